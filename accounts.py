@@ -0,0 +1,78 @@
+import collections
+import json
+import logging
+import os
+
+logger = logging.getLogger("accounts")
+
+# One mailbox to back up. recordPath holds the ledger, sync and checkpoint files of the account.
+Account = collections.namedtuple(
+    'Account', ['name', 'token', 'query', 'contentType', 'downloadPath', 'recordPath'])
+
+
+def _directory(path: str, name: str, field: str):
+    if path[-1] != '/' and path[-1] != '\\':
+        path = path + '/'
+    if not os.path.isdir(path):
+        raise ValueError("%s of account %s does not exist, please create it first: %s" %
+                         (field, name, path))
+    return path
+
+
+def loadManifest(path: str, query: str = '', contentType: str = ''):
+    """
+    Reads the accounts to back up from a JSON manifest: a list of objects with a token, the path
+    to the account's token.pickle, and a downloadPath. Each may also have a name, used in logs, a
+    query and a contentType, which default to the given ones, and a recordPath, which defaults to
+    the downloadPath.
+
+    Parameters
+    ----------
+    path : str
+        Path and file name of the manifest
+    query : str
+        gmail query string of accounts that don't have their own
+    contentType : str
+        content type of accounts that don't have their own
+
+    Returns
+    -------
+    List of Account.
+
+    Raises
+    ------
+    ValueError
+        If the manifest is not valid, an account is missing a field, a directory does not exist or
+        two accounts share a token, download directory or record directory.
+    """
+
+    with open(path, 'r', encoding="utf-8") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError("Account manifest %s must hold a list of accounts." % path)
+
+    accounts = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('token') or not entry.get('downloadPath'):
+            raise ValueError(
+                "Account %d of %s must have a token and a downloadPath." % (index + 1, path))
+        name = entry.get('name') or entry['token']
+        downloadPath = _directory(entry['downloadPath'], name, 'downloadPath')
+        recordPath = _directory(entry.get('recordPath') or downloadPath, name, 'recordPath')
+        accounts.append(Account(name, entry['token'], entry.get('query', query),
+                                entry.get('contentType', contentType), downloadPath, recordPath))
+
+    # accounts sharing these would overwrite each other's tokens and ledgers, or remove each
+    # other's partial downloads when starting
+    for field in ['name', 'token', 'downloadPath', 'recordPath']:
+        values = [getattr(account, field) for account in accounts]
+        if field.endswith('Path'):
+            # the same directory may be written in several ways
+            values = [os.path.realpath(value) for value in values]
+        duplicates = [value for value, count in collections.Counter(values).items() if count > 1]
+        if duplicates:
+            raise ValueError("Accounts in %s share a %s: %s" %
+                             (path, field, ", ".join(duplicates)))
+
+    logger.info("%d accounts read from %s", len(accounts), path)
+    return accounts
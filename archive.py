@@ -0,0 +1,254 @@
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+
+from ledger import Ledger
+from storage import claimPath
+
+logger = logging.getLogger("archive")
+
+# Archive formats that attachments can be written into
+ARCHIVE_FORMATS = ['tar', 'zip']
+
+# Periods archives can be rolled over by, as the strftime format of the period an archive is for
+ARCHIVE_PERIODS = {'day': '%Y%m%d', 'month': '%Y%m'}
+
+# Archives are rolled over once they reach this many bytes by default
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+
+class ArchiveWriter():
+    """
+    ArchiveWriter appends attachments to rolling tar or zip archives instead of writing a file per
+    attachment. tar archives are optionally gzip compressed, zip archives deflate each member. A new
+    archive is started once the current one reaches maxSize bytes, or when the day or month changes
+    if a period is given, and by every new ArchiveWriter, so an archive is never appended to again
+    once closed.
+
+    Each attachment is stored as a member named after its email ID and filename. The member name
+    and its offset in the uncompressed archive, recorded in the ledger, let extractMember read a
+    single attachment back without unpacking the archive. An archive cut short by a crash keeps
+    every member recorded before it, but a zip archive then lacks its central directory and must be
+    repaired, with zip -FF for example, before other tools can read it.
+
+    Attributes
+    ----------
+    directory : str
+        Directory the archives are created in.
+    format : str
+        'tar' or 'zip'.
+    compress : bool
+        Whether archives are compressed.
+    maxSize : int
+        Size in bytes an archive is rolled over at.
+    period : str
+        'day' or 'month' to also roll archives over by date, None to only roll them over by size.
+    path : str
+        Path and file name of the current archive, None if none is open.
+    """
+
+    def __init__(self, directory: str, format: str = 'tar', compress: bool = False, maxSize: int = DEFAULT_MAX_SIZE,
+                 period: str = None):
+        self.logger = logging.getLogger(
+            "archive." + self.__class__.__name__)
+
+        if format not in ARCHIVE_FORMATS:
+            raise ValueError("Archive format must be one of %s." %
+                             ", ".join(ARCHIVE_FORMATS))
+        if period and period not in ARCHIVE_PERIODS:
+            raise ValueError("Archive period must be one of %s." %
+                             ", ".join(ARCHIVE_PERIODS))
+
+        self.directory = directory
+        self.format = format
+        self.compress = compress
+        self.maxSize = maxSize
+        self.period = period
+        self.path = None
+        self.__raw = None
+        self.__gzip = None
+        self.__archive = None
+        self.__periodKey = None
+        self.__names = set()
+        self.__count = 0
+
+    @property
+    def extension(self):
+        if self.format == 'zip':
+            return '.zip'
+        return '.tar.gz' if self.compress else '.tar'
+
+    def __currentPeriod(self):
+        return time.strftime(ARCHIVE_PERIODS[self.period]) if self.period else None
+
+    def __open(self):
+        # numbered so that archives rolled over within a second still sort in order
+        self.__count += 1
+        self.path = claimPath(self.directory, '%s-%03d%s' % (
+            time.strftime('attachments-%Y%m%d-%H%M%S'), self.__count, self.extension))
+        self.__raw = open(self.path, 'wb')
+        self.__periodKey = self.__currentPeriod()
+        self.__names = set()
+        if self.format == 'zip':
+            self.__archive = zipfile.ZipFile(self.__raw, 'w', zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED,
+                                             allowZip64=True)
+        else:
+            fileobj = self.__raw
+            if self.compress:
+                self.__gzip = gzip.GzipFile(fileobj=self.__raw, mode='wb')
+                fileobj = self.__gzip
+            self.__archive = tarfile.open(
+                fileobj=fileobj, mode='w', format=tarfile.PAX_FORMAT)
+        self.logger.info("Started archive %s", self.path)
+
+    def __memberName(self, msgId: str, partId: str, filename: str):
+        name = '%s/%s' % (msgId, filename)
+        if name in self.__names:
+            # two attachments of an email with the same filename
+            name = '%s/%s-%s' % (msgId, partId, filename)
+        self.__names.add(name)
+        return name
+
+    def add(self, tempPath: str, msgId: str, partId: str, filename: str):
+        """
+        Appends a downloaded attachment to the current archive, first rolling over to a new archive
+        if the current one is full or for an earlier period. The temporary file is left in place.
+
+        Parameters
+        ----------
+        tempPath : str
+            Path and file name of the temporary file with the data.
+        msgId : str
+            ID of the email that contains the attachment.
+        partId : str
+            ID of the MIME part holding the attachment.
+        filename : str
+            Filename to store the attachment under.
+
+        Returns
+        -------
+        Tuple of the path of the archive, the member name and the offset of the member in the
+        uncompressed archive.
+        """
+
+        if self.__archive and (self.__raw.tell() >= self.maxSize or self.__periodKey != self.__currentPeriod()):
+            self.close()
+        if not self.__archive:
+            self.__open()
+
+        member = self.__memberName(msgId, partId or '', filename)
+        if self.format == 'zip':
+            self.__archive.write(tempPath, member)
+            offset = self.__archive.getinfo(member).header_offset
+        else:
+            info = self.__archive.gettarinfo(tempPath, arcname=member)
+            # the temporary file is private to this user, the member shouldn't be
+            info.mode = 0o644
+            info.mtime = time.time()
+            offset = self.__archive.offset
+            with open(tempPath, 'rb') as f:
+                self.__archive.addfile(info, f)
+        return self.path, member, offset
+
+    def flush(self):
+        """
+        Flushes everything added so far to disk, so that it survives a crash.
+        """
+
+        if not self.__archive:
+            return
+        if self.__gzip:
+            self.__gzip.flush()
+        self.__raw.flush()
+        os.fsync(self.__raw.fileno())
+
+    def close(self):
+        """
+        Completes and closes the current archive, if any. The next add starts a new one.
+        """
+
+        if not self.__archive:
+            return
+        self.__archive.close()
+        if self.__gzip:
+            self.__gzip.close()
+        self.__raw.flush()
+        os.fsync(self.__raw.fileno())
+        self.__raw.close()
+        self.logger.info("Completed archive %s", self.path)
+        self.__archive = None
+        self.__gzip = None
+        self.__raw = None
+        self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+def extractMember(archivePath: str, member: str, offset: int, path: str):
+    """
+    Extracts a single attachment from an archive written by ArchiveWriter, without unpacking the
+    rest of it. Members of uncompressed tar archives are read directly at their offset. Compressed
+    tar archives are decompressed up to the member but nothing before it is written out.
+
+    Parameters
+    ----------
+    archivePath : str
+        Path and file name of the archive.
+    member : str
+        Name of the member holding the attachment.
+    offset : int
+        Offset of the member in the uncompressed archive, as recorded in the ledger.
+    path : str
+        Path and file name to extract the attachment to.
+    """
+
+    if archivePath.endswith('.zip'):
+        with zipfile.ZipFile(archivePath) as archive, archive.open(member) as source, open(path, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        return
+
+    opener = gzip.open if archivePath.endswith('.gz') else open
+    with opener(archivePath, 'rb') as f:
+        f.seek(offset)
+        # a tar file opened at the offset starts with the member's header
+        with tarfile.open(fileobj=f, mode='r:') as archive:
+            info = archive.next()
+            if not info or info.name != member:
+                raise ValueError("No member %s at offset %d of %s" %
+                                 (member, offset, archivePath))
+            with archive.extractfile(info) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract the attachments of an email from the archives recorded in a ledger.")
+    parser.add_argument('ledger', help="path of the ledger.sqlite3 of the download")
+    parser.add_argument('msgId', help="ID of the email")
+    parser.add_argument('--part', help="only extract the attachment in this MIME part")
+    parser.add_argument('--out', default='.', help="directory to extract into")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with Ledger(args.ledger) as ledger:
+        members = [member for member in ledger.members(args.msgId)
+                   if args.part is None or member[0] == args.part]
+    if not members:
+        exit("No archived attachments recorded for email " + args.msgId)
+    for partId, filename, archivePath, member, offset in members:
+        path = os.path.join(args.out, os.path.basename(member))
+        extractMember(archivePath, member, offset, path)
+        logger.info("Extracted part %s %s to %s", partId, filename, path)
+
+
+if __name__ == '__main__':
+    main()
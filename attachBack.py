@@ -1,5 +1,12 @@
 #from __future__ import print_function
 
+# first, so the startup report includes the time taken by the other imports
+import startup
+
+import collections
+import concurrent.futures
+import contextlib
+import glob
 import json
 import logging
 import mimetypes
@@ -7,36 +14,99 @@ import os
 import os.path
 import pickle
 import re
+import signal
+import threading
 import time
 
-from oauthlib.oauth2.rfc6749.errors import OAuth2Error
-
 import envvar
-from emailMsg import Attachment, Email, EmailMsg, GoogleAuth
+from accounts import Account, loadManifest
+from archive import ArchiveWriter
+from cache import MetadataCache
+from hooks import PostProcessor, newProcessPool
+from ledger import Ledger
+from metrics import Metrics
+from planner import PlannedEmail, loadPlan, planBackup, planSummary, savePlan
+from quota import QuotaLimiter
+from startup import lazyImport
+from storage import ContentStore, NameIndex
+from writer import AttachmentWriter
+from emailMsg import (Attachment, AttachmentFilter, Email, EmailMsg,
+                      GoogleAuth, History, ShardedEmail,
+                      fetchAttachments, getHistoryId)
+
+# Only needed for errors, loaded on first use
+requests = lazyImport('requests')
 
 logger = logging.getLogger("attachBack")
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+LEDGER_FILENAME = 'ledger.sqlite3'
+
+# Records of downloaded attachments from before the ledger, imported into it on first use
 RECORD_FILENAME = 'records.txt'
 
+SYNC_FILENAME = 'sync.json'
+
+CHECKPOINT_FILENAME = 'checkpoint.json'
+
+# Parsed metadata of emails seen by earlier runs
+METADATA_CACHE_FILENAME = 'metadata.sqlite3'
+
+# What a run would download, written by ATTACH_PLAN and executed by ATTACH_FROM_PLAN
+PLAN_FILENAME = 'plan.json'
+
+# Directory in the download path that deduplicated attachments are stored in
+STORE_DIRNAME = '.store'
+
+# Incremental runs search this many seconds before the previous run to allow for clock differences
+SYNC_OVERLAP = 24 * 60 * 60
+
+# Attachment data held in memory by one group of batch requests before it is written out. The API
+# client holds a batch response several times over while parsing it, so a group peaks at many
+# times this, and larger groups save few requests for the memory they take.
+MAX_BATCH_BYTES = 2 * 1024 * 1024
 
-def authenticate(tokenFileName: str, credFileName: str):
+# Attachments larger than this are not batched but streamed to disk with a request each, in
+# bounded memory. The overhead of a request is small next to their data.
+MAX_BATCHED_ATTACHMENT_SIZE = 256 * 1024
+
+
+def _isBatched(attachment: Attachment):
+    return attachment.size is not None and attachment.size <= MAX_BATCHED_ATTACHMENT_SIZE
+
+
+def authenticate(tokenFileName: str, credFileName: str, limiter: QuotaLimiter = None, maxRetries: int = 5,
+                 metrics: Metrics = None, concurrency: threading.Semaphore = None):
     """
     Reads previous tokens and credentials if they exist, and uses them to to authenticate with Google APIs by
-    creating a GoogleAuth object.
+    creating a GoogleAuth object. The tokens are only saved again if they changed.
 
     Parameter:
     ----------
     tokenFileName : str
     credFileName : str
+    limiter : QuotaLimiter
+        quota shared by all requests, defaults to Gmail's per user quota
+    maxRetries : int
+        number of times rate limited or failed requests are retried
+    metrics : Metrics
+        metrics to record the requests into
+    concurrency : threading.Semaphore
+        caps the requests in flight across accounts, None for no cap
 
     Returns:
     --------
     GoogleAuth object
+
+    Raises:
+    -------
+    OAuth2Error
+        If permission could not be received by the user, logged by GoogleAuth.
     """
 
+    started = time.perf_counter()
     creds = None
     # The file token.pickle stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -45,28 +115,55 @@ def authenticate(tokenFileName: str, credFileName: str):
         with open(tokenFileName, 'rb') as token:
             creds = pickle.load(token)
             logger.info("Credentials read from %s", tokenFileName)
+    savedToken = creds.token if creds else None
 
     # Load the secrets
     with open(credFileName, 'r') as json_file:
         client_config = json.load(json_file)
         logger.info("App secrets read from %s", credFileName)
 
-    try:
-        auth = GoogleAuth(SCOPES, GoogleAuth.API_GMAIL,
-                          GoogleAuth.API_VER_1, client_config, creds)
-
-        # Save the credentials for the next run
-        with open(tokenFileName, 'wb') as token:
-            pickle.dump(auth.creds, token)
-            logger.info("Credentials saved to %s for future use.",
-                        tokenFileName)
-        logging.info("Successfully authenticated to gmail.")
-    except OAuth2Error as e:
-        logging.error("Failure to authenticate to gmail: %s", e)
-        raise e
+    auth = GoogleAuth(SCOPES, GoogleAuth.API_GMAIL,
+                      GoogleAuth.API_VER_1, client_config, creds,
+                      limiter=limiter, maxRetries=maxRetries, metrics=metrics,
+                      concurrency=concurrency)
+    # Save the credentials for the next run, if they were refreshed or newly authorized
+    saveCredentials(auth, tokenFileName, savedToken)
+    logging.info("Successfully authenticated to gmail.")
+    auth.metrics.increment('startup_seconds_total', 'authentication',
+                           time.perf_counter() - started)
     return auth
 
 
+def saveCredentials(auth: GoogleAuth, tokenFileName: str, savedToken: str = None):
+    """
+    Saves the credentials of a GoogleAuth object for future runs, unless their access token is the
+    one already saved. The file is replaced in one step so an interrupted write never loses them.
+
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authenticated object whose credentials to save
+    tokenFileName : str
+        Path and file name to save the credentials to
+    savedToken : str
+        Access token the file already holds, None if it holds none
+
+    Returns
+    -------
+    The access token the file holds afterwards.
+    """
+
+    if auth.creds.token == savedToken and os.path.exists(tokenFileName):
+        logger.debug("Credentials unchanged, not saving them.")
+        return savedToken
+    tempFile = tokenFileName + '.tmp'
+    with open(tempFile, 'wb') as token:
+        pickle.dump(auth.creds, token)
+    os.replace(tempFile, tokenFileName)
+    logger.info("Credentials saved to %s for future use.", tokenFileName)
+    return auth.creds.token
+
+
 def isValidFileName(name: str):
     """
     Returns true or false based on if the provided string is a valid filename based on Windows filename limitations.
@@ -108,9 +205,278 @@ def isValidFileName(name: str):
     return True
 
 
-def downloadAttachmentsFromGmail(auth: GoogleAuth, downloadPath: str, recordFile: str, records: list, query: str = '', contentType: str = ''):
+def fetchMessage(auth: GoogleAuth, msgId: str, isWanted, downloadPath: str, cache: MetadataCache = None):
+    """
+    Retrieves an email and downloads the attachments that are wanted into temporary files in the
+    download path. Safe to call from worker threads.
+
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authentication object into Google APIs
+    msgId : str
+        ID of the email to retrieve
+    isWanted : callable
+        Called with the email and each of its attachments, returns True if the attachment should be
+        downloaded
+    downloadPath : str
+        Path to download attachments into
+    cache : MetadataCache
+        Cache to read the email from if it was seen before, None to always retrieve it
+
+    Returns
+    -------
+    Tuple of the EmailMsg and a list of (Attachment, SavedFile) tuples of its wanted attachments.
+    """
+
+    email = EmailMsg(auth, msgId, cache=cache)
+    logger.debug("Email ID: %s Subject: %s", email.msgId, email.subject)
+    attachments = []
+    for attachment in email:
+        if isWanted(email, attachment):
+            attachments.append(
+                (attachment, attachment.saveToTemp(downloadPath, sync=False)))
+    return email, attachments
+
+
+def fetchMessagesBatched(auth: GoogleAuth, emails: Email, isWanted, downloadPath: str, batchSize: int):
+    """
+    Generator over the emails, downloading the wanted attachments of batchSize emails at a time with
+    batch requests. A group is also downloaded early once its attachments reach MAX_BATCH_BYTES.
+    Attachments over MAX_BATCHED_ATTACHMENT_SIZE, or of unknown size, are streamed one by one instead.
+
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authentication object into Google APIs
+    emails : Email
+        Emails to retrieve, ideally created with the same batchSize
+    isWanted : callable
+        Called with the email and each of its attachments, returns True if the attachment should be
+        downloaded
+    downloadPath : str
+        Path to download attachments into
+    batchSize : int
+        Maximum number of sub-requests per batch request
+
+    Yields
+    ------
+    Tuple of the EmailMsg and a list of (Attachment, SavedFile) tuples of its wanted attachments.
+    """
+
+    def downloadGroup(group):
+        fetchAttachments(auth, [attachment for _, attachments in group for attachment in attachments
+                                if _isBatched(attachment)], batchSize)
+        for email, attachments in group:
+            yield email, [(attachment, attachment.saveToTemp(downloadPath, sync=False)) for attachment in attachments]
+
+    group = []
+    groupBytes = 0
+    for email in emails:
+        logger.debug("Email ID: %s Subject: %s", email.msgId, email.subject)
+        attachments = [
+            attachment for attachment in email if isWanted(email, attachment)]
+        group.append((email, attachments))
+        groupBytes += sum(attachment.size for attachment in attachments if _isBatched(attachment))
+        if len(group) >= batchSize or groupBytes >= MAX_BATCH_BYTES:
+            yield from downloadGroup(group)
+            group = []
+            groupBytes = 0
+    if group:
+        yield from downloadGroup(group)
+
+
+def fetchMessages(auth: GoogleAuth, emails: Email, isWanted, downloadPath: str, workers: int = 1, batchSize: int = 0,
+                  executor: concurrent.futures.Executor = None, cache: MetadataCache = None):
+    """
+    Generator over the emails, retrieving the emails and their wanted attachments. With a batchSize
+    the emails and attachments are retrieved with batch requests. Otherwise with more than one
+    worker, or an executor shared with other accounts, the emails are retrieved concurrently by a
+    thread pool. Results are still yielded in the order of the emails, and at most twice as many
+    emails as workers are held in memory.
+
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authentication object into Google APIs
+    emails : Email
+        Emails to retrieve
+    isWanted : callable
+        Called with the email and each of its attachments, returns True if the attachment should be
+        downloaded
+    downloadPath : str
+        Path to download attachments into
+    workers : int
+        Number of threads retrieving emails
+    batchSize : int
+        Maximum number of sub-requests per batch request, 0 to not use batch requests
+    executor : concurrent.futures.Executor
+        Thread pool to retrieve emails with, None to start one of workers threads
+    cache : MetadataCache
+        Cache to read emails seen before from, None to always retrieve them. Emails handed out by
+        iterating emails, as with a batchSize, are read from the cache the emails were created with.
+
+    Yields
+    ------
+    Tuple of the EmailMsg and a list of (Attachment, SavedFile) tuples of its wanted attachments.
+    """
+
+    if batchSize:
+        yield from fetchMessagesBatched(auth, emails, isWanted, downloadPath, batchSize)
+        return
+
+    if executor:
+        yield from _fetchMessagesWith(executor, auth, emails, isWanted, downloadPath, workers, cache)
+        return
+
+    if workers <= 1:
+        for msgId in emails.messageIds():
+            yield fetchMessage(auth, msgId, isWanted, downloadPath, cache)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch") as executor:
+        yield from _fetchMessagesWith(executor, auth, emails, isWanted, downloadPath, workers, cache)
+
+
+def _fetchMessagesWith(executor: concurrent.futures.Executor, auth: GoogleAuth, emails: Email, isWanted,
+                       downloadPath: str, workers: int, cache: MetadataCache = None):
+    pending = collections.deque()
+    try:
+        for msgId in emails.messageIds():
+            pending.append(executor.submit(
+                fetchMessage, auth, msgId, isWanted, downloadPath, cache))
+            if len(pending) >= max(workers, 1) * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # a shared executor outlives this generator, don't leave it work nobody will collect
+        for future in pending:
+            future.cancel()
+
+
+def attachmentFilename(email: EmailMsg, attachment: Attachment):
+    """
+    Returns the filename to save an attachment under. The filename is taken from the attachment, or
+    made up if it is missing or invalid.
+
+    Parameters
+    ----------
+    email : EmailMsg
+        Email that contains the attachment
+    attachment : Attachment
+        Attachment to name
+
+    Returns
+    -------
+    The filename, or None if the attachment has no usable name and its extension can't be guessed.
+    """
+
+    logger.debug("Content-type string of attachment: %s",
+                 attachment.contentType)
+    mimetype = attachment.contentType.split(';')[0].strip()
+    logger.debug("Mimetype determined to be: %s", mimetype)
+    filename = attachment.filename
+
+    logger.debug("Attachment filename: %s", attachment.filename)
+    # if there's no filename or its invalid, we make one up and guess the extension from content-type
+    if not attachment.filename or not isValidFileName(attachment.filename):
+        extension = mimetypes.guess_extension(
+            mimetype)
+        if not extension:
+            logger.warning(
+                "Skipping attachment. Unable to determine extension from content-type for unnamed attachment in email: %s.", email.subject)
+            return None
+
+        filename = "%s-%s%s" % (email.msgId, attachment.partId, extension)
+        logger.info("Invalid name: %s - new name: %s",
+                    attachment.filename, filename)
+
+    logger.debug("Filename: %s", filename)
+    return filename
+
+
+def removePartialDownloads(downloadPath: str):
+    """
+    Removes temporary files left in the download path by an interrupted run.
+
+    Parameters
+    ----------
+    downloadPath : str
+        Path attachments are downloaded into
+    """
+
+    for partial in glob.glob(os.path.join(downloadPath, '.attachBack-*.part')):
+        logger.info("Removing partial download %s", partial)
+        os.remove(partial)
+
+
+def loadSyncState(syncFile: str):
+    """
+    Reads the state saved by the last successful incremental run.
+
+    Parameters
+    ----------
+    syncFile : str
+        Path and file name of the sync state
+
+    Returns
+    -------
+    Dictionary with the query, historyId and time of the last run, or None if there is none.
+    """
+
+    if not os.path.exists(syncFile):
+        return None
+    try:
+        with open(syncFile, 'r', encoding="utf-8") as f:
+            state = json.load(f)
+    except ValueError as e:
+        logger.warning("Ignoring unreadable sync state %s: %s", syncFile, e)
+        return None
+    if not state.get('historyId') or 'time' not in state:
+        logger.warning("Ignoring incomplete sync state %s", syncFile)
+        return None
+    return state
+
+
+def saveSyncState(syncFile: str, state: dict):
+    """
+    Saves the state of a successful incremental run, replacing the previous state in one step so
+    an interrupted write never leaves a partial file.
+
+    Parameters
+    ----------
+    syncFile : str
+        Path and file name of the sync state
+    state : dict
+        Dictionary with the query, historyId and time of the run
+    """
+
+    tempFile = syncFile + '.tmp'
+    with open(tempFile, 'w', encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tempFile, syncFile)
+    logger.info("Saved history %s to %s", state['historyId'], syncFile)
+
+
+def downloadAttachmentsFromGmail(auth: GoogleAuth, downloadPath: str, ledger: Ledger, query: str = '',
+                                 contentType: str = '', attachmentFilter: AttachmentFilter = None, workers: int = 1,
+                                 batchSize: int = 0, syncFile: str = None, checkpointFile: str = None,
+                                 pageSize: int = 500, store: ContentStore = None,
+                                 executor: concurrent.futures.Executor = None, stop: threading.Event = None,
+                                 archive: ArchiveWriter = None, cache: MetadataCache = None, listShards: int = 1,
+                                 postProcessor: PostProcessor = None, plan: dict = None, layout: str = 'flat',
+                                 names: NameIndex = None):
     """
     Downloads the attachments from gmail filtered by the query str and the desired content type.
+    Attachments are only downloaded once they pass the filter and are not already recorded.
+
+    With a syncFile, the mailbox historyId is saved after a successful run and the next run with the
+    same query only looks at emails added since then. If that history has expired, all emails
+    matching the query are checked again.
+
+    With a checkpointFile, a run that is interrupted while checking all emails continues from the
+    last checkpoint when run again with the same query.
 
     Parameters
     ----------
@@ -118,70 +484,340 @@ def downloadAttachmentsFromGmail(auth: GoogleAuth, downloadPath: str, recordFile
         Authentication object into Google APIs
     downloadPath : str
         Path to download attachments into
-    recordFile : str
-        Path and file name to record downloaded attachments into to ensure they are not duplicated on subsequent runs
+    ledger : Ledger
+        Ledger to record downloaded attachments into to ensure they are not duplicated on subsequent runs
     query : str
         gmail query string, used to filter emails that will be checked for attachments
     contentType : str
         string or substring that represents content-types of attachments, such as "application/pdf" or "image/jpeg" or "image/"
+        Ignored if attachmentFilter is provided.
+    attachmentFilter : AttachmentFilter
+        predicate applied to each attachment's metadata, attachments it rejects are never downloaded
+    workers : int
+        number of threads retrieving emails and attachments concurrently
+    batchSize : int
+        number of emails or attachments retrieved per batch request, 0 to not use batch requests
+    syncFile : str
+        Path and file name to save the mailbox history state into for incremental runs, None to always check every email
+    checkpointFile : str
+        Path and file name to save the position in the emails into so an interrupted run can resume, None to not resume
+    pageSize : int
+        number of emails listed per request, up to 500
+    store : ContentStore
+        store to keep a single copy of identical attachments in, None to save every attachment separately
+    executor : concurrent.futures.Executor
+        thread pool shared with other accounts to retrieve emails with, None to start one of workers threads
+    stop : threading.Event
+        when set, the run ends after the email being saved, leaving its checkpoint for the next run
+    archive : ArchiveWriter
+        rolling archives to write attachments into, None to write a file per attachment
+    cache : MetadataCache
+        cache of the metadata of emails seen before, so they are not retrieved again, None to retrieve every email
+    listShards : int
+        number of threads listing the emails at once, each a window of time of the query, 1 to list them page by page
+    postProcessor : PostProcessor
+        hooks to run over every attachment saved, None to only save them. Can't be used with an archive.
+    plan : dict
+        plan made by planBackup to download the attachments of, instead of listing the emails of the query
+    layout : str
+        directories of the download path attachments are filed in, one of storage.LAYOUTS. Can't be used with an archive.
+    names : NameIndex
+        names taken in the download path, kept across runs into it so its directories are read once, None for a new index
+
+    Returns
+    -------
+    True if every email was checked, False if the run was stopped.
+    """
+
+    if not attachmentFilter:
+        attachmentFilter = AttachmentFilter(contentType)
+
+    def isWanted(email, attachment):
+        # skip if the attachment has already been downloaded
+        if ledger.contains(email.msgId, attachment.partId, attachment.filename):
+            logger.info(
+                "Attachment already downloaded, skipping. Email was: %s", email.subject)
+            auth.metrics.increment('attachments_skipped_total', 'recorded')
+            return False
+        if not attachmentFilter(attachment):
+            auth.metrics.increment('attachments_skipped_total', 'filtered')
+            return False
+        return True
+
+    emails = None
+    syncState = None
+    if plan:
+        if plan['query'] != query:
+            logger.warning("The plan was made for the query %s, not %s", plan['query'], query)
+        emails = PlannedEmail(auth, plan, checkpointFile=checkpointFile, cache=cache,
+                              batchSize=batchSize)
+        # the plan found everything up to when it was made
+        syncState = {'query': plan['query'], 'historyId': plan['historyId'],
+                     'time': int(plan['createdAt'])}
+    elif syncFile:
+        # taken before listing, so that emails arriving during the run are seen by the next one
+        syncState = {'query': query, 'historyId': getHistoryId(auth),
+                     'time': int(time.time())}
+        lastState = loadSyncState(syncFile)
+        if lastState and lastState.get('query') == query:
+            try:
+                emails = History(auth, lastState['historyId'], query=query,
+                                 since=lastState['time'] - SYNC_OVERLAP, cache=cache)
+            except requests.HTTPError as e:
+                if e.args[0] != 404:
+                    raise e
+                logger.warning(
+                    "History %s has expired, checking all emails.", lastState['historyId'])
+        elif lastState:
+            logger.info("Query changed since the last run, checking all emails.")
+
+    if not emails and listShards > 1:
+        emails = ShardedEmail(auth, query=query, shards=listShards, batchSize=batchSize,
+                              checkpointFile=checkpointFile, pageSize=pageSize, cache=cache, syncState=syncState)
+        # a resumed listing skips what the interrupted run listed, so the next run looks from where
+        # that run started
+        syncState = emails.syncState
+    elif not emails:
+        emails = Email(auth, query=query, batchSize=batchSize,
+                       checkpointFile=checkpointFile, pageSize=pageSize, cache=cache, syncState=syncState)
+        syncState = emails.syncState
+
+    removePartialDownloads(downloadPath)
+
+    # the workers only download into temporary files, the writer names and records them, and an
+    # email is checkpointed once the writer is done with it
+    writer = AttachmentWriter(downloadPath, ledger, attachmentFilename, auth.metrics, store, archive,
+                              postProcessor=postProcessor, layout=layout, names=names)
+    stopped = False
+    try:
+        for email, attachments in fetchMessages(auth, emails, isWanted, downloadPath, workers, batchSize, executor,
+                                                cache):
+            auth.metrics.increment('emails_total')
+            writer.put(email, attachments)
+            for msgId in writer.popWritten():
+                emails.checkpoint(msgId)
+            if stop and stop.is_set():
+                stopped = True
+                break
+    finally:
+        emails.close()
+        writer.close()
+    for msgId in writer.popWritten():
+        emails.checkpoint(msgId)
+    if postProcessor:
+        postProcessor.flush()
+    if stopped:
+        logger.info("Stopped, the next run continues from the last checkpoint.")
+        return False
+    emails.clearCheckpoint()
+
+    if syncFile:
+        saveSyncState(syncFile, syncState)
+    return True
+
+
+def watchMailbox(auth: GoogleAuth, downloadPath: str, ledger: Ledger, syncFile: str, stop: threading.Event,
+                 minInterval: float = 5, maxInterval: float = 300, onPass=None, **options):
     """
+    Keeps downloading new attachments until stop is set. The first pass checks every email, as an
+    incremental run would, and later passes only the emails added since the previous one. Between
+    passes the mailbox historyId is polled, a single cheap request, and a pass is only made when it
+    moved. Polls start minInterval apart and back off to maxInterval while the mailbox is idle,
+    returning to minInterval as soon as something changes. A failed pass is logged and retried
+    after maxInterval.
 
-    records = []
-    recf = open(recordFile, 'a+', encoding="utf-8")
-    records = [record.rstrip() for record in recf.readlines()]
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authentication object into Google APIs, kept for the whole watch
+    downloadPath : str
+        Path to download attachments into
+    ledger : Ledger
+        Ledger to record downloaded attachments into
+    syncFile : str
+        Path and file name to save the mailbox history state into
+    stop : threading.Event
+        Set to end the watch, which waits for the email being saved
+    minInterval : float
+        Seconds between polls while mail is arriving
+    maxInterval : float
+        Most seconds between polls while the mailbox is idle
+    onPass : callable
+        Called without arguments after every poll, such as to write the metrics
+    options
+        Keyword arguments of downloadAttachmentsFromGmail, such as the query
+    """
 
-    emails = Email(auth, query=query)
+    query = options.get('query', '')
+    interval = minInterval
+    while not stop.is_set():
+        try:
+            lastState = loadSyncState(syncFile)
+            if lastState and lastState.get('query') == query and \
+                    str(lastState['historyId']) == str(getHistoryId(auth)):
+                interval = min(interval * 2, maxInterval)
+                logger.debug("No changes, polling again in %.0fs", interval)
+            else:
+                downloadAttachmentsFromGmail(auth, downloadPath, ledger, syncFile=syncFile,
+                                             stop=stop, **options)
+                interval = minInterval
+        except Exception:
+            logger.exception("Pass failed, retrying in %.0fs", maxInterval)
+            interval = maxInterval
+        if onPass:
+            onPass()
+        stop.wait(interval)
+
+
+def runAccount(account: Account, metrics: Metrics = None, executor: concurrent.futures.Executor = None,
+               concurrency: threading.Semaphore = None, stop: threading.Event = None, onPass=None,
+               processPool: concurrent.futures.Executor = None):
+    """
+    Backs up the attachments of one account with the settings read by envvar, once or, with
+    ATTACH_WATCH, until stop is set. With ATTACH_PLAN, only plans the backup. Each account has its own credentials, quota, ledger, sync state
+    and checkpoint, so accounts never block or corrupt each other.
 
-    for email in emails:
-        logger.debug("Email ID: %s Subject: %s", email.msgId, email.subject)
-        for attachment in email:
-            # skip if the attachment has already been downloaded
-            if (email.msgId + attachment.filename) in records:
-                logger.info(
-                    "Attachment already downloaded, skipping. Email was: %s", email.subject)
-                continue
-
-            if contentType in attachment.contentType:
-                logger.debug("Content-type string of attachment: %s",
-                             attachment.contentType)
-                mimetype = attachment.contentType.split(';')[0].strip()
-                logger.debug("Mimetype determined to be: %s", mimetype)
-                filename = attachment.filename
-
-                logger.debug("Attachment filename: %s", attachment.filename)
-                # if there's no filename or its invalid, we make one up and guess the extension from content-type
-                if not attachment.filename or not isValidFileName(attachment.filename):
-                    extension = mimetypes.guess_extension(
-                        mimetype)
-                    if not extension:
-                        logger.warning(
-                            "Skipping attachment. Unable to determine extension from content-type for unnamed attachment in email: %s.", email.subject)
-                        continue
-
-                    filename = "temp" + str(time.time()) + extension
-                    logger.info("Invalid name: %s - new name: %s",
-                                attachment.filename, filename)
-                if filename:
-                    logger.debug("Filename: %s", filename)
-
-                    # create a name modifier if there's already a file with the same name
-                    diff = ''
-                    if os.path.exists(''.join([downloadPath, filename])):
-                        logger.info("Duplicate file %s found.", filename)
-                        diff = str(time.time())+'-'
-
-                    path = ''.join(
-                        [downloadPath, diff, filename])
-                    logger.info("Writing: %s", path)
-                    f = open(path, 'wb')
-                    f.write(attachment.bytes)
-                    f.close()
-
-                    newRecord = email.msgId + attachment.filename
-                    records.append(newRecord)
-
-                    recf.write(newRecord + "\n")
-    recf.close()
+    Parameters
+    ----------
+    account : Account
+        Account to back up
+    metrics : Metrics
+        Metrics to record the run into, None for new ones
+    executor : concurrent.futures.Executor
+        Thread pool shared with other accounts to retrieve emails with, None to start one of
+        ATTACH_WORKERS threads
+    concurrency : threading.Semaphore
+        Caps the requests in flight across accounts, None for no cap
+    stop : threading.Event
+        Set to end the run after the email being saved
+    onPass : callable
+        Called after every poll of ATTACH_WATCH
+    processPool : concurrent.futures.Executor
+        Pool of processes shared with other accounts to run ATTACH_HOOKS in, None to start one of
+        ATTACH_HOOK_WORKERS processes
+
+    Returns
+    -------
+    GoogleAuth object of the account, holding the metrics of the run.
+    """
+
+    # watching only makes sense incrementally
+    syncFile = account.recordPath + \
+        SYNC_FILENAME if envvar.incremental or envvar.watch else None
+    checkpointFile = account.recordPath + CHECKPOINT_FILENAME if envvar.resume else None
+    store = ContentStore(account.downloadPath +
+                         STORE_DIRNAME) if envvar.deduplicate else None
+
+    auth = authenticate(account.token, envvar.appCredentials, QuotaLimiter(envvar.quotaUnits),
+                        envvar.maxRetries, metrics, concurrency)
+    savedToken = auth.creds.token
+
+    attachmentFilter = AttachmentFilter(account.contentType, envvar.minSize,
+                                        envvar.maxSize, envvar.filenamePattern)
+
+    archive = ArchiveWriter(account.downloadPath, envvar.archive, envvar.archiveCompress, envvar.archiveMaxSize,
+                            envvar.archivePeriod) if envvar.archive else None
+    cache = MetadataCache(account.recordPath + METADATA_CACHE_FILENAME,
+                          envvar.metadataCacheSize) if envvar.metadataCacheSize else None
+    plan = loadPlan(account.recordPath + PLAN_FILENAME) if envvar.fromPlan else None
+
+    options = {'query': account.query, 'attachmentFilter': attachmentFilter, 'workers': envvar.workers,
+               'batchSize': envvar.batchSize, 'checkpointFile': checkpointFile,
+               'pageSize': envvar.pageSize, 'store': store, 'executor': executor, 'archive': archive,
+               'cache': cache, 'listShards': envvar.listShards, 'plan': plan, 'layout': envvar.layout,
+               # kept across the passes of a watch, like the archive
+               'names': NameIndex()}
+    try:
+        with Ledger(account.recordPath + LEDGER_FILENAME, account.recordPath + RECORD_FILENAME) as ledger, \
+                archive if archive else contextlib.nullcontext(), cache if cache else contextlib.nullcontext():
+            if envvar.plan:
+                plan = planBackup(auth, ledger, account.query, attachmentFilter, envvar.workers, envvar.batchSize,
+                                  envvar.pageSize, envvar.listShards, cache)
+                savePlan(account.recordPath + PLAN_FILENAME, plan)
+                logger.info("Plan of %s:\n%s", account.name, planSummary(plan))
+                return auth
+
+            postProcessor = PostProcessor(envvar.hooks, ledger, auth.metrics, envvar.hookWorkers,
+                                          processPool) if envvar.hooks else None
+            options['postProcessor'] = postProcessor
+            with postProcessor if postProcessor else contextlib.nullcontext():
+                if envvar.watch:
+                    watchMailbox(auth, account.downloadPath, ledger, syncFile, stop if stop else threading.Event(),
+                                 envvar.watchMinInterval, envvar.watchMaxInterval, onPass, **options)
+                else:
+                    downloadAttachmentsFromGmail(auth, account.downloadPath, ledger, syncFile=syncFile,
+                                                 stop=stop, **options)
+    finally:
+        # the access token is refreshed during long runs
+        saveCredentials(auth, account.token, savedToken)
+    return auth
+
+
+def runAccounts(accounts: list, accountWorkers: int = 1, maxRequests: int = 0, stop: threading.Event = None,
+                metrics: Metrics = None):
+    """
+    Backs up several accounts in one process, accountWorkers at a time, or with ATTACH_WATCH all of
+    them at once until stop is set. With ATTACH_WORKERS above one, a single pool of that many
+    threads retrieves emails for every account, and with ATTACH_HOOKS a single pool of processes
+    runs the hooks of every account. A failing account is logged and does not stop the others.
+
+    Parameters
+    ----------
+    accounts : list
+        Accounts to back up
+    accountWorkers : int
+        Number of accounts backed up at the same time
+    maxRequests : int
+        Most requests in flight across all accounts, 0 for no cap
+    stop : threading.Event
+        Set to end the run after the emails being saved
+    metrics : Metrics
+        Metrics to add those of every account to, None for new ones
+
+    Returns
+    -------
+    Tuple of the Metrics of all accounts combined and the list of names of the accounts that failed.
+    """
+
+    concurrency = threading.BoundedSemaphore(maxRequests) if maxRequests else None
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=envvar.workers, thread_name_prefix="fetch") if envvar.workers > 1 else None
+    processPool = newProcessPool(envvar.hookWorkers) if envvar.hooks else None
+    total = metrics if metrics else Metrics()
+    failed = []
+    writeLock = threading.Lock()
+
+    def writeMetrics():
+        if envvar.metricsFile:
+            with writeLock:
+                total.write(envvar.metricsFile)
+
+    def backup(account):
+        # watching accounts never finish, so they record straight into the total written after each poll
+        metrics = total if envvar.watch else Metrics()
+        try:
+            runAccount(account, metrics, executor,
+                       concurrency, stop, writeMetrics, processPool)
+            logger.info("Account %s done:\n%s", account.name, metrics.summary())
+        except Exception:
+            logger.exception("Account %s failed", account.name)
+            failed.append(account.name)
+        finally:
+            if metrics is not total:
+                total.merge(metrics)
+
+    if envvar.watch:
+        accountWorkers = len(accounts)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=accountWorkers, thread_name_prefix="account") as scheduler:
+            for _ in scheduler.map(backup, accounts):
+                pass
+    finally:
+        if executor:
+            executor.shutdown()
+        if processPool:
+            processPool.shutdown()
+    return total, failed
 
 
 def main():
@@ -190,19 +826,58 @@ def main():
     Sets the log level and reads input parameters.
     """
 
+    metrics = Metrics()
+    metrics.increment('startup_seconds_total', 'imports', startup.sinceStarted())
+    started = time.perf_counter()
+
     LOGFORMAT = "%(asctime)s %(levelname)s - %(name)s.%(funcName)s - %(message)s"
     logging.basicConfig(level=logging.INFO, format=LOGFORMAT)
     logging.getLogger('googleapiclient').setLevel(logging.WARNING)
 
     envvar.loadenv()
     logger.setLevel(envvar.logLevel)
+    metrics.increment('startup_seconds_total', 'configuration',
+                      time.perf_counter() - started)
+
+    stop = threading.Event()
+    if envvar.watch:
+        def requestStop(signum, frame):
+            logger.info(
+                "Received signal %d, stopping once the emails being saved are done.", signum)
+            stop.set()
+        signal.signal(signal.SIGTERM, requestStop)
+        signal.signal(signal.SIGINT, requestStop)
+
+    if envvar.accounts:
+        try:
+            accounts = loadManifest(envvar.accounts, envvar.query, envvar.contentType)
+        except (OSError, ValueError) as e:
+            logger.error("Invalid account manifest %s: %s", envvar.accounts, e)
+            exit("Invalid account manifest provided")
+        metrics, failed = runAccounts(
+            accounts, envvar.accountWorkers, envvar.maxRequests, stop, metrics)
+        logger.info("Run summary of %d accounts:\n%s",
+                    len(accounts), metrics.summary())
+        if envvar.metricsFile:
+            metrics.write(envvar.metricsFile)
+        if failed:
+            exit("%d of %d accounts failed: %s" %
+                 (len(failed), len(accounts), ", ".join(failed)))
+        return
+
+    account = Account(envvar.apiToken, envvar.apiToken, envvar.query, envvar.contentType,
+                      envvar.downloadPath, envvar.recordPath)
+
+    def writeMetrics():
+        if envvar.metricsFile:
+            metrics.write(envvar.metricsFile)
 
-    recordFile = envvar.recordPath + RECORD_FILENAME
-
-    auth = authenticate(envvar.apiToken, envvar.appCredentials)
-
-    downloadAttachmentsFromGmail(
-        auth, envvar.downloadPath, recordFile, envvar.query, envvar.contentType)
+    try:
+        runAccount(account, metrics, stop=stop, onPass=writeMetrics)
+    finally:
+        logger.info("Run summary:\n%s", metrics.summary())
+        if envvar.metricsFile:
+            metrics.write(envvar.metricsFile)
 
 
 if __name__ == '__main__':
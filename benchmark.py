@@ -0,0 +1,192 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from google.oauth2.credentials import Credentials
+
+import attachBack
+from emailMsg import GoogleAuth
+from fakeGmail import FakeGmailServer, Mailbox
+from hooks import PostProcessor
+from ledger import Ledger
+from metrics import Metrics
+from quota import QuotaLimiter
+from storage import LAYOUTS, ContentStore
+
+logger = logging.getLogger("benchmark")
+
+
+def serve(mailboxSettings: dict, serverSettings: dict, ready):
+    """
+    Runs a FakeGmailServer until the process is terminated, sending its discovery URL to ready once
+    it is listening. Runs in its own process so the server does not compete with the benchmark for
+    the interpreter lock.
+    """
+
+    server = FakeGmailServer(Mailbox(**mailboxSettings), **serverSettings)
+    ready.put(server.discoveryUrl)
+    server.serve_forever()
+
+
+def peakRss():
+    """
+    Returns the peak resident set size of this process in bytes.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def runBenchmark(mailboxSettings: dict, serverSettings: dict, workers: int = 1, batchSize: int = 0, pageSize: int = 500,
+                 quotaUnits: float = 1000000, maxRetries: int = 5, deduplicate: bool = False, listShards: int = 1,
+                 hooks: list = None, hookWorkers: int = 0, layout: str = 'flat'):
+    """
+    Downloads every attachment of a synthetic mailbox from a local fake Gmail API with
+    downloadAttachmentsFromGmail, into a temporary directory, and measures the run.
+
+    Parameters
+    ----------
+    mailboxSettings : dict
+        Keyword arguments of the Mailbox to serve
+    serverSettings : dict
+        Keyword arguments of the FakeGmailServer, such as latency and errorRate
+    workers : int
+        ATTACH_WORKERS of the run
+    batchSize : int
+        ATTACH_BATCH_SIZE of the run
+    pageSize : int
+        ATTACH_PAGE_SIZE of the run
+    quotaUnits : float
+        ATTACH_QUOTA_UNITS of the run, high by default so the quota does not limit the measurement
+    maxRetries : int
+        ATTACH_MAX_RETRIES of the run
+    deduplicate : bool
+        ATTACH_DEDUPLICATE of the run
+    listShards : int
+        ATTACH_LIST_SHARDS of the run
+    hooks : list
+        ATTACH_HOOKS of the run
+    hookWorkers : int
+        ATTACH_HOOK_WORKERS of the run
+    layout : str
+        ATTACH_LAYOUT of the run
+
+    Returns
+    -------
+    Dictionary of the settings, elapsed time, throughput, peak RSS and collected metrics.
+    """
+
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(
+        mailboxSettings, serverSettings, ready), daemon=True)
+    server.start()
+    try:
+        discoveryUrl = ready.get(timeout=30)
+        metrics = Metrics()
+        auth = GoogleAuth(attachBack.SCOPES, GoogleAuth.API_GMAIL, GoogleAuth.API_VER_1,
+                          {'installed': {}}, Credentials(token='fake'),
+                          limiter=QuotaLimiter(quotaUnits), maxRetries=maxRetries,
+                          metrics=metrics, discoveryUrl=discoveryUrl)
+
+        with tempfile.TemporaryDirectory() as workDir:
+            downloadPath = os.path.join(workDir, 'download') + os.sep
+            os.makedirs(downloadPath)
+            store = ContentStore(
+                downloadPath + attachBack.STORE_DIRNAME) if deduplicate else None
+            with Ledger(os.path.join(workDir, attachBack.LEDGER_FILENAME)) as ledger:
+                postProcessor = PostProcessor(hooks, ledger, metrics, hookWorkers) if hooks else None
+                start = time.monotonic()
+                attachBack.downloadAttachmentsFromGmail(auth, downloadPath, ledger, workers=workers,
+                                                        batchSize=batchSize, pageSize=pageSize, store=store,
+                                                        listShards=listShards, postProcessor=postProcessor,
+                                                        layout=layout)
+                elapsed = time.monotonic() - start
+                if postProcessor:
+                    postProcessor.close()
+    finally:
+        server.terminate()
+        server.join()
+
+    emails = metrics.get('emails_total')
+    saved = metrics.get('attachments_saved_total')
+    downloaded = metrics.get('bytes_downloaded_total')
+    return {'settings': {'mailbox': mailboxSettings, 'server': serverSettings, 'workers': workers,
+                         'batchSize': batchSize, 'pageSize': pageSize, 'quotaUnits': quotaUnits,
+                         'deduplicate': deduplicate, 'listShards': listShards,
+                         'hooks': hooks, 'hookWorkers': hookWorkers, 'layout': layout},
+            'elapsedSeconds': elapsed,
+            'emailsPerSecond': emails / elapsed if elapsed else 0,
+            'attachmentsPerSecond': saved / elapsed if elapsed else 0,
+            'megabytesPerSecond': downloaded / elapsed / 1024 / 1024 if elapsed else 0,
+            'peakRssBytes': peakRss(),
+            'metrics': metrics.toDict(),
+            'summary': metrics.summary()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark downloadAttachmentsFromGmail against a local fake Gmail API.")
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--attachments', type=int, default=1,
+                        help="attachments per email")
+    parser.add_argument('--min-size', type=int, default=10 * 1024)
+    parser.add_argument('--max-size', type=int, default=256 * 1024)
+    parser.add_argument('--nesting', type=int, default=1,
+                        help="depth of multipart parts holding the attachments")
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--inline-size', type=int, default=0,
+                        help="attachments up to this size are sent inline in the email")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to every HTTP request")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of requests answered with 429")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=0)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--quota-units', type=float, default=1000000)
+    parser.add_argument('--deduplicate', action='store_true')
+    parser.add_argument('--list-shards', type=int, default=1,
+                        help="threads listing windows of time of the mailbox at once")
+    parser.add_argument('--hooks', help="comma separated hooks to run over every attachment")
+    parser.add_argument('--hook-workers', type=int, default=0,
+                        help="processes running the hooks, 0 for one per CPU")
+    parser.add_argument('--layout', default='flat', choices=LAYOUTS,
+                        help="directories attachments are filed in")
+    parser.add_argument('--json', help="file to write the full results to")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s %(levelname)s - %(name)s.%(funcName)s - %(message)s")
+    logging.getLogger('googleapiclient').setLevel(logging.WARNING)
+
+    result = runBenchmark({'messageCount': args.messages, 'attachments': args.attachments, 'minSize': args.min_size,
+                           'maxSize': args.max_size, 'nesting': args.nesting,
+                           'duplicateRate': args.duplicate_rate, 'inlineSize': args.inline_size,
+                           'seed': args.seed},
+                          {'latency': args.latency, 'errorRate': args.error_rate,
+                              'seed': args.seed},
+                          workers=args.workers, batchSize=args.batch_size, pageSize=args.page_size,
+                          quotaUnits=args.quota_units, deduplicate=args.deduplicate, listShards=args.list_shards,
+                          hooks=args.hooks.split(',') if args.hooks else None, hookWorkers=args.hook_workers,
+                          layout=args.layout)
+
+    print(result['summary'])
+    print("Elapsed: %.2fs, %.1f emails/s, %.1f attachments/s, %.2f MB/s, peak RSS %.1f MB" %
+          (result['elapsedSeconds'], result['emailsPerSecond'], result['attachmentsPerSecond'],
+           result['megabytesPerSecond'], result['peakRssBytes'] / 1024 / 1024))
+    if args.json:
+        with open(args.json, 'w', encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# Entries added or used between writes of the cache to disk
+FLUSH_INTERVAL = 100
+
+# Eviction removes the least recently used entries until the cache is down to this share of its
+# maximum size, so it doesn't run again on the very next entry
+EVICTION_TARGET = 0.9
+
+
+class MetadataCache():
+    """
+    MetadataCache keeps the parsed metadata of emails, their date, sender, subject and attachment
+    descriptors, so that an email seen by an earlier run needs no messages.get. Gmail emails never
+    change once received, so an entry never goes stale, and the attachment IDs it holds remain
+    valid for downloading.
+
+    Entries are kept in an SQLite database keyed by email ID. Once their total size passes maxSize
+    bytes, the least recently used are evicted. Entries added and used are held in memory and
+    written every FLUSH_INTERVAL changes and on close, as losing some of them in a crash only costs
+    requests. A MetadataCache may be shared by several threads.
+
+    Attributes
+    ----------
+    path : str
+        Path and file name of the database.
+    maxSize : int
+        Size in bytes of the entries the cache is kept within.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS messages (
+            msgId TEXT PRIMARY KEY,
+            metadata TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            usedAt REAL NOT NULL) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS messagesByUse ON messages (usedAt)",
+    ]
+
+    def __init__(self, path: str, maxSize: int):
+        self.logger = logging.getLogger(
+            "cache." + self.__class__.__name__)
+
+        if not path:
+            raise ValueError("Valid path required for cache.")
+        if maxSize < 1:
+            raise ValueError("maxSize must be at least 1.")
+
+        self.path = path
+        self.maxSize = maxSize
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        # a cache survives losing its last writes, no need to wait for the disk
+        self.__db.execute("PRAGMA synchronous=OFF")
+        with self.__db:
+            for statement in self.SCHEMA:
+                self.__db.execute(statement)
+        self.__size = self.__db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM messages").fetchone()[0]
+        # entries added and times entries were used, not yet written
+        self.__added = {}
+        self.__used = {}
+        self.logger.info("Metadata cache opened at %s holding %d bytes", path, self.__size)
+
+    def get(self, msgId: str):
+        """
+        Returns the cached metadata of an email as a dictionary, None if it is not cached.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the email
+        """
+
+        with self.__lock:
+            if msgId in self.__added:
+                metadata = self.__added[msgId][0]
+            else:
+                row = self.__db.execute(
+                    "SELECT metadata FROM messages WHERE msgId = ?", (msgId,)).fetchone()
+                if not row:
+                    return None
+                metadata = row[0]
+                self.__used[msgId] = time.time()
+                self.__flushIfDue()
+        return json.loads(metadata)
+
+    def contains(self, msgId: str):
+        """
+        Returns True if the metadata of the email is cached.
+        """
+
+        with self.__lock:
+            return msgId in self.__added or self.__db.execute(
+                "SELECT 1 FROM messages WHERE msgId = ?", (msgId,)).fetchone() is not None
+
+    def put(self, msgId: str, metadata: dict):
+        """
+        Caches the metadata of an email.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the email
+        metadata : dict
+            Metadata to cache, must be serializable as JSON
+        """
+
+        text = json.dumps(metadata, separators=(',', ':'))
+        with self.__lock:
+            self.__added[msgId] = (text, time.time())
+            self.__flushIfDue()
+
+    def __flushIfDue(self):
+        if len(self.__added) + len(self.__used) >= FLUSH_INTERVAL:
+            self.__flush()
+
+    def __flush(self):
+        if not self.__added and not self.__used:
+            return
+        with self.__db:
+            for msgId, (text, usedAt) in self.__added.items():
+                previous = self.__db.execute(
+                    "SELECT size FROM messages WHERE msgId = ?", (msgId,)).fetchone()
+                if previous:
+                    self.__size -= previous[0]
+                size = len(text.encode('utf-8'))
+                self.__db.execute("INSERT OR REPLACE INTO messages (msgId, metadata, size, usedAt) VALUES (?, ?, ?, ?)",
+                                  (msgId, text, size, usedAt))
+                self.__size += size
+            self.__db.executemany("UPDATE messages SET usedAt = ? WHERE msgId = ?",
+                                  [(usedAt, msgId) for msgId, usedAt in self.__used.items()])
+            self.__added.clear()
+            self.__used.clear()
+            if self.__size > self.maxSize:
+                self.__evict()
+
+    def __evict(self):
+        excess = self.__size - int(self.maxSize * EVICTION_TARGET)
+        evicted = []
+        for msgId, size in self.__db.execute("SELECT msgId, size FROM messages ORDER BY usedAt"):
+            if excess <= 0:
+                break
+            evicted.append((msgId,))
+            excess -= size
+            self.__size -= size
+        self.__db.executemany("DELETE FROM messages WHERE msgId = ?", evicted)
+        self.logger.debug("Evicted %d emails from the metadata cache", len(evicted))
+
+    def close(self):
+        """
+        Writes the entries held in memory and closes the database.
+        """
+
+        with self.__lock:
+            self.__flush()
+            self.__db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
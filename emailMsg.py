@@ -1,18 +1,130 @@
 import base64
+import collections
+import concurrent.futures
+import hashlib
+import itertools
 import json
 import logging
+import math
 import os
 import pickle
 import pprint
+import queue
+import re
+import secrets
+import threading
+import time
 
-import requests
+import google_auth_httplib2
+import httplib2
 from google.auth import exceptions
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from oauthlib.oauth2.rfc6749.errors import OAuth2Error
+
+import quota
+from cache import MetadataCache
+from metrics import Metrics
+from quota import QuotaLimiter
+from startup import lazyImport
+
+# Only needed for errors, loaded on first use. The OAuth flow, token refresh over requests and
+# the discovery client are imported where they are used, as most runs need only some of them.
+requests = lazyImport('requests')
+
+
+def _toHTTPError(e: HttpError):
+    """
+    Converts an HttpError from the Google API client into the requests.HTTPError raised by this module.
+    """
+
+    try:
+        errorMessage = json.loads(e.content)
+        return requests.HTTPError(errorMessage["error"]["code"], errorMessage["error"]["message"])
+    except (ValueError, KeyError, TypeError):
+        return requests.HTTPError(e.resp.status, str(e))
+
+
+# Attachment data is decoded and written this many bytes at a time
+CHUNK_SIZE = 1024 * 1024
+
+# Fields of a raw attachments.get response, base64url data never contains quotes or escapes
+_DATA_PATTERN = re.compile(rb'"data"\s*:\s*"([^"]*)"')
+_SIZE_PATTERN = re.compile(rb'"size"\s*:\s*(\d+)')
+
+
+def _createTemp(directory: str):
+    # A new hidden temporary file, opened for writing. Unlike those of tempfile, which are private,
+    # it gets the permissions of any file created under the umask, and keeps them once renamed.
+    while True:
+        path = os.path.join(directory, '.attachBack-%s.part' % secrets.token_hex(8))
+        try:
+            return path, os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0), 0o666)
+        except FileExistsError:
+            continue
+
+# A file written from an attachment
+SavedFile = collections.namedtuple('SavedFile', ['path', 'size', 'sha256'])
+
+# Times a rate limited or failed request is retried by default
+DEFAULT_MAX_RETRIES = 5
+
+# Gmail returns at most 500 emails per page of messages.list
+MAX_PAGE_SIZE = 500
+
+# Emails processed between saves of an Email checkpoint
+CHECKPOINT_INTERVAL = 100
+
+# Gmail accepts at most 100 sub-requests in a single batch request
+MAX_BATCH_SIZE = 100
+
+# Gmail's launch. A sharded listing splits the time since into windows, older emails, such as
+# imported ones, are listed by a last window without a lower bound.
+GMAIL_EPOCH = 1080777600
+
+# Span in seconds of the first window of a sharded listing
+INITIAL_WINDOW = 30 * 24 * 60 * 60
+
+# Windows are never split below this span, but paged through instead
+MIN_WINDOW = 60 * 60
+
+# Windows never grow beyond this span, however few emails they hold
+MAX_WINDOW = 2 * 365 * 24 * 60 * 60
+
+# Windows sharing a boundary overlap by this many seconds, so that no email falls between them
+WINDOW_OVERLAP = 1
+
+# Emails listed by the threads of a sharded listing waiting to be handed out
+SHARD_QUEUE_SIZE = 1000
+
+# Marks the end of the emails listed by one thread of a sharded listing
+_LISTED = object()
+
+
+def _partFields(depth: int, fields: str):
+    # partial response mask for the given fields of a MIME part and its nested parts, down to the
+    # given depth
+    if depth > 1:
+        fields += ',parts(' + _partFields(depth - 1, fields) + ')'
+    return fields
+
+
+# Deepest nesting of MIME parts requested when retrieving an email
+MAX_PART_DEPTH = 6
+
+# Fields requested when retrieving an email, its headers and the metadata of its parts. The data
+# of parts is left out: Gmail returns it for every part without an attachmentId, which includes
+# the text and HTML bodies of the email.
+MESSAGE_FIELDS = 'id,payload(' + _partFields(
+    MAX_PART_DEPTH, 'partId,mimeType,filename,headers(name,value),body(attachmentId,size)') + ')'
+
+# Fields requested to read attachments inline in an email. Parts can't be requested alone, so
+# this also returns the bodies of the email, and is only requested once an inline attachment is
+# wanted.
+PART_DATA_FIELDS = 'id,payload(' + _partFields(MAX_PART_DEPTH, 'partId,filename,body/data') + ')'
+
+# Discovery documents by URL, fetched once per process and shared by every GoogleAuth
+_discoveryDocs = {}
+_discoveryLock = threading.Lock()
 
 
 class GoogleAuth():
@@ -24,6 +136,18 @@ class GoogleAuth():
     ----------
     creds : Credentials
         OAuth2 access and refresh tokens.
+    limiter : QuotaLimiter
+        Quota shared by every request made with this object.
+    maxRetries : int
+        Number of times a rate limited or failed request is retried before giving up.
+    metrics : Metrics
+        Metrics of every request made with this object, and of the attachments downloaded.
+    concurrency : threading.Semaphore
+        Semaphore held while a request is in flight, shared by several objects to cap the number
+        of concurrent requests across accounts. None for no cap.
+
+    The discoveryUrl argument points the object at another server implementing the API, such as
+    the one in fakeGmail. It may contain {api} and {apiVersion} placeholders.
 
     Raises
     -----------
@@ -34,8 +158,11 @@ class GoogleAuth():
 
     API_GMAIL = 'gmail'
     API_VER_1 = 'v1'
+    DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest'
 
-    def __init__(self, scopes: list, apiName: str, apiVer: str, secrets: json, creds: Credentials = None):
+    def __init__(self, scopes: list, apiName: str, apiVer: str, secrets: json, creds: Credentials = None,
+                 limiter: QuotaLimiter = None, maxRetries: int = DEFAULT_MAX_RETRIES, metrics: Metrics = None,
+                 discoveryUrl: str = None, concurrency: threading.Semaphore = None):
         self.logger = logging.getLogger(
             "emailMsg." + self.__class__.__name__)
 
@@ -50,11 +177,18 @@ class GoogleAuth():
 
         self.__apiVer = apiVer
         self.__apiName = apiName
+        self.limiter = limiter if limiter else QuotaLimiter()
+        self.maxRetries = maxRetries
+        self.metrics = metrics if metrics else Metrics()
+        self.concurrency = concurrency
+        self.__discoveryUrl = discoveryUrl if discoveryUrl else self.DISCOVERY_URL
+        self.__local = threading.local()
 
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
                 self.logger.debug(
                     "Credentials were expired, attempting to refresh.")
+                from google.auth.transport.requests import Request
                 try:
                     creds.refresh(Request())
                 except exceptions.RefreshError as e:
@@ -65,6 +199,8 @@ class GoogleAuth():
             else:
                 self.logger.info(
                     "Credentials could not be found, asking for authorization from the user.")
+                from google_auth_oauthlib.flow import InstalledAppFlow
+                from oauthlib.oauth2.rfc6749.errors import OAuth2Error
                 flow = InstalledAppFlow.from_client_config(
                     secrets, scopes)
                 try:
@@ -77,48 +213,154 @@ class GoogleAuth():
 
         self.creds = creds
 
+    def __getDiscoveryDoc(self):
+        # The discovery document is fetched once and shared by every service built afterwards,
+        # for every account.
+        url = self.__discoveryUrl.format(
+            api=self.__apiName, apiVersion=self.__apiVer)
+        with _discoveryLock:
+            if url not in _discoveryDocs:
+                self.logger.debug("Fetching discovery document from %s", url)
+                started = time.perf_counter()
+                response, content = httplib2.Http().request(url)
+                if response.status >= 400:
+                    raise requests.HTTPError(
+                        response.status, "Unable to retrieve discovery document.")
+                _discoveryDocs[url] = content.decode('UTF-8')
+                self.metrics.increment('startup_seconds_total', 'discovery',
+                                       time.perf_counter() - started)
+            return _discoveryDocs[url]
+
     def buildService(self):
         """
-        Returns a resource object for interacting with the Google API that the GoogleAuth object
-        represents.
+        Builds a new resource object for interacting with the Google API that the GoogleAuth object
+        represents. The resource owns its own HTTP transport, which keeps its connections alive
+        between requests.
 
         Returns
         -------
         Resource object for interacting with the Google API.
         """
 
-        service = build(self.__apiName, self.__apiVer, credentials=self.creds,
-                        cache_discovery=False)
+        http = google_auth_httplib2.AuthorizedHttp(
+            self.creds, http=httplib2.Http())
+        document = self.__getDiscoveryDoc()
+        started = time.perf_counter()
+        from googleapiclient.discovery import build_from_document
+        service = build_from_document(document, http=http)
+        self.metrics.increment('startup_seconds_total', 'service',
+                               time.perf_counter() - started)
+        return service
+
+    def execute(self, request):
+        """
+        Executes a request once its quota units are available. Requests that are rate limited or
+        fail with a server or network error are retried with jittered exponential backoff, honouring
+        any Retry-After the server sends.
+
+        Parameters
+        ----------
+        request : HttpRequest
+            Request to execute.
+
+        Returns
+        -------
+        The response of the request.
+
+        Raises
+        ------
+        HttpError
+            If the request failed and can't be retried, or was retried maxRetries times.
+        """
+
+        method = getattr(request, 'methodId', None) or 'batch'
+        units = self.limiter.cost(getattr(request, 'methodId', None))
+        attempt = 0
+        while True:
+            with self.metrics.phase('quota'):
+                self.limiter.acquire(units)
+            self.metrics.increment('api_calls_total', method)
+            self.metrics.increment('quota_units_total', amount=units)
+            try:
+                if self.concurrency:
+                    with self.metrics.phase('concurrency'):
+                        self.concurrency.acquire()
+                try:
+                    with self.metrics.phase('network'), self.metrics.timer('api_latency_seconds', method):
+                        return request.execute()
+                finally:
+                    if self.concurrency:
+                        self.concurrency.release()
+            except Exception as e:
+                if attempt >= self.maxRetries or not quota.isRetryable(e):
+                    raise
+                delay = quota.retryDelay(e, attempt)
+                attempt += 1
+                self.metrics.increment('api_retries_total', method)
+                self.logger.warning("Retry %d of %s in %.1fs after: %s", attempt,
+                                    method, delay, e)
+                if quota.isRateLimited(e):
+                    # hold back every thread, not only this one
+                    self.limiter.pause(delay)
+                time.sleep(delay)
+
+    def getService(self):
+        """
+        Returns the resource object for the calling thread, building it on first use. httplib2
+        transports are not thread safe, so each thread gets its own long-lived resource.
+
+        Returns
+        -------
+        Resource object for interacting with the Google API.
+        """
+
+        service = getattr(self.__local, 'service', None)
+        if service is None:
+            self.logger.debug(
+                "Building service for thread %s", threading.current_thread().name)
+            service = self.buildService()
+            self.__local.service = service
         return service
 
 
 class Attachment():
     """
-    Attachment represents a Gmail attachment.
+    Attachment represents a Gmail attachment. The attachment data is not downloaded until it is
+    needed, so attachments can be inspected and skipped without any API calls.
 
     Attributes
     ----------
     id : str
-        ID of the attachment
+        ID of the attachment, None if the attachment is inline in the email
     msgId : str
         ID of the email that contains the attachment
     filename : str
         Filename of the attachment.
     contentType : str
         Content Type of the attachment.
+    size : int
+        Size of the attachment data in bytes as reported by the email, None if unknown.
+    partId : str
+        ID of the MIME part of the email holding the attachment. Unlike the attachment ID it does
+        not change between requests.
+    isInline : bool
+        True if the attachment data is inline in the email rather than behind an attachment ID. It
+        is read with loadData, a function given the partId.
     bytes : bytes
-        Attachment data as bytes.
+        Attachment data as bytes, downloaded on first access. Use saveTo or iterChunks to avoid
+        holding large attachments in memory.
     """
 
-    def __init__(self, auth, msgId: str, attachmentId: str, fileName: str, userId: str = 'me', contentType: str = None):
+    def __init__(self, auth, msgId: str, attachmentId: str, fileName: str, userId: str = 'me', contentType: str = None, size: int = None, partId: str = None,
+                 loadData=None):
         self.logger = logging.getLogger(
             "emailMsg." + self.__class__.__name__)
         if not auth:
             raise ValueError("Valid GoogleAuth required for attachment.")
         if not msgId:
             raise ValueError("Valid msgId required for attachment.")
-        if not attachmentId:
-            raise ValueError("Valid attachmentId required for attachment.")
+        if not attachmentId and not loadData:
+            raise ValueError("Valid attachmentId or loadData required for attachment.")
 
         self.id = attachmentId
         self.msgId = msgId
@@ -126,20 +368,228 @@ class Attachment():
         self.filename = fileName
         self.__userId = userId
         self.contentType = contentType
+        self.size = size
+        self.partId = partId
+        self.__bytes = None
+        # base64url data embedded in the email, read with loadData when first needed and decoded as
+        # it is read like downloaded data
+        self.__inline = None
+        self.__loadData = loadData
 
-        request = self.__auth.buildService().users().messages().attachments().get(
-            userId=userId, messageId=msgId, id=attachmentId)
-        try:
-            attachment = request.execute()
-            self.bytes = base64.urlsafe_b64decode(
+    @property
+    def bytes(self):
+        if self.__bytes is None:
+            self.__bytes = b''.join(self.iterChunks())
+        return self.__bytes
+
+    @property
+    def isInline(self):
+        return not self.id
+
+    @property
+    def isLoaded(self):
+        """
+        True if the attachment data is held in memory, downloaded or read from the email.
+        """
+
+        return self.__bytes is not None or self.__inline is not None
+
+    def request(self):
+        """
+        Returns the unexecuted request for the attachment data, so it can be added to a batch.
+        """
+
+        return self.__auth.getService().users().messages().attachments().get(
+            userId=self.__userId, messageId=self.msgId, id=self.id)
+
+    def load(self, attachment: dict):
+        """
+        Sets the attachment data from an executed attachments.get response.
+
+        Parameters
+        ----------
+        attachment : dict
+            Response of the attachment request.
+        """
+
+        with self.__auth.metrics.phase('decode'):
+            self.__bytes = base64.urlsafe_b64decode(
                 attachment['data'].encode('UTF-8'))
-            self.__size = attachment['size']
+        self.size = attachment['size']
+        self.__auth.metrics.increment(
+            'bytes_downloaded_total', amount=len(self.__bytes))
+
+    def __downloadEncoded(self):
+        if self.__inline is None and not self.id:
+            self.__inline = self.__loadData(self.partId).encode('ascii')
+        if self.__inline is not None:
+            return memoryview(self.__inline)
+
+        self.logger.debug("Downloading attachment %s of email %s",
+                          self.filename, self.msgId)
+        # keep the response as raw bytes instead of parsing it, so the base64 data is not copied
+        # into a str and can be decoded a piece at a time
+        request = self.request()
+        request.postproc = lambda response, content: content
+        try:
+            content = self.__auth.execute(request)
         except HttpError as e:
-            errorMessage = json.loads(e.content)
+            error = _toHTTPError(e)
+            self.logger.error("Error getting attachment: %s %s", *error.args)
+            raise error
+
+        data = _DATA_PATTERN.search(content)
+        if not data:
             self.logger.error(
-                "Error getting attachment: %s %s", errorMessage["error"]["code"], errorMessage["error"]["message"])
-            raise requests.HTTPError(
-                errorMessage["error"]["code"], errorMessage["error"]["message"])
+                "Attachment response for %s contained no data", self.filename)
+            raise requests.HTTPError(500, "Attachment response contained no data.")
+        size = _SIZE_PATTERN.search(content)
+        if size:
+            self.size = int(size.group(1))
+        return memoryview(content)[data.start(1):data.end(1)]
+
+    def iterChunks(self, chunkSize: int = CHUNK_SIZE):
+        """
+        Generator over the attachment data, downloading it if it isn't in memory and decoding it
+        chunkSize bytes at a time.
+
+        Parameters
+        ----------
+        chunkSize : int
+            Approximate number of bytes per chunk.
+
+        Yields
+        ------
+        bytes
+            The next chunk of attachment data.
+        """
+
+        if self.__bytes is not None:
+            for start in range(0, len(self.__bytes), chunkSize):
+                yield self.__bytes[start:start + chunkSize]
+            return
+
+        encoded = self.__downloadEncoded()
+        # every 4 base64 characters decode to 3 bytes, so steps of a multiple of 4 decode alone
+        step = max(4, chunkSize // 3 * 4)
+        metrics = self.__auth.metrics
+        for start in range(0, len(encoded), step):
+            with metrics.phase('decode'):
+                piece = bytes(encoded[start:start + step])
+                chunk = base64.urlsafe_b64decode(
+                    piece + b'=' * (-len(piece) % 4))
+            metrics.increment('bytes_downloaded_total', amount=len(chunk))
+            yield chunk
+
+    def saveToTemp(self, directory: str, sync: bool = True):
+        """
+        Streams the attachment data into a new hidden temporary file in the directory, so that only
+        one chunk of decoded data is held in memory at a time.
+
+        Parameters
+        ----------
+        directory : str
+            Directory to create the temporary file in.
+        sync : bool
+            Whether to flush the file to disk before returning. Callers that may discard the file
+            can leave this to whoever keeps it.
+
+        Returns
+        -------
+        SavedFile with the path of the temporary file, the size and the hex SHA-256 of the data.
+        """
+
+        path, fd = _createTemp(directory or '.')
+        try:
+            with open(fd, 'wb') as f:
+                size = 0
+                sha256 = hashlib.sha256()
+                for chunk in self.iterChunks():
+                    with self.__auth.metrics.phase('disk'):
+                        f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                with self.__auth.metrics.phase('disk'):
+                    f.flush()
+                    if sync:
+                        os.fsync(f.fileno())
+                self.__auth.metrics.increment('bytes_written_total', amount=size)
+        except BaseException:
+            os.remove(path)
+            raise
+        return SavedFile(path, size, sha256.hexdigest())
+
+    def saveTo(self, path: str):
+        """
+        Streams the attachment data to a file. The data is written to a temporary file that is
+        renamed to path once complete, so path never holds a partial attachment.
+
+        Parameters
+        ----------
+        path : str
+            Path and file name to save the attachment to, replaced if it exists.
+
+        Returns
+        -------
+        SavedFile with the path, the size and the hex SHA-256 of the data.
+        """
+
+        saved = self.saveToTemp(os.path.dirname(path))
+        os.replace(saved.path, path)
+        return saved._replace(path=path)
+
+
+class AttachmentFilter():
+    """
+    AttachmentFilter decides from an attachment's metadata alone whether it is wanted, so unwanted
+    attachments are never downloaded. Calling the filter with an Attachment returns True if the
+    attachment passes every criterion that was set.
+
+    Attributes
+    ----------
+    contentType : str
+        String or substring that must appear in the attachment's content type.
+    minSize : int
+        Smallest attachment size in bytes to accept. Attachments of unknown size are accepted.
+    maxSize : int
+        Largest attachment size in bytes to accept. Attachments of unknown size are accepted.
+    filenamePattern : str
+        Regular expression that must match somewhere in the attachment's filename.
+    """
+
+    def __init__(self, contentType: str = '', minSize: int = None, maxSize: int = None, filenamePattern: str = None):
+        self.logger = logging.getLogger(
+            "emailMsg." + self.__class__.__name__)
+
+        if minSize is not None and maxSize is not None and minSize > maxSize:
+            raise ValueError("minSize must not be larger than maxSize.")
+
+        self.contentType = contentType or ''
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.filenamePattern = filenamePattern
+        self.__filenameRegex = re.compile(
+            filenamePattern) if filenamePattern else None
+
+    def __call__(self, attachment: Attachment):
+        if self.contentType not in (attachment.contentType or ''):
+            self.logger.debug("Content-type %s does not match %s",
+                              attachment.contentType, self.contentType)
+            return False
+        if attachment.size is not None:
+            if self.minSize is not None and attachment.size < self.minSize:
+                self.logger.debug(
+                    "Attachment %s smaller than %s bytes", attachment.filename, self.minSize)
+                return False
+            if self.maxSize is not None and attachment.size > self.maxSize:
+                self.logger.debug(
+                    "Attachment %s larger than %s bytes", attachment.filename, self.maxSize)
+                return False
+        if self.__filenameRegex and not self.__filenameRegex.search(attachment.filename or ''):
+            self.logger.debug(
+                "Filename %s does not match %s", attachment.filename, self.filenamePattern)
+            return False
+        return True
 
 
 class EmailMsg():
@@ -153,9 +603,18 @@ class EmailMsg():
         ID of the email.
     date : str
         Date of receipt of the email.
+    sender : str
+        From header of the email.
+    subject : str
+        Subject of the email.
+    body : str
+        Body of the email, retrieved on first access.
+    isCached : bool
+        True if the email was read from the metadata cache rather than retrieved.
     """
 
-    def __init__(self, auth: GoogleAuth, msgId: str, userId: str = 'me'):
+    def __init__(self, auth: GoogleAuth, msgId: str, userId: str = 'me', message: dict = None,
+                 cache: MetadataCache = None):
         self.logger = logging.getLogger(
             "emailMsg." + self.__class__.__name__)
 
@@ -167,22 +626,97 @@ class EmailMsg():
         self.__auth = auth
         self.__userId = userId
         self.msgId = msgId
+        self.__body = None
+        self.__partData = None
+        self.__attachmentIndex = 0
+
+        cached = cache.get(msgId) if cache and not message else None
+        self.isCached = cached is not None
+        if cache and not message:
+            auth.metrics.increment('metadata_cache_total', 'hit' if cached else 'miss')
+        if cached:
+            self.date, self.sender, self.subject = cached['date'], cached['sender'], cached['subject']
+            self.__attachments = cached['attachments']
+            return
+
+        # the message may already have been retrieved, for example as part of a batch
+        if not message:
+            message = self.__retrieve(MESSAGE_FIELDS)
 
-        request = self.__auth.buildService().users().messages().get(
-            userId=userId, id=msgId)
+        self.date, self.sender, self.subject = self.__getHeaderInfo(
+            message)
+        self.__attachments, truncated = self.__getAttachments(message)
+        if truncated:
+            # rare, such as forwards of forwards, so the whole email is retrieved rather than
+            # every email with a deeper mask
+            self.logger.warning("Parts of email %s are nested deeper than %d levels, retrieving the whole email",
+                                msgId, MAX_PART_DEPTH)
+            self.__attachments, _ = self.__getAttachments(self.__retrieve(None))
+        if cache:
+            cache.put(msgId, {'date': self.date, 'sender': self.sender, 'subject': self.subject,
+                              'attachments': self.__attachments})
+
+    def __retrieve(self, fields: str):
         try:
-            message = request.execute()
-            self.date, self.sender, self.subject = self.__getHeaderInfo(
-                message)
-            self.__body = self.__getBody(message)
-            self.__attachments = self.__getAttachments(message)
-            self.__attachmentIndex = 0
+            return self.__auth.execute(EmailMsg.request(self.__auth, self.msgId, self.__userId, fields))
         except HttpError as e:
-            errorMessage = json.loads(e.content)
-            self.logger.error(
-                "Error getting email: %s %s", errorMessage["error"]["code"], errorMessage["error"]["message"])
-            raise requests.HTTPError(
-                errorMessage["error"]["code"], errorMessage["error"]["message"])
+            error = _toHTTPError(e)
+            self.logger.error("Error getting email: %s %s", *error.args)
+            raise error
+
+    @staticmethod
+    def request(auth: GoogleAuth, msgId: str, userId: str = 'me', fields: str = MESSAGE_FIELDS):
+        """
+        Returns the unexecuted request for an email, so it can be added to a batch. By default only
+        the headers and the attachment metadata of the email are requested, None requests all of it.
+        """
+
+        return auth.getService().users().messages().get(userId=userId, id=msgId, format='full',
+                                                        fields=fields)
+
+    @property
+    def body(self):
+        """
+        Body of the email. The whole email is retrieved the first time the body is read.
+        """
+
+        if self.__body is None:
+            request = self.__auth.getService().users().messages().get(
+                userId=self.__userId, id=self.msgId, format='full')
+            try:
+                self.__body = self.__getBody(self.__auth.execute(request))
+            except HttpError as e:
+                error = _toHTTPError(e)
+                self.logger.error("Error getting email body: %s %s", *error.args)
+                raise error
+        return self.__body
+
+    def partData(self, partId: str):
+        """
+        Returns the base64url data of an attachment inline in the email. The data of every inline
+        attachment is retrieved together the first time one is read.
+
+        Parameters
+        ----------
+        partId : str
+            ID of the MIME part holding the attachment.
+        """
+
+        # partIds have a number per level below the payload, such as 1.0.2
+        deep = (partId or '').count('.') + 2 > MAX_PART_DEPTH
+        if self.__partData is None or (deep and partId not in self.__partData):
+            message = self.__retrieve(None if deep else PART_DATA_FIELDS)
+            partData = {}
+            stack = [message['payload']]
+            while stack:
+                part = stack.pop()
+                stack.extend(part.get('parts', []))
+                # keep only attachments, not the bodies of the email
+                if part.get('filename'):
+                    partData[part.get('partId')] = part.get('body', {}).get('data', '')
+            self.__partData = partData
+        # Gmail leaves out the data of empty parts
+        return self.__partData.get(partId, '')
 
     def __getHeaderInfo(self, message):
         subject = None
@@ -224,27 +758,40 @@ class EmailMsg():
         return ''
 
     def __getAttachments(self, message):
+        # Walks the whole tree of parts in a single pass, in the order they appear in the email.
+        # Attachments may be nested in multipart/mixed or multipart/related parts, or be the payload
+        # itself. Their data is either behind an attachmentId or, when small, inline in the email,
+        # which is only retrieved by partData if the attachment is wanted.
+        # Parts below MAX_PART_DEPTH are not returned, which shows as a multipart part without
+        # parts at that depth. Returns the attachments and whether any were cut off.
         attachmentList = []
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                filename = ''
-                contentType = ''
-                size = None
-                for attachHeader in part['headers']:
-                    if attachHeader['name'] == 'Content-Type':
-                        contentType = attachHeader['value']
-                if 'filename' in part and part['filename']:
-                    filename = part['filename']
-                if 'attachmentId' in part['body']:
-                    attachmentId = part['body']['attachmentId']
-                    if 'size' in part['body'] and part['body']['size']:
-                        size = int(part['body']['size'])
-                    attachment = {'id': attachmentId, 'filename': filename,
-                                  'content-type': contentType, 'size': size}
-                    self.logger.debug(
-                        "Attachment found for message: %s", attachment)
-                    attachmentList.append(attachment)
-        return attachmentList
+        truncated = False
+        stack = [(message['payload'], 1)]
+        while stack:
+            part, depth = stack.pop()
+            stack.extend((child, depth + 1) for child in reversed(part.get('parts', [])))
+            if depth >= MAX_PART_DEPTH and 'parts' not in part and \
+                    part.get('mimeType', '').startswith('multipart/'):
+                truncated = True
+            # fields left empty are not returned at all in a partial response
+            body = part.get('body', {})
+            filename = part.get('filename') or ''
+            attachmentId = body.get('attachmentId')
+            # inline data without a filename is the text of the email
+            if not attachmentId and (not filename or part.get('mimeType', '').startswith('multipart/')):
+                continue
+
+            contentType = ''
+            for attachHeader in part.get('headers', []):
+                if attachHeader['name'].lower() == 'content-type':
+                    contentType = attachHeader['value']
+            size = int(body['size']) if body.get('size') else None
+            attachment = {'id': attachmentId, 'partId': part.get('partId'), 'filename': filename,
+                          'content-type': contentType, 'size': size}
+            self.logger.debug("Attachment found for message: %s in part %s%s", filename,
+                              attachment['partId'], '' if attachmentId else ', inline')
+            attachmentList.append(attachment)
+        return attachmentList, truncated
 
     def __iter__(self):
         return self
@@ -256,66 +803,895 @@ class EmailMsg():
         attachment = Attachment(self.__auth, self.msgId,
                                 self.__attachments[self.__attachmentIndex]['id'],
                                 self.__attachments[self.__attachmentIndex]['filename'],
-                                self.__userId, self.__attachments[self.__attachmentIndex]['content-type'])
+                                self.__userId, self.__attachments[self.__attachmentIndex]['content-type'],
+                                self.__attachments[self.__attachmentIndex]['size'],
+                                self.__attachments[self.__attachmentIndex]['partId'],
+                                self.partData)
         self.__attachmentIndex += 1
         return attachment
 
 
+class CheckpointFile():
+    """
+    CheckpointFile is the JSON file the position of an interrupted listing is saved in, so that a
+    new listing can continue from it. It is replaced atomically, a crash while saving leaves the
+    previous checkpoint.
+
+    Attributes
+    ----------
+    path : str
+        Path of the file.
+    """
+
+    def __init__(self, path: str):
+        self.logger = logging.getLogger(
+            "emailMsg." + self.__class__.__name__)
+
+        if not path:
+            raise ValueError("Valid path required for checkpoint file.")
+
+        self.path = path
+
+    def load(self):
+        """
+        Returns the checkpoint saved, or None if there is none or it can't be read.
+        """
+
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r', encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError as e:
+            self.logger.warning("Ignoring unreadable checkpoint %s: %s", self.path, e)
+            return None
+
+    def save(self, checkpoint: dict):
+        """
+        Saves the checkpoint in place of the previous one.
+        """
+
+        tempFile = self.path + '.tmp'
+        with open(tempFile, 'w', encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(tempFile, self.path)
+
+    def clear(self):
+        """
+        Removes the checkpoint file, for once every email has been processed.
+        """
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            self.logger.debug("Checkpoint %s removed", self.path)
+
+
 class Email():
     """
     Email represents the user's Gmail contents. The emails can be iterated and the object will handle
     all necessary calls to the Gmail APIs to get them.
+
+    While the emails of one page are being handed out, the next page is already retrieved in the
+    background, so iteration does not stall at page boundaries.
+
+    With a checkpointFile, the position of the last email reported processed through checkpoint() is
+    saved periodically, and a new Email for the same query continues from that position.
+
+    With a cache, emails found in it are not retrieved again, neither one by one nor in batches.
+
+    Attributes
+    ----------
+    syncState : dict
+        Sync state taken when the listing started, saved with the checkpoint. When resuming, that of
+        the interrupted run, as emails that arrived since it started are not listed.
     """
 
-    def __init__(self, auth: GoogleAuth, userId: str = 'me', query: str = None):
+    def __init__(self, auth: GoogleAuth, userId: str = 'me', query: str = None, batchSize: int = 0, checkpointFile: str = None,
+                 pageSize: int = MAX_PAGE_SIZE, cache: MetadataCache = None, syncState: dict = None):
         self.logger = logging.getLogger(
             "emailMsg." + self.__class__.__name__)
 
         if not auth:
             raise ValueError("Valid GoogleAuth required for email.")
+        if batchSize < 0 or batchSize > MAX_BATCH_SIZE:
+            raise ValueError(
+                "batchSize must be between 0 and %d." % MAX_BATCH_SIZE)
+        if pageSize < 1 or pageSize > MAX_PAGE_SIZE:
+            raise ValueError(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
 
         self.__auth = auth
         self.__userId = userId
         self.__query = query
+        self.__batchSize = batchSize
+        self.__pageSize = pageSize
+        self.__cache = cache
         self.__nextPageToken = None
+        self.__messages = collections.deque()
+        self.__prefetcher = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prefetch")
+        self.__prefetched = None
+        self.__batched = {}
+        self.__checkpointFile = CheckpointFile(checkpointFile) if checkpointFile else None
+        # page token the current page was loaded with, and how many of its emails were taken
+        self.__pageToken = None
+        self.__pageIndex = 0
+        # position after each email handed out but not yet reported processed
+        self.__issued = collections.OrderedDict()
+        self.__sinceCheckpoint = 0
+        self.__savedPageToken = None
+        self.syncState = syncState
+
+        checkpoint = self.__loadCheckpoint()
+        if checkpoint:
+            self.syncState = checkpoint.get('syncState') or syncState
+            self.__nextPageToken = checkpoint['pageToken']
+            try:
+                self.__loadPageOfMessages(checkpoint['position'])
+                return
+            except requests.HTTPError as e:
+                if e.args[0] != 400:
+                    raise e
+                self.logger.warning(
+                    "Checkpoint page token is no longer valid, starting from the first page.")
+                self.__nextPageToken = None
 
         self.__loadPageOfMessages()
 
-    def __loadPageOfMessages(self):
+    def __loadCheckpoint(self):
+        checkpoint = self.__checkpointFile.load() if self.__checkpointFile else None
+        if not checkpoint:
+            return None
+        if checkpoint.get('query') != self.__query:
+            self.logger.info(
+                "Ignoring checkpoint for a different query: %s", checkpoint.get('query'))
+            return None
+        if checkpoint.get('pageSize') != self.__pageSize:
+            self.logger.info(
+                "Ignoring checkpoint for a different page size: %s", checkpoint.get('pageSize'))
+            return None
+        if 'pageToken' not in checkpoint:
+            self.logger.info("Ignoring checkpoint of a sharded listing")
+            return None
+        self.logger.info("Resuming from checkpoint at email %s of page %s",
+                         checkpoint['position'], checkpoint['pageToken'])
+        return checkpoint
+
+    def __saveCheckpoint(self, pageToken: str, position: int):
+        self.__checkpointFile.save({'query': self.__query, 'pageSize': self.__pageSize,
+                                    'pageToken': pageToken, 'position': position, 'syncState': self.syncState})
+        self.__savedPageToken = pageToken
+        self.__sinceCheckpoint = 0
+        self.logger.debug(
+            "Checkpoint saved at email %s of page %s", position, pageToken)
+
+    def checkpoint(self, msgId: str):
+        """
+        Reports that the email, and every email handed out before it, has been processed. The
+        position after it is saved to the checkpoint file every CHECKPOINT_INTERVAL emails and
+        whenever a new page is reached. Does nothing without a checkpoint file.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the processed email.
+        """
+
+        if msgId not in self.__issued:
+            return
+        issuedId = None
+        while issuedId != msgId:
+            issuedId, (pageToken, position) = self.__issued.popitem(last=False)
+        self.__sinceCheckpoint += 1
+        if self.__sinceCheckpoint >= CHECKPOINT_INTERVAL or pageToken != self.__savedPageToken:
+            self.__saveCheckpoint(pageToken, position)
+
+    def clearCheckpoint(self):
+        """
+        Removes the checkpoint file, for once every email has been processed.
+        """
+
+        if self.__checkpointFile:
+            self.__checkpointFile.clear()
+
+    def close(self):
+        """
+        Stops retrieving the next page, for when the remaining emails are not wanted.
+        """
+
+        self.__prefetcher.shutdown(wait=False)
+
+    def __requestPage(self, pageToken: str):
+        # runs on the prefetch thread for every page after the first
         self.logger.debug(
-            "Retrieving page of messages with next page token of: %s", self.__nextPageToken)
-        request = self.__auth.buildService().users().messages().list(
-            userId='me', pageToken=self.__nextPageToken, q=self.__query)
+            "Retrieving page of messages with next page token of: %s", pageToken)
+        request = self.__auth.getService().users().messages().list(
+            userId=self.__userId, pageToken=pageToken, q=self.__query, maxResults=self.__pageSize)
         try:
-            messagelist = request.execute()
+            return self.__auth.execute(request)
+        except HttpError as e:
+            error = _toHTTPError(e)
+            self.logger.error("Error getting page of emails: %s %s", *error.args)
+            raise error
+
+    def __loadPageOfMessages(self, skip: int = 0):
+        if self.__prefetched:
+            messagelist = self.__prefetched.result()
+            self.__prefetched = None
+        else:
+            messagelist = self.__requestPage(self.__nextPageToken)
+
+        self.__pageToken = self.__nextPageToken
+        self.__pageIndex = skip
+        if 'messages' in messagelist:
+            self.__messages = collections.deque(
+                messagelist['messages'][skip:])
+        else:
+            self.logger.debug("No messages returned from gmail.")
+            self.__messages = collections.deque()
+        self.__nextPageToken = None
+        if 'nextPageToken' in messagelist:
+            self.__nextPageToken = messagelist['nextPageToken']
+            self.__prefetched = self.__prefetcher.submit(
+                self.__requestPage, self.__nextPageToken)
+        else:
+            self.__prefetcher.shutdown(wait=False)
+
+        if self.__batchSize:
+            self.__loadBatchedMessages()
+
+    def __loadBatchedMessages(self):
+        # retrieve every message of the page up front, in batches of batchSize sub-requests
+        self.__batched = retrieveBatched(self.__auth, [message['id'] for message in self.__messages],
+                                         self.__userId, self.__cache, self.__batchSize)
+
+    def __nextMessageId(self):
+        while len(self.__messages) <= 0:
+            self.logger.debug("No more messages in local list.")
+            if not self.__nextPageToken:
+                return None
+            self.__loadPageOfMessages()
+        msgId = self.__messages.popleft()['id']
+        self.__pageIndex += 1
+        if self.__checkpointFile:
+            self.__issued[msgId] = (self.__pageToken, self.__pageIndex)
+        return msgId
 
-            if 'messages' in messagelist:
-                self.__messages = messagelist['messages']
+    def messageIds(self):
+        """
+        Generator of the IDs of the remaining emails, without retrieving the emails themselves.
+        Shares its position with iteration over the Email object.
+
+        Yields
+        ------
+        str
+            ID of the next email.
+        """
+
+        msgId = self.__nextMessageId()
+        while msgId:
+            yield msgId
+            msgId = self.__nextMessageId()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        msgId = self.__nextMessageId()
+        if not msgId:
+            raise StopIteration
+        if msgId in self.__batched:
+            response = self.__batched.pop(msgId)
+            if isinstance(response, requests.HTTPError):
+                self.logger.error("Error getting email: %s %s", *response.args)
+                raise response
+            return EmailMsg(self.__auth, msgId, self.__userId, response, self.__cache)
+        message = EmailMsg(self.__auth, msgId, self.__userId, cache=self.__cache)
+        return message
+
+
+class ShardedEmail():
+    """
+    ShardedEmail represents the emails matching a query like Email, but lists them with several
+    threads at once. messages.list can only be paged through one page after another, so the query
+    is split into windows of time with the after: and before: operators and each thread lists
+    windows of its own, from the newest back to the oldest.
+
+    Windows adapt to how many emails they hold. A window that holds more than a page is split in
+    two rather than paged through, down to MIN_WINDOW, and new windows are sized after the density
+    of the last one listed to hold about half a page. The emails of every window are merged into a
+    single stream without duplicates, in no particular order.
+
+    With a batchSize, the emails are retrieved batchSize at a time with batch requests. With a
+    cache, emails found in it are not retrieved again.
+
+    With a checkpointFile, the windows whose emails have all been reported processed through
+    checkpoint() are saved, and a new ShardedEmail for the same query skips them.
+
+    Attributes
+    ----------
+    syncState : dict
+        Sync state taken when the listing started, saved with the checkpoint. When resuming, that of
+        the interrupted run, as emails that arrived since in completed windows are not listed.
+    """
+
+    def __init__(self, auth: GoogleAuth, userId: str = 'me', query: str = None, shards: int = 4, batchSize: int = 0,
+                 checkpointFile: str = None, pageSize: int = MAX_PAGE_SIZE, cache: MetadataCache = None,
+                 syncState: dict = None):
+        self.logger = logging.getLogger(
+            "emailMsg." + self.__class__.__name__)
+
+        if not auth:
+            raise ValueError("Valid GoogleAuth required for email.")
+        if shards < 1:
+            raise ValueError("shards must be at least 1.")
+        if batchSize < 0 or batchSize > MAX_BATCH_SIZE:
+            raise ValueError(
+                "batchSize must be between 0 and %d." % MAX_BATCH_SIZE)
+        if pageSize < 1 or pageSize > MAX_PAGE_SIZE:
+            raise ValueError(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
+
+        self.__auth = auth
+        self.__userId = userId
+        self.__query = query
+        self.__batchSize = batchSize
+        self.__pageSize = pageSize
+        self.__cache = cache
+        self.__checkpointFile = CheckpointFile(checkpointFile) if checkpointFile else None
+        self.__now = int(time.time())
+        # the next window ends here and goes back span seconds, windows split in two come first
+        self.__cursor = math.inf
+        self.__span = INITIAL_WINDOW
+        self.__split = []
+        self.__listing = 0
+        self.__condition = threading.Condition()
+        self.__closed = threading.Event()
+        self.__queue = queue.Queue(SHARD_QUEUE_SIZE)
+        # (after, before) spans whose emails were all processed, and the window of each email
+        # handed out but not yet reported processed
+        self.syncState = syncState
+        self.__done = self.__loadCheckpoint()
+        self.__issued = collections.OrderedDict()
+        self.__batch = collections.deque()
+
+        self.__threads = [threading.Thread(target=self.__list, name="list-%d" % number, daemon=True)
+                          for number in range(shards)]
+        for thread in self.__threads:
+            thread.start()
+        self.__msgIds = self.__merge()
+
+    def __loadCheckpoint(self):
+        checkpoint = self.__checkpointFile.load() if self.__checkpointFile else None
+        if not checkpoint:
+            return []
+        if checkpoint.get('query') != self.__query or 'windows' not in checkpoint:
+            self.logger.info(
+                "Ignoring checkpoint for a different query or listing: %s", checkpoint.get('query'))
+            return []
+        self.logger.info("Resuming after %d completed windows", len(checkpoint['windows']))
+        self.syncState = checkpoint.get('syncState') or self.syncState
+        return [(after, math.inf if before is None else before) for after, before in checkpoint['windows']]
+
+    def __saveCheckpoint(self):
+        self.__checkpointFile.save({'query': self.__query,
+                                    'windows': [[after, None if before == math.inf else before]
+                                                for after, before in self.__done],
+                                    'syncState': self.syncState})
+        self.logger.debug("Checkpoint saved with %d completed spans", len(self.__done))
+
+    def __complete(self, window: dict):
+        # merges the window into the spans done, which overlap or touch where windows met
+        if not self.__checkpointFile or not window['listed'] or window['outstanding']:
+            return
+        merged = []
+        for after, before in sorted(self.__done + [(window['after'], window['upper'])]):
+            if merged and after <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], before))
             else:
-                self.logger.debug("No messages returned from gmail.")
-                self.__messages = list()
-            self.__nextPageToken = None
-            if 'nextPageToken' in messagelist:
-                self.__nextPageToken = messagelist['nextPageToken']
+                merged.append((after, before))
+        self.__done = merged
+        self.__saveCheckpoint()
+
+    def checkpoint(self, msgId: str):
+        """
+        Reports that the email, and every email handed out before it, has been processed. A window
+        is saved to the checkpoint file as completed once all its emails are. Does nothing without
+        a checkpoint file.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the processed email.
+        """
+
+        if msgId not in self.__issued:
+            return
+        issuedId = None
+        while issuedId != msgId:
+            issuedId, window = self.__issued.popitem(last=False)
+            window['outstanding'] -= 1
+            self.__complete(window)
+
+    def clearCheckpoint(self):
+        """
+        Removes the checkpoint file, for once every email has been processed.
+        """
+
+        if self.__checkpointFile:
+            self.__checkpointFile.clear()
+
+    def __window(self, after: int, upper: float):
+        # upper is infinite for the newest window, which has no before: and catches new emails
+        return {'after': after, 'upper': upper, 'listed': False, 'outstanding': 0}
+
+    def __nextWindow(self):
+        # called holding the condition
+        if self.__split:
+            return self.__split.pop()
+        cursor = self.__cursor
+        # skip the spans a previous run completed
+        covering = [after for after, before in self.__done if after < cursor <= before]
+        while covering:
+            cursor = min(covering)
+            covering = [after for after, before in self.__done if after < cursor <= before]
+        if cursor <= 0:
+            return None
+        if cursor <= GMAIL_EPOCH:
+            after = 0
+        else:
+            after = max(int(min(cursor, self.__now)) - self.__span, GMAIL_EPOCH)
+            after = max([after] + [before for _, before in self.__done if before < cursor])
+        self.__cursor = after
+        return self.__window(after, cursor)
+
+    def __windowQuery(self, window: dict):
+        terms = [self.__query] if self.__query else []
+        if window['after'] > 0:
+            terms.append('after:%d' % window['after'])
+        if window['upper'] != math.inf:
+            terms.append('before:%d' % (window['upper'] + WINDOW_OVERLAP))
+        return ' '.join(terms)
+
+    def __requestPage(self, window: dict, pageToken: str):
+        request = self.__auth.getService().users().messages().list(
+            userId=self.__userId, pageToken=pageToken, q=self.__windowQuery(window), maxResults=self.__pageSize)
+        try:
+            return self.__auth.execute(request)
         except HttpError as e:
-            errorMessage = json.loads(e.content)
-            self.logger.error(
-                "Error getting page of emails: %s %s", errorMessage["error"]["code"], errorMessage["error"]["message"])
-            raise requests.HTTPError(
-                errorMessage["error"]["code"], errorMessage["error"]["message"])
+            error = _toHTTPError(e)
+            self.logger.error("Error getting page of emails: %s %s", *error.args)
+            raise error
+
+    def __put(self, item):
+        # gives up once the emails are no longer wanted
+        while not self.__closed.is_set():
+            try:
+                self.__queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __splitWindow(self, window: dict):
+        upper = min(window['upper'], self.__now)
+        if window['after'] <= 0 or upper - window['after'] <= MIN_WINDOW:
+            return False
+        middle = (window['after'] + int(upper)) // 2
+        with self.__condition:
+            # the newer half is listed first, like the rest
+            self.__split.append(self.__window(window['after'], middle))
+            self.__split.append(self.__window(middle, window['upper']))
+            self.__span = max(min(self.__span, (int(upper) - window['after']) // 2), MIN_WINDOW)
+            self.__condition.notify_all()
+        self.__auth.metrics.increment('list_windows_total', 'split')
+        return True
+
+    def __adapt(self, window: dict, count: int):
+        if window['after'] <= 0:
+            return
+        span = min(window['upper'], self.__now) - window['after']
+        with self.__condition:
+            # sized to hold half a page, growing at most fourfold after an empty window
+            self.__span = int(max(MIN_WINDOW, min(MAX_WINDOW, span * 4,
+                                                  span * self.__pageSize / 2 / max(count, 1))))
+
+    def __listWindow(self, window: dict):
+        pageToken = None
+        count = 0
+        while True:
+            page = self.__requestPage(window, pageToken)
+            pageToken = page.get('nextPageToken')
+            if pageToken and not count and self.__splitWindow(window):
+                return True
+            for message in page.get('messages', []):
+                if not self.__put((message['id'], window)):
+                    return False
+            count += len(page.get('messages', []))
+            if not pageToken:
+                break
+        self.__auth.metrics.increment('list_windows_total', 'listed')
+        self.__adapt(window, count)
+        # after every email of the window
+        return self.__put((None, window))
+
+    def __list(self):
+        # runs on each listing thread until no window is left
+        try:
+            while True:
+                with self.__condition:
+                    window = self.__nextWindow()
+                    while window is None and self.__listing and not self.__closed.is_set():
+                        # a window being listed may still be split
+                        self.__condition.wait()
+                        window = self.__nextWindow()
+                    if window is None or self.__closed.is_set():
+                        self.__condition.notify_all()
+                        break
+                    self.__listing += 1
+                try:
+                    listed = self.__listWindow(window)
+                finally:
+                    with self.__condition:
+                        self.__listing -= 1
+                        self.__condition.notify_all()
+                if not listed:
+                    break
+        except BaseException as e:
+            self.__put(e)
+        finally:
+            self.__put(_LISTED)
+
+    def __merge(self):
+        # emails at the second where two windows meet are listed by both, so the IDs listed are
+        # kept by the boundaries of their window until every window meeting there is listed
+        boundaries = collections.defaultdict(lambda: {'ids': set(), 'listed': 0})
+        for after, before in self.__done:
+            # the windows meeting a span done are the only ones listing there
+            boundaries[after]['listed'] += 1
+            boundaries[before]['listed'] += 1
+        running = len(self.__threads)
+        try:
+            while running:
+                item = self.__queue.get()
+                if item is _LISTED:
+                    running -= 1
+                    continue
+                if isinstance(item, BaseException):
+                    raise item
+                msgId, window = item
+                edges = (window['after'], window['upper'])
+                if msgId is None:
+                    window['listed'] = True
+                    for edge in edges:
+                        boundaries[edge]['listed'] += 1
+                        # nothing is listed before the first window or after the last
+                        if boundaries[edge]['listed'] >= (2 if 0 < edge < math.inf else 1):
+                            del boundaries[edge]
+                    self.__complete(window)
+                    continue
+                if any(msgId in boundaries[edge]['ids'] for edge in edges):
+                    continue
+                for edge in edges:
+                    boundaries[edge]['ids'].add(msgId)
+                if self.__checkpointFile:
+                    window['outstanding'] += 1
+                    self.__issued[msgId] = window
+                yield msgId
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops listing, for when the remaining emails are not wanted.
+        """
+
+        self.__closed.set()
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def messageIds(self):
+        """
+        Generator of the IDs of the remaining emails, without retrieving the emails themselves.
+        Shares its position with iteration over the ShardedEmail object.
+
+        Yields
+        ------
+        str
+            ID of the next email.
+        """
+
+        yield from self.__msgIds
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if len(self.__messages) <= 0:
-            self.logger.debug("No more messages in local list.")
-            if not self.__nextPageToken:
+        if not self.__batch:
+            msgIds = list(itertools.islice(self.__msgIds, max(self.__batchSize, 1)))
+            if not msgIds:
                 raise StopIteration
-            self.__loadPageOfMessages()
-        messageIds = self.__messages.pop(0)
-        message = EmailMsg(self.__auth, messageIds['id'], self.__userId)
-        return message
+            responses = {}
+            if self.__batchSize:
+                responses = retrieveBatched(self.__auth, msgIds, self.__userId, self.__cache, self.__batchSize)
+            self.__batch = collections.deque((msgId, responses.get(msgId)) for msgId in msgIds)
+        msgId, response = self.__batch.popleft()
+        if isinstance(response, requests.HTTPError):
+            self.logger.error("Error getting email: %s %s", *response.args)
+            raise response
+        return EmailMsg(self.__auth, msgId, self.__userId, response, self.__cache)
+
+
+class History():
+    """
+    History represents the emails added to the user's Gmail since a point in the mailbox history,
+    as found by the Gmail history API. The emails can be iterated like Email, without listing the
+    whole mailbox.
+
+    Emails that were since deleted, or that are in spam or trash, are left out. If a query is given,
+    only emails that also match the query among those received since the given time are included.
+    With a cache, emails found in it are not retrieved again.
+
+    Raises
+    ------
+    requests.HTTPError
+        With code 404 if the starting historyId is too old and no longer available.
+    """
+
+    # labels of emails that messages.list leaves out by default
+    EXCLUDED_LABELS = {'SPAM', 'TRASH'}
+
+    def __init__(self, auth: GoogleAuth, startHistoryId: str, userId: str = 'me', query: str = None, since: int = None,
+                 cache: MetadataCache = None):
+        self.logger = logging.getLogger(
+            "emailMsg." + self.__class__.__name__)
+
+        if not auth:
+            raise ValueError("Valid GoogleAuth required for history.")
+        if not startHistoryId:
+            raise ValueError("Valid startHistoryId required for history.")
+        if query and since is None:
+            raise ValueError("since is required to apply a query to history.")
+
+        self.__auth = auth
+        self.__userId = userId
+        self.__cache = cache
+
+        msgIds = self.__loadHistory(startHistoryId)
+        if query:
+            # the history API can't search, so keep only what the query finds among recent emails
+            matching = set(Email(auth, userId, "%s after:%d" %
+                                 (query, since)).messageIds())
+            msgIds = [msgId for msgId in msgIds if msgId in matching]
+        self.logger.info(
+            "%d emails added since history %s", len(msgIds), startHistoryId)
+        self.__messages = collections.deque(msgIds)
+
+    def __loadHistory(self, startHistoryId: str):
+        # a dict rather than a set to keep the emails in history order
+        addedIds = {}
+        deleted = set()
+        pageToken = None
+        while True:
+            self.logger.debug(
+                "Retrieving page of history with next page token of: %s", pageToken)
+            request = self.__auth.getService().users().history().list(
+                userId=self.__userId, startHistoryId=startHistoryId, pageToken=pageToken,
+                historyTypes=['messageAdded', 'messageDeleted'])
+            try:
+                historyList = self.__auth.execute(request)
+            except HttpError as e:
+                error = _toHTTPError(e)
+                self.logger.error("Error getting history: %s %s", *error.args)
+                raise error
+
+            for record in historyList.get('history', []):
+                for messageAdded in record.get('messagesAdded', []):
+                    message = messageAdded['message']
+                    if not self.EXCLUDED_LABELS.intersection(message.get('labelIds', [])):
+                        addedIds[message['id']] = True
+                for removed in record.get('messagesDeleted', []):
+                    deleted.add(removed['message']['id'])
+
+            pageToken = historyList.get('nextPageToken')
+            if not pageToken:
+                break
+        return [msgId for msgId in addedIds if msgId not in deleted]
+
+    def checkpoint(self, msgId: str):
+        """
+        Does nothing, a History is short enough to be read again in full.
+        """
+
+    def clearCheckpoint(self):
+        """
+        Does nothing, a History is short enough to be read again in full.
+        """
+
+    def close(self):
+        """
+        Does nothing, a History is read in full when created.
+        """
+
+    def messageIds(self):
+        """
+        Generator of the IDs of the remaining emails, without retrieving the emails themselves.
+        Shares its position with iteration over the History object.
+
+        Yields
+        ------
+        str
+            ID of the next email.
+        """
+
+        while self.__messages:
+            yield self.__messages.popleft()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.__messages:
+            raise StopIteration
+        return EmailMsg(self.__auth, self.__messages.popleft(), self.__userId, cache=self.__cache)
+
+
+def getHistoryId(auth: GoogleAuth, userId: str = 'me'):
+    """
+    Returns the current historyId of the user's mailbox, the point a later History starts from.
+    """
+
+    try:
+        profile = auth.execute(
+            auth.getService().users().getProfile(userId=userId))
+    except HttpError as e:
+        error = _toHTTPError(e)
+        logging.getLogger("emailMsg").error(
+            "Error getting profile: %s %s", *error.args)
+        raise error
+    return profile['historyId']
+
+
+def executeBatched(auth: GoogleAuth, requestList: list, batchSize: int = MAX_BATCH_SIZE):
+    """
+    Executes requests as Gmail batch requests, at most batchSize sub-requests per HTTP call. The
+    quota for every sub-request is acquired before each batch is sent, and sub-requests that were
+    rate limited or failed with a server error are sent again in a later batch after a backoff.
+
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authentication object into Google APIs
+    requestList : list
+        List of (key, request) tuples, where the key identifies the response
+    batchSize : int
+        Maximum number of sub-requests per batch, up to 100
+
+    Returns
+    -------
+    Dictionary of key to the response, or to a requests.HTTPError if that sub-request failed.
+    """
+
+    responses = {}
+    failures = {}
+    pending = list(requestList)
+    attempt = 0
+
+    def callback(key, response, exception):
+        if exception:
+            failures[key] = exception
+        else:
+            responses[key] = response
+
+    while pending:
+        requestsByKey = dict(pending)
+        failures.clear()
+        for start in range(0, len(pending), batchSize):
+            chunk = pending[start:start + batchSize]
+            batch = auth.getService().new_batch_http_request(callback=callback)
+            for key, request in chunk:
+                batch.add(request, request_id=key)
+            units = sum(auth.limiter.cost(request.methodId)
+                        for _, request in chunk)
+            with auth.metrics.phase('quota'):
+                auth.limiter.acquire(units)
+            auth.metrics.increment('quota_units_total', amount=units)
+            for _, request in chunk:
+                auth.metrics.increment('api_calls_total', request.methodId)
+            try:
+                auth.execute(batch)
+            except HttpError as e:
+                error = _toHTTPError(e)
+                logging.getLogger("emailMsg").error(
+                    "Error executing batch: %s %s", *error.args)
+                raise error
+
+        pending = []
+        delay = 0
+        for key, exception in failures.items():
+            if attempt < auth.maxRetries and quota.isRetryable(exception):
+                pending.append((key, requestsByKey[key]))
+                auth.metrics.increment(
+                    'api_retries_total', requestsByKey[key].methodId)
+                delay = max(delay, quota.retryDelay(exception, attempt))
+                if quota.isRateLimited(exception):
+                    auth.limiter.pause(delay)
+            elif isinstance(exception, HttpError):
+                responses[key] = _toHTTPError(exception)
+            else:
+                responses[key] = exception
+        if pending:
+            attempt += 1
+            logging.getLogger("emailMsg").warning(
+                "Retry %d of %d batched requests in %.1fs", attempt, len(pending), delay)
+            time.sleep(delay)
+    return responses
+
+
+def retrieveBatched(auth: GoogleAuth, msgIds: list, userId: str = 'me', cache: MetadataCache = None,
+                    batchSize: int = MAX_BATCH_SIZE):
+    """
+    Retrieves emails with executeBatched, leaving out those found in the cache.
+
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authentication object into Google APIs
+    msgIds : list
+        IDs of the emails
+    userId : str
+        User whose emails they are
+    cache : MetadataCache
+        Cache of the emails already retrieved, None for none
+    batchSize : int
+        Maximum number of sub-requests per batch, up to 100
+
+    Returns
+    -------
+    Dictionary of email ID to the response, or to a requests.HTTPError if that email could not be
+    retrieved.
+    """
+
+    missing = [msgId for msgId in msgIds if not (cache and cache.contains(msgId))]
+    if cache and missing:
+        # EmailMsg only counts the emails it looks up itself, the cached ones
+        auth.metrics.increment('metadata_cache_total', 'miss', len(missing))
+    return executeBatched(auth, [(msgId, EmailMsg.request(auth, msgId, userId)) for msgId in missing], batchSize)
+
+
+def fetchAttachments(auth: GoogleAuth, attachments: list, batchSize: int = MAX_BATCH_SIZE):
+    """
+    Downloads the data of many attachments using batch requests instead of a request each.
+
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authentication object into Google APIs
+    attachments : list
+        Attachments to download, attachments already downloaded are skipped
+    batchSize : int
+        Maximum number of sub-requests per batch, up to 100
+
+    Raises
+    ------
+    requests.HTTPError
+        If any of the attachments could not be retrieved.
+    """
+
+    # inline attachments are read with their email instead
+    pending = [attachment for attachment in attachments if not attachment.isLoaded and not attachment.isInline]
+    responses = executeBatched(auth, [(str(index), attachment.request())
+                                      for index, attachment in enumerate(pending)], batchSize)
+    for index, attachment in enumerate(pending):
+        response = responses.get(str(index))
+        if isinstance(response, requests.HTTPError):
+            logging.getLogger("emailMsg").error(
+                "Error getting attachment: %s %s", *response.args)
+            raise response
+        if response is None:
+            raise requests.HTTPError(
+                500, "No response for attachment " + attachment.filename)
+        attachment.load(response)
 
 
 def __authenticate(scopes: list, tokenFileName: str, credFileName: str):
@@ -353,7 +1729,7 @@ def main():
     auth = __authenticate(['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.metadata'],
                           'secrets/token.pickle', 'secrets/credentials-gmail.json')
 
-    service = auth.buildService()
+    service = auth.getService()
 
     emailMsg = EmailMsg(auth, '170938527ac31a43')
 
@@ -1,8 +1,12 @@
 import logging
 import os
+import re
 
 from dotenv import load_dotenv
 
+from hooks import resolveHook
+from storage import LAYOUTS
+
 logger = logging.getLogger("envvar")
 
 
@@ -27,6 +31,58 @@ def loadvar(envVarName: str, defaultValue: str = None):
     return envVar
 
 
+def loadint(envVarName: str, defaultValue: int = None):
+    """
+    Load a specific environment variable that holds a non-negative integer and log that. The
+    application exits if the value is not a valid integer.
+
+    Parameters
+    ----------
+    envVarName : str
+        The name of the environment variable
+    defaultValue : int
+        The default value of the environment variable
+
+    Returns
+    -------
+    The value of the environment variable as an int, or the default value if it is not set
+    """
+
+    envVar = loadvar(envVarName)
+    if not envVar:
+        return defaultValue
+    if not envVar.isdigit():
+        logger.error("Invalid value for %s: %s", envVarName, envVar)
+        exit("Invalid value provided for " + envVarName)
+    return int(envVar)
+
+
+def loadbool(envVarName: str, defaultValue: bool = False):
+    """
+    Load a specific environment variable that holds true or false and log that. The application
+    exits if the value is neither.
+
+    Parameters
+    ----------
+    envVarName : str
+        The name of the environment variable
+    defaultValue : bool
+        The default value of the environment variable
+
+    Returns
+    -------
+    The value of the environment variable as a bool, or the default value if it is not set
+    """
+
+    envVar = loadvar(envVarName)
+    if not envVar:
+        return defaultValue
+    if envVar.lower() not in ['true', 'false']:
+        logger.error("Invalid value for %s: %s", envVarName, envVar)
+        exit("Invalid value provided for " + envVarName)
+    return envVar.lower() == 'true'
+
+
 def loadenv():
     """
     Load all environment variables for the application and set them to global variables in this package.
@@ -39,6 +95,35 @@ def loadenv():
     global query
     global contentType
     global recordPath
+    global minSize
+    global maxSize
+    global filenamePattern
+    global workers
+    global batchSize
+    global incremental
+    global quotaUnits
+    global maxRetries
+    global resume
+    global pageSize
+    global deduplicate
+    global metricsFile
+    global accounts
+    global accountWorkers
+    global maxRequests
+    global watch
+    global watchMinInterval
+    global watchMaxInterval
+    global archive
+    global archiveCompress
+    global archiveMaxSize
+    global archivePeriod
+    global metadataCacheSize
+    global listShards
+    global hooks
+    global hookWorkers
+    global plan
+    global fromPlan
+    global layout
 
     load_dotenv()
     logLevel = loadvar('ATTACH_LOG_LEVEL', 'INFO')
@@ -48,11 +133,124 @@ def loadenv():
     query = loadvar('ATTACH_GMAIL_SEARCH', '')
     contentType = loadvar('ATTACH_CONTENT_TYPE', '')
     recordPath = loadvar('ATTACH_RECORD_PATH', './')
+    minSize = loadint('ATTACH_MIN_SIZE')
+    maxSize = loadint('ATTACH_MAX_SIZE')
+    filenamePattern = loadvar('ATTACH_FILENAME_PATTERN')
+    workers = loadint('ATTACH_WORKERS', 1)
+    batchSize = loadint('ATTACH_BATCH_SIZE', 0)
+    incremental = loadbool('ATTACH_INCREMENTAL')
+    quotaUnits = loadint('ATTACH_QUOTA_UNITS', 250)
+    maxRetries = loadint('ATTACH_MAX_RETRIES', 5)
+    resume = loadbool('ATTACH_RESUME', True)
+    pageSize = loadint('ATTACH_PAGE_SIZE', 500)
+    deduplicate = loadbool('ATTACH_DEDUPLICATE')
+    metricsFile = loadvar('ATTACH_METRICS_FILE')
+    accounts = loadvar('ATTACH_ACCOUNTS')
+    accountWorkers = loadint('ATTACH_ACCOUNT_WORKERS', 4)
+    maxRequests = loadint('ATTACH_MAX_REQUESTS', 0)
+    watch = loadbool('ATTACH_WATCH')
+    watchMinInterval = loadint('ATTACH_WATCH_MIN_INTERVAL', 5)
+    watchMaxInterval = loadint('ATTACH_WATCH_MAX_INTERVAL', 300)
+    archive = loadvar('ATTACH_ARCHIVE')
+    archiveCompress = loadbool('ATTACH_ARCHIVE_COMPRESS')
+    archiveMaxSize = loadint('ATTACH_ARCHIVE_MAX_SIZE', 1024 * 1024 * 1024)
+    archivePeriod = loadvar('ATTACH_ARCHIVE_PERIOD')
+    metadataCacheSize = loadint('ATTACH_METADATA_CACHE_SIZE', 0)
+    listShards = loadint('ATTACH_LIST_SHARDS', 1)
+    hooks = [hook.strip() for hook in (loadvar('ATTACH_HOOKS') or '').split(',') if hook.strip()]
+    hookWorkers = loadint('ATTACH_HOOK_WORKERS', 0)
+    plan = loadbool('ATTACH_PLAN')
+    fromPlan = loadbool('ATTACH_FROM_PLAN')
+    layout = loadvar('ATTACH_LAYOUT', 'flat')
 
     if logLevel not in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]:
         logger.error("Invalid log level specified: %s", logLevel)
         exit("Invalid log level provided")
 
+    if minSize is not None and maxSize is not None and minSize > maxSize:
+        logger.error("ATTACH_MIN_SIZE %s is larger than ATTACH_MAX_SIZE %s",
+                     minSize, maxSize)
+        exit("Invalid attachment size range provided")
+
+    if workers < 1:
+        logger.error("ATTACH_WORKERS must be at least 1: %s", workers)
+        exit("Invalid number of workers provided")
+
+    if listShards < 1:
+        logger.error("ATTACH_LIST_SHARDS must be at least 1: %s", listShards)
+        exit("Invalid number of list shards provided")
+
+    if accountWorkers < 1:
+        logger.error("ATTACH_ACCOUNT_WORKERS must be at least 1: %s", accountWorkers)
+        exit("Invalid number of account workers provided")
+
+    if watchMinInterval < 1 or watchMinInterval > watchMaxInterval:
+        logger.error("ATTACH_WATCH_MIN_INTERVAL %s must be at least 1 and at most ATTACH_WATCH_MAX_INTERVAL %s",
+                     watchMinInterval, watchMaxInterval)
+        exit("Invalid watch interval provided")
+
+    if archive and archive not in ['tar', 'zip']:
+        logger.error("ATTACH_ARCHIVE must be tar or zip: %s", archive)
+        exit("Invalid archive format provided")
+
+    if archivePeriod and archivePeriod not in ['day', 'month']:
+        logger.error("ATTACH_ARCHIVE_PERIOD must be day or month: %s", archivePeriod)
+        exit("Invalid archive period provided")
+
+    if layout not in LAYOUTS:
+        logger.error("ATTACH_LAYOUT must be one of %s: %s", ", ".join(LAYOUTS), layout)
+        exit("Invalid layout provided")
+
+    if archive and layout != 'flat':
+        logger.error("ATTACH_LAYOUT can't be used with ATTACH_ARCHIVE")
+        exit("Invalid combination of archive and layout provided")
+
+    if archive and deduplicate:
+        logger.error("ATTACH_DEDUPLICATE can't be used with ATTACH_ARCHIVE")
+        exit("Invalid combination of archive and deduplication provided")
+
+    if plan and (fromPlan or watch):
+        logger.error("ATTACH_PLAN can't be used with ATTACH_FROM_PLAN or ATTACH_WATCH")
+        exit("Invalid combination of plan and other modes provided")
+
+    if fromPlan and watch:
+        logger.error("ATTACH_FROM_PLAN can't be used with ATTACH_WATCH")
+        exit("Invalid combination of plan and watch provided")
+
+    if archive and hooks:
+        logger.error("ATTACH_HOOKS can't be used with ATTACH_ARCHIVE")
+        exit("Invalid combination of archive and hooks provided")
+
+    for hook in hooks:
+        try:
+            resolveHook(hook)
+        except (ValueError, ImportError, AttributeError) as e:
+            logger.error("Invalid hook %s: %s", hook, e)
+            exit("Invalid hook provided")
+
+    if accounts and not os.path.isfile(accounts):
+        logger.error("Account manifest does not exist: %s", accounts)
+        exit("Invalid account manifest provided")
+
+    if quotaUnits < 1:
+        logger.error("ATTACH_QUOTA_UNITS must be at least 1: %s", quotaUnits)
+        exit("Invalid quota provided")
+
+    if pageSize < 1 or pageSize > 500:
+        logger.error("ATTACH_PAGE_SIZE must be between 1 and 500: %s", pageSize)
+        exit("Invalid page size provided")
+
+    if batchSize > 100:
+        logger.error("ATTACH_BATCH_SIZE must be at most 100: %s", batchSize)
+        exit("Invalid batch size provided")
+
+    if filenamePattern:
+        try:
+            re.compile(filenamePattern)
+        except re.error as e:
+            logger.error("Invalid filename pattern %s: %s", filenamePattern, e)
+            exit("Invalid filename pattern provided")
+
     if downloadPath[-1] != '/' and downloadPath[-1] != '\\':
         downloadPath = downloadPath + '/'
         if not os.path.isdir(downloadPath):
@@ -0,0 +1,491 @@
+import argparse
+import base64
+import email.parser
+import hashlib
+import http.server
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger("fakeGmail")
+
+
+class Mailbox():
+    """
+    Mailbox is a synthetic Gmail mailbox generated from a seed, so the same settings always produce
+    the same emails and attachment data without storing any of it.
+
+    Attributes
+    ----------
+    messageCount : int
+        Number of emails in the mailbox.
+    attachments : int
+        Number of attachments on each email.
+    minSize : int
+        Smallest attachment size in bytes.
+    maxSize : int
+        Largest attachment size in bytes.
+    nesting : int
+        Depth of multipart parts the attachments are nested in, 1 for attachments at the top level.
+    duplicateRate : float
+        Fraction of attachments that have the same content as another attachment.
+    inlineSize : int
+        Attachments of at most this many bytes have their data inline in the email, like Gmail does
+        for small parts, rather than behind an attachment ID.
+    seed : int
+        Seed of the generated emails and attachment data.
+    """
+
+    CONTENT_TYPE = 'application/pdf'
+
+    def __init__(self, messageCount: int = 1000, attachments: int = 1, minSize: int = 10 * 1024, maxSize: int = 1024 * 1024,
+                 nesting: int = 1, duplicateRate: float = 0.0, inlineSize: int = 0, seed: int = 0):
+        if messageCount < 0 or attachments < 0:
+            raise ValueError("messageCount and attachments must not be negative.")
+        if minSize < 0 or maxSize < minSize:
+            raise ValueError("Attachment sizes must satisfy 0 <= minSize <= maxSize.")
+        if nesting < 1:
+            raise ValueError("nesting must be at least 1.")
+
+        self.messageCount = messageCount
+        self.attachments = attachments
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.nesting = nesting
+        self.duplicateRate = duplicateRate
+        self.inlineSize = inlineSize
+        self.seed = seed
+        # one day apart, newest first like Gmail lists them
+        self.__start = 1500000000
+
+    @staticmethod
+    def messageId(index: int):
+        return '%016x' % (index + 1)
+
+    @staticmethod
+    def messageIndex(msgId: str):
+        try:
+            index = int(msgId, 16) - 1
+        except ValueError:
+            return None
+        return index
+
+    def exists(self, index: int):
+        return index is not None and 0 <= index < self.messageCount
+
+    def messageTime(self, index: int):
+        """
+        Returns the time an email was received, in seconds since the epoch.
+        """
+
+        return self.__start + index * 86400
+
+    def __attachmentInfo(self, index: int, number: int):
+        rng = random.Random('%d-%d-%d' % (self.seed, index, number))
+        size = rng.randint(self.minSize, self.maxSize)
+        contentSeed = '%d-%d-%d' % (self.seed, index, number)
+        if rng.random() < self.duplicateRate:
+            # duplicates share the content of one of a few common attachments
+            contentSeed = '%d-dup-%d' % (self.seed, rng.randint(0, 9))
+            size = random.Random(contentSeed).randint(
+                self.minSize, self.maxSize)
+        return size, contentSeed
+
+    def attachmentData(self, msgId: str, attachmentId: str):
+        """
+        Returns the data of an attachment, or None if there is no such attachment.
+        """
+
+        index = self.messageIndex(msgId)
+        match = re.fullmatch(r'att-(\d+)', attachmentId or '')
+        if not self.exists(index) or not match or int(match.group(1)) >= self.attachments:
+            return None
+        size, contentSeed = self.__attachmentInfo(index, int(match.group(1)))
+        if not size:
+            return b''
+        # what Random.randbytes does, which needs Python 3.9
+        return random.Random(contentSeed).getrandbits(8 * size).to_bytes(size, 'little')
+
+    def message(self, msgId: str):
+        """
+        Returns the email in the form of a messages.get response with format=full, or None if
+        there is no such email.
+        """
+
+        index = self.messageIndex(msgId)
+        if not self.exists(index):
+            return None
+
+        body = ("Synthetic email %d" % index).encode('UTF-8')
+        textPart = {'mimeType': 'text/plain', 'filename': '',
+                    'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="UTF-8"'}],
+                    'body': {'size': len(body), 'data': base64.urlsafe_b64encode(body).decode('ascii')}}
+        attachmentParts = []
+        for number in range(self.attachments):
+            size, _ = self.__attachmentInfo(index, number)
+            filename = 'file-%d-%d.pdf' % (index, number)
+            if size <= self.inlineSize:
+                data = self.attachmentData(msgId, 'att-%d' % number)
+                partBody = {'size': size, 'data': base64.urlsafe_b64encode(data).decode('ascii')}
+            else:
+                partBody = {'attachmentId': 'att-%d' % number, 'size': size}
+            attachmentParts.append({'mimeType': self.CONTENT_TYPE, 'filename': filename,
+                                    'headers': [{'name': 'Content-Type', 'value': '%s; name="%s"' % (self.CONTENT_TYPE, filename)},
+                                                {'name': 'Content-Disposition', 'value': 'attachment; filename="%s"' % filename}],
+                                    'body': partBody})
+
+        parts = attachmentParts
+        for _ in range(self.nesting - 1):
+            parts = [{'mimeType': 'multipart/mixed', 'filename': '', 'headers': [],
+                      'body': {'size': 0}, 'parts': parts}]
+        payload = {'mimeType': 'multipart/mixed', 'filename': '',
+                   'headers': [{'name': 'Subject', 'value': 'Synthetic email %d' % index},
+                               {'name': 'From', 'value': 'sender%d@example.com' % (index % 50)},
+                               {'name': 'Date', 'value': time.strftime('%a, %d %b %Y %H:%M:%S +0000',
+                                                                       time.gmtime(self.messageTime(index)))}],
+                   'body': {'size': 0}, 'parts': [textPart] + parts}
+        _numberParts(payload, '')
+        return {'id': msgId, 'threadId': msgId, 'labelIds': ['INBOX'], 'historyId': str(index + 1),
+                'internalDate': str(self.messageTime(index) * 1000), 'payload': payload}
+
+    def listIds(self, query: str = None, start: int = 0, count: int = None):
+        """
+        Returns a tuple of the IDs of the emails matching the query, newest first, and the total
+        number of matching emails. Only count IDs from position start are returned if count is
+        given. Only the after: and before: search operators are understood, anything else in the
+        query matches every email.
+        """
+
+        first = 0
+        last = self.messageCount
+        for operator, value in re.findall(r'\b(after|before):(\S+)', query or ''):
+            # emails are a day apart in index order, so each operator bounds a range of indexes
+            bound = -(-(_parseSearchDate(value) - self.__start) // 86400)
+            if operator == 'after':
+                first = max(first, bound)
+            else:
+                last = min(last, bound)
+        total = max(0, last - first)
+        if count is None:
+            count = total
+        newest = last - 1 - start
+        return [self.messageId(index) for index in range(newest, max(first - 1, newest - count), -1)], total
+
+
+def _numberParts(part: dict, partId: str):
+    # gives every part its Gmail style partId: '' for the top, then 0, 1, 1.0, 1.1 and so on
+    part['partId'] = partId
+    for number, child in enumerate(part.get('parts', [])):
+        _numberParts(child, str(number) if not partId else '%s.%d' % (partId, number))
+
+
+def _parseSearchDate(value: str):
+    if value.isdigit():
+        return int(value)
+    return int(time.mktime(time.strptime(value.replace('-', '/'), '%Y/%m/%d')))
+
+
+def discoveryDocument(rootUrl: str):
+    """
+    Returns a discovery document for the parts of the Gmail API that the fake server implements.
+    """
+
+    userId = {'type': 'string', 'location': 'path', 'required': True}
+    string = {'type': 'string', 'location': 'query'}
+    number = {'type': 'integer', 'location': 'query'}
+
+    def method(methodId, path, parameters, order):
+        # without a response schema the client returns undecoded bytes
+        return {'id': methodId, 'path': path, 'httpMethod': 'GET', 'parameters': parameters, 'parameterOrder': order,
+                'response': {'$ref': 'Object'}}
+
+    return {
+        'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'id': 'gmail:v1',
+        'name': 'gmail', 'version': 'v1', 'protocol': 'rest',
+        'rootUrl': rootUrl, 'servicePath': 'gmail/v1/users/', 'batchPath': 'batch/gmail/v1',
+        'parameters': {'alt': {'type': 'string', 'location': 'query', 'default': 'json'}, 'fields': string},
+        'schemas': {'Object': {'id': 'Object', 'type': 'object'}},
+        'resources': {'users': {
+            'methods': {'getProfile': method('gmail.users.getProfile', '{userId}/profile', {'userId': userId}, ['userId'])},
+            'resources': {
+                'history': {'methods': {'list': method('gmail.users.history.list', '{userId}/history',
+                                                       {'userId': userId, 'startHistoryId': string, 'pageToken': string,
+                                                        'maxResults': number, 'labelId': string,
+                                                        'historyTypes': dict(string, repeated=True)},
+                                                       ['userId'])}},
+                'messages': {
+                    'methods': {
+                        'list': method('gmail.users.messages.list', '{userId}/messages',
+                                       {'userId': userId, 'q': string, 'pageToken': string, 'maxResults': number,
+                                        'includeSpamTrash': {'type': 'boolean', 'location': 'query'}},
+                                       ['userId']),
+                        'get': method('gmail.users.messages.get', '{userId}/messages/{id}',
+                                      {'userId': userId, 'id': dict(userId), 'format': string,
+                                       'metadataHeaders': dict(string, repeated=True)},
+                                      ['userId', 'id'])},
+                    'resources': {'attachments': {'methods': {
+                        'get': method('gmail.users.messages.attachments.get', '{userId}/messages/{messageId}/attachments/{id}',
+                                      {'userId': userId, 'messageId': dict(userId), 'id': dict(userId)},
+                                      ['userId', 'messageId', 'id'])}}}}}}},
+    }
+
+
+class FakeGmailServer(http.server.ThreadingHTTPServer):
+    """
+    FakeGmailServer is a local stand in for the Gmail API serving a synthetic Mailbox. It implements
+    discovery, messages.list, messages.get, messages.attachments.get, getProfile, history.list and
+    batch requests, and can add latency to and rate limit a share of its responses.
+
+    Attributes
+    ----------
+    mailbox : Mailbox
+        Emails served.
+    latency : float
+        Seconds added to every HTTP request.
+    errorRate : float
+        Fraction of API requests answered with 429 rateLimitExceeded.
+    retryAfter : int
+        Retry-After seconds sent with the rate limited responses, None to send none.
+    requestCount : int
+        Number of HTTP requests served.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, mailbox: Mailbox, port: int = 0, latency: float = 0.0, errorRate: float = 0.0,
+                 retryAfter: int = None, seed: int = 0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.mailbox = mailbox
+        self.latency = latency
+        self.errorRate = errorRate
+        self.retryAfter = retryAfter
+        self.requestCount = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    @property
+    def rootUrl(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    @property
+    def discoveryUrl(self):
+        """
+        URL to give GoogleAuth as its discoveryUrl.
+        """
+
+        return self.rootUrl + 'discovery/v1/apis/{api}/{apiVersion}/rest'
+
+    def shouldFail(self):
+        with self.__lock:
+            self.requestCount += 1
+            return self.__random.random() < self.errorRate
+
+    def call(self, path: str, query: dict):
+        """
+        Answers one API request.
+
+        Returns
+        -------
+        Tuple of the HTTP status, extra headers and the JSON response.
+        """
+
+        if self.shouldFail():
+            headers = {'Retry-After': str(self.retryAfter)
+                       } if self.retryAfter is not None else {}
+            return 429, headers, _error(429, 'Rate Limit Exceeded', 'rateLimitExceeded')
+
+        parts = path.strip('/').split('/')
+        # gmail/v1/users/{userId}/...
+        if parts[:3] != ['gmail', 'v1', 'users'] or len(parts) < 5:
+            return 404, {}, _error(404, 'Not Found', 'notFound')
+        route = parts[4:]
+        mailbox = self.mailbox
+
+        if route == ['profile']:
+            return 200, {}, {'emailAddress': 'fake@example.com', 'messagesTotal': mailbox.messageCount,
+                             'historyId': str(mailbox.messageCount)}
+
+        if route == ['history']:
+            start = int(query.get('startHistoryId', ['0'])[0])
+            added = [{'id': str(index + 1), 'messagesAdded': [{'message': {'id': mailbox.messageId(index), 'labelIds': ['INBOX']}}]}
+                     for index in range(start, mailbox.messageCount)]
+            return 200, {}, {'history': added, 'historyId': str(mailbox.messageCount)}
+
+        if route == ['messages']:
+            pageSize = min(int(query.get('maxResults', ['100'])[0]), 500)
+            start = int(query.get('pageToken', ['0'])[0])
+            page, total = mailbox.listIds(
+                query.get('q', [''])[0], start, pageSize)
+            response = {'resultSizeEstimate': total}
+            if page:
+                response['messages'] = [
+                    {'id': msgId, 'threadId': msgId} for msgId in page]
+            if start + pageSize < total:
+                response['nextPageToken'] = str(start + pageSize)
+            return 200, {}, response
+
+        if len(route) == 2 and route[0] == 'messages':
+            message = mailbox.message(route[1])
+            if not message:
+                return 404, {}, _error(404, 'Requested entity was not found.', 'notFound')
+            return 200, {}, _partialResponse(message, query.get('fields', [''])[0])
+
+        if len(route) == 4 and route[0] == 'messages' and route[2] == 'attachments':
+            data = mailbox.attachmentData(route[1], route[3])
+            if data is None:
+                return 404, {}, _error(404, 'Requested entity was not found.', 'notFound')
+            return 200, {}, {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode('ascii')}
+
+        return 404, {}, _error(404, 'Not Found', 'notFound')
+
+
+def _parseFields(fields: str, position: int = 0):
+    # a partial response mask, such as id,payload(parts(body/size)), as a tree of dictionaries
+    # where None keeps the whole field. Returns the tree and where parsing stopped.
+    tree = {}
+    name = ''
+    while position < len(fields):
+        char = fields[position]
+        position += 1
+        if char == '(':
+            subtree, position = _parseFields(fields, position)
+            _addField(tree, name, subtree)
+            name = ''
+        elif char in ',)':
+            if name:
+                _addField(tree, name, None)
+            name = ''
+            if char == ')':
+                return tree, position
+        else:
+            name += char.strip()
+    if name:
+        _addField(tree, name, None)
+    return tree, position
+
+
+def _addField(tree: dict, path: str, subtree: dict):
+    *parents, last = path.split('/')
+    for parent in parents:
+        tree = tree.setdefault(parent, {})
+    tree[last] = subtree
+
+
+def _selectFields(value, tree: dict):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [_selectFields(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: _selectFields(item, tree[key]) for key, item in value.items() if key in tree}
+    return value
+
+
+def _partialResponse(response: dict, fields: str):
+    """
+    Returns only the fields of a response named by a fields parameter, like Google APIs do.
+    """
+
+    if not fields:
+        return response
+    return _selectFields(response, _parseFields(fields)[0])
+
+
+def _error(code: int, message: str, reason: str):
+    return {'error': {'code': code, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, which would otherwise stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def __send(self, status: int, headers: dict, body: bytes, contentType: str = 'application/json; charset=UTF-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith('/discovery/'):
+            document = discoveryDocument(self.server.rootUrl)
+            self.__send(200, {}, json.dumps(document).encode('UTF-8'))
+            return
+        status, headers, response = self.server.call(
+            url.path, urllib.parse.parse_qs(url.query))
+        self.__send(status, headers, json.dumps(response).encode('UTF-8'))
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urllib.parse.urlsplit(self.path).path != '/batch/gmail/v1':
+            self.__send(404, {}, json.dumps(
+                _error(404, 'Not Found', 'notFound')).encode('UTF-8'))
+            return
+
+        # parse the multipart/mixed batch, each part holding one serialized HTTP request
+        batch = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode('UTF-8') + b'\r\n\r\n' + body)
+        boundary = 'batch_' + hashlib.md5(body).hexdigest()
+        out = []
+        for part in batch.get_payload():
+            request = part.get_payload()
+            requestLine = request.lstrip().split('\n', 1)[0].strip()
+            target = requestLine.split(' ')[1]
+            url = urllib.parse.urlsplit(target)
+            status, headers, response = self.server.call(
+                url.path, urllib.parse.parse_qs(url.query))
+            contentId = part['Content-ID'] or '<>'
+            lines = ['--' + boundary, 'Content-Type: application/http',
+                     'Content-ID: <response-' + contentId[1:], '',
+                     'HTTP/1.1 %d %s' % (status, http.HTTPStatus(status).phrase),
+                     'Content-Type: application/json; charset=UTF-8']
+            lines += ['%s: %s' % header for header in headers.items()]
+            lines += ['', json.dumps(response)]
+            out.append('\r\n'.join(lines))
+        payload = ('\r\n'.join(out) + '\r\n--' +
+                   boundary + '--\r\n').encode('UTF-8')
+        self.__send(200, {}, payload,
+                    'multipart/mixed; boundary=' + boundary)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a synthetic mailbox through a local fake of the Gmail API.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--attachments', type=int, default=1)
+    parser.add_argument('--min-size', type=int, default=10 * 1024)
+    parser.add_argument('--max-size', type=int, default=1024 * 1024)
+    parser.add_argument('--nesting', type=int, default=1)
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--inline-size', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mailbox = Mailbox(args.messages, args.attachments, args.min_size, args.max_size,
+                      args.nesting, args.duplicate_rate, args.inline_size, args.seed)
+    server = FakeGmailServer(mailbox, args.port, args.latency,
+                             args.error_rate, seed=args.seed)
+    logger.info("Serving %d emails, discovery URL %s",
+                args.messages, server.discoveryUrl)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+import concurrent.futures
+import importlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+
+from ledger import Ledger
+from metrics import Metrics
+from storage import claimPath
+
+logger = logging.getLogger("hooks")
+
+# Most attachments handed to the hooks and not yet processed before the writer is held back
+HOOK_QUEUE_SIZE = 64
+
+# Hook results recorded in the ledger with one flush
+RESULT_BATCH_SIZE = 64
+
+# The EICAR anti-virus test file, which scan reports as infected
+EICAR_SIGNATURE = b'X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*'
+
+# Largest width and height of the thumbnails of images
+THUMBNAIL_SIZE = (256, 256)
+
+
+def _sidecarPath(path: str, suffix: str):
+    # a file derived from an attachment, next to it and never replacing another file
+    return claimPath(os.path.dirname(path), os.path.basename(path) + suffix)
+
+
+def scan(path: str, data, info: dict):
+    """
+    Stand in for a virus scanner, reporting only the EICAR test file as infected. Real scanners can
+    be plugged in as hooks of their own.
+    """
+
+    infected = data.find(EICAR_SIGNATURE) >= 0
+    return {'infected': infected, 'signature': 'EICAR-Test-File' if infected else None}
+
+
+def pdfText(path: str, data, info: dict):
+    """
+    Extracts the text of a PDF into a .txt file next to it. Needs pypdf. Returns None for other
+    files.
+    """
+
+    if data[:5] != b'%PDF-':
+        return None
+    # optional, only needed by those who extract text
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    text = '\n'.join(page.extract_text() or '' for page in reader.pages)
+    textPath = _sidecarPath(path, '.txt')
+    with open(textPath, 'w', encoding="utf-8") as f:
+        f.write(text)
+    return {'pages': len(reader.pages), 'characters': len(text), 'path': textPath}
+
+
+def thumbnail(path: str, data, info: dict):
+    """
+    Makes a PNG thumbnail of an image next to it, at most THUMBNAIL_SIZE. Needs Pillow. Returns None
+    for other files.
+    """
+
+    if not (info.get('contentType') or '').startswith('image/'):
+        return None
+    # optional, only needed by those who make thumbnails
+    from PIL import Image
+    with Image.open(path) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        thumbnailPath = _sidecarPath(path, '.thumb.png')
+        image.save(thumbnailPath, 'PNG')
+        return {'width': image.width, 'height': image.height, 'path': thumbnailPath}
+
+
+# Hooks that can be named without their module
+BUILTIN_HOOKS = {'scan': 'hooks:scan', 'pdftext': 'hooks:pdfText', 'thumbnail': 'hooks:thumbnail'}
+
+# Hook functions by name, resolved once per process
+_resolved = {}
+
+
+def resolveHook(name: str):
+    """
+    Returns the function of a hook, given the name of a built in hook or module:function.
+
+    Raises
+    ------
+    ValueError
+        If the name is neither.
+    ImportError
+        If the module can't be imported.
+    AttributeError
+        If the module has no such function.
+    """
+
+    if name not in _resolved:
+        moduleName, separator, function = BUILTIN_HOOKS.get(name, name).partition(':')
+        if not separator or not moduleName or not function:
+            raise ValueError("Hook %s must be one of %s or module:function." %
+                             (name, ", ".join(BUILTIN_HOOKS)))
+        _resolved[name] = getattr(importlib.import_module(moduleName), function)
+    return _resolved[name]
+
+
+def runHooks(hooks: list, path: str, info: dict):
+    """
+    Runs hooks over a saved attachment, in a worker process. Each hook is called with the path of
+    the file, a read only buffer of its data mapped from the file rather than read into memory,
+    and the info of the attachment. A failing hook is reported and does not stop the others.
+
+    Parameters
+    ----------
+    hooks : list
+        Names of the hooks to run
+    path : str
+        Path and file name of the saved attachment
+    info : dict
+        msgId, partId, filename, contentType, size and sha256 of the attachment
+
+    Returns
+    -------
+    List of tuples of the hook, its result as JSON or None if it failed, the error if it failed or
+    None, and the seconds it took.
+    """
+
+    with open(path, 'rb') as f:
+        # an empty file can't be mapped
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(
+            f.fileno()).st_size else b''
+    results = []
+    try:
+        for hook in hooks:
+            started = time.perf_counter()
+            try:
+                result, error = json.dumps(resolveHook(hook)(path, data, info)), None
+            except Exception as e:
+                result, error = None, '%s: %s' % (type(e).__name__, e)
+            results.append((hook, result, error, time.perf_counter() - started))
+    finally:
+        if isinstance(data, mmap.mmap):
+            try:
+                data.close()
+            except BufferError:
+                # a hook still holds a view of the data, the map is closed once it is released
+                pass
+    return results
+
+
+def newProcessPool(workers: int = 0):
+    """
+    Returns a pool of processes to run hooks in, which may be shared by several PostProcessors.
+    Processes are spawned rather than forked, as forking a process running threads can deadlock.
+
+    Parameters
+    ----------
+    workers : int
+        Number of processes, 0 for one per CPU
+    """
+
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers or None,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+
+
+class PostProcessor():
+    """
+    PostProcessor runs hooks, such as scanning, extracting text or making thumbnails, over every
+    saved attachment in a pool of processes, so that CPU bound work uses every core and overlaps
+    the downloads instead of being a separate pass over the download path. Hooks are named like
+    BUILTIN_HOOKS or module:function, and are called with the path of the attachment, a read only
+    buffer of its data and a dictionary describing it. What each returns, or the error it raised,
+    is recorded in the ledger.
+
+    At most queueSize attachments wait for the hooks, the writer is held back beyond that. Results
+    are recorded in batches, and once everything submitted is processed by flush.
+
+    A PostProcessor may be shared by several threads.
+
+    Attributes
+    ----------
+    hooks : list
+        Names of the hooks run over each attachment.
+    """
+
+    def __init__(self, hooks: list, ledger: Ledger, metrics: Metrics = None, workers: int = 0,
+                 executor: concurrent.futures.Executor = None, queueSize: int = HOOK_QUEUE_SIZE):
+        self.logger = logging.getLogger(
+            "hooks." + self.__class__.__name__)
+
+        if not hooks:
+            raise ValueError("At least one hook required for post processing.")
+        if not ledger:
+            raise ValueError("Valid ledger required for post processing.")
+        # fail now rather than in every worker
+        for hook in hooks:
+            resolveHook(hook)
+
+        self.hooks = list(hooks)
+        self.__ledger = ledger
+        self.__metrics = metrics if metrics else Metrics()
+        self.__ownsExecutor = executor is None
+        self.__executor = executor if executor else newProcessPool(workers)
+        self.__slots = threading.BoundedSemaphore(queueSize)
+        self.__condition = threading.Condition()
+        self.__pending = 0
+        self.__results = []
+
+    def submit(self, path: str, info: dict):
+        """
+        Queues a saved attachment for the hooks, waiting while the queue is full.
+
+        Parameters
+        ----------
+        path : str
+            Path and file name of the saved attachment
+        info : dict
+            msgId, partId, filename, contentType, size and sha256 of the attachment
+        """
+
+        with self.__metrics.phase('backpressure'):
+            self.__slots.acquire()
+        with self.__condition:
+            self.__pending += 1
+        try:
+            future = self.__executor.submit(runHooks, self.hooks, path, info)
+        except BaseException:
+            self.__finished()
+            raise
+        future.add_done_callback(lambda future: self.__done(future, info))
+
+    def __done(self, future: concurrent.futures.Future, info: dict):
+        # runs on a thread of the pool once the hooks of an attachment are done
+        try:
+            results = future.result()
+        except Exception as e:
+            # the file is gone or the worker process died
+            results = [(hook, None, '%s: %s' % (type(e).__name__, e), 0) for hook in self.hooks]
+        records = []
+        for hook, result, error, seconds in results:
+            self.__metrics.increment('hook_seconds_total', hook, seconds)
+            if error:
+                self.__metrics.increment('hook_errors_total', hook)
+                self.logger.warning("Hook %s failed on %s of email %s: %s",
+                                    hook, info.get('filename'), info['msgId'], error)
+            records.append((info['msgId'], info['partId'], hook, result, error))
+        with self.__condition:
+            self.__results.extend(records)
+            if len(self.__results) < RESULT_BATCH_SIZE:
+                records = []
+            else:
+                records, self.__results = self.__results, []
+        try:
+            self.__record(records)
+        finally:
+            self.__finished()
+
+    def __finished(self):
+        with self.__condition:
+            self.__pending -= 1
+            self.__condition.notify_all()
+        self.__slots.release()
+
+    def __record(self, records: list):
+        if not records:
+            return
+        try:
+            self.__ledger.addResults(records)
+        except Exception:
+            self.logger.exception("Unable to record %d hook results", len(records))
+
+    def flush(self):
+        """
+        Waits for the hooks of every attachment submitted and records all their results.
+        """
+
+        with self.__condition:
+            while self.__pending:
+                self.__condition.wait()
+            records, self.__results = self.__results, []
+        self.__record(records)
+
+    def close(self):
+        """
+        Flushes, then stops the pool of processes if it is not shared.
+        """
+
+        self.flush()
+        if self.__ownsExecutor:
+            self.__executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
@@ -0,0 +1,228 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class Ledger():
+    """
+    Ledger records the attachments that have been downloaded so they are not downloaded again on
+    subsequent runs. It is kept in an SQLite database indexed on the email ID and the MIME part ID
+    of the attachment, so lookups stay fast however many attachments are recorded, and records are
+    committed as soon as they are added so a crash loses at most the batch being written.
+
+    A Ledger may be shared by several threads.
+
+    Attributes
+    ----------
+    path : str
+        Path and file name of the database.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS attachments (
+            msgId TEXT NOT NULL,
+            partId TEXT NOT NULL,
+            filename TEXT,
+            path TEXT,
+            size INTEGER,
+            sha256 TEXT,
+            savedAt REAL,
+            PRIMARY KEY (msgId, partId)) WITHOUT ROWID""",
+        # records.txt entries were the email ID and filename concatenated
+        "CREATE TABLE IF NOT EXISTS legacy (record TEXT PRIMARY KEY) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID",
+        # where attachments written into archives are, path of attachments holds the archive
+        """CREATE TABLE IF NOT EXISTS members (
+            msgId TEXT NOT NULL,
+            partId TEXT NOT NULL,
+            member TEXT NOT NULL,
+            offset INTEGER,
+            PRIMARY KEY (msgId, partId)) WITHOUT ROWID""",
+        # what each post processing hook returned for an attachment, as JSON, or the error it raised
+        """CREATE TABLE IF NOT EXISTS results (
+            msgId TEXT NOT NULL,
+            partId TEXT NOT NULL,
+            hook TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            processedAt REAL,
+            PRIMARY KEY (msgId, partId, hook)) WITHOUT ROWID""",
+    ]
+
+    def __init__(self, path: str, legacyRecordFile: str = None):
+        self.logger = logging.getLogger(
+            "ledger." + self.__class__.__name__)
+
+        if not path:
+            raise ValueError("Valid path required for ledger.")
+
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=FULL")
+        with self.__db:
+            for statement in self.SCHEMA:
+                self.__db.execute(statement)
+        self.logger.info("Ledger opened at %s", path)
+
+        if legacyRecordFile:
+            self.__importLegacy(legacyRecordFile)
+
+    def __importLegacy(self, recordFile: str):
+        if not os.path.exists(recordFile):
+            return
+        imported = self.__db.execute(
+            "SELECT value FROM meta WHERE key = 'legacyImported'").fetchone()
+        if imported:
+            return
+
+        with open(recordFile, 'r', encoding="utf-8") as recf:
+            records = ((record.rstrip(),) for record in recf if record.strip())
+            with self.__db:
+                self.__db.executemany(
+                    "INSERT OR IGNORE INTO legacy (record) VALUES (?)", records)
+                self.__db.execute(
+                    "INSERT INTO meta (key, value) VALUES ('legacyImported', ?)", (recordFile,))
+        self.logger.info("Imported records from %s", recordFile)
+
+    def contains(self, msgId: str, partId: str, filename: str):
+        """
+        Returns True if the attachment has already been recorded.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the email that contains the attachment
+        partId : str
+            ID of the MIME part holding the attachment
+        filename : str
+            Filename of the attachment, used to match records imported from records.txt
+        """
+
+        with self.__lock:
+            if self.__db.execute("SELECT 1 FROM attachments WHERE msgId = ? AND partId = ?",
+                                 (msgId, partId or '')).fetchone():
+                return True
+            return self.__db.execute("SELECT 1 FROM legacy WHERE record = ?",
+                                     (msgId + (filename or ''),)).fetchone() is not None
+
+    def add(self, msgId: str, partId: str, filename: str, path: str, size: int, sha256: str):
+        """
+        Records a downloaded attachment.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the email that contains the attachment
+        partId : str
+            ID of the MIME part holding the attachment
+        filename : str
+            Filename of the attachment in the email
+        path : str
+            Path the attachment was saved to
+        size : int
+            Size of the saved attachment in bytes
+        sha256 : str
+            Hex SHA-256 digest of the saved attachment
+        """
+
+        with self.__lock, self.__db:
+            self.__db.execute("INSERT OR REPLACE INTO attachments (msgId, partId, filename, path, size, sha256, savedAt) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (msgId, partId or '', filename, path, size, sha256, time.time()))
+
+    def addMany(self, records: list, members: list = None):
+        """
+        Records several downloaded attachments in a single transaction, which is flushed to disk
+        once rather than once per attachment.
+
+        Parameters
+        ----------
+        records : list
+            Tuples of the msgId, partId, filename, path, size and sha256 of each attachment, as
+            taken by add.
+        members : list
+            Tuples of the msgId, partId, member name and offset of the attachments written into an
+            archive, whose path is the archive's.
+        """
+
+        now = time.time()
+        with self.__lock, self.__db:
+            self.__db.executemany("INSERT OR REPLACE INTO attachments (msgId, partId, filename, path, size, sha256, savedAt) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(msgId, partId or '', filename, path, size, sha256, now)
+                                   for msgId, partId, filename, path, size, sha256 in records])
+            if members:
+                self.__db.executemany("INSERT OR REPLACE INTO members (msgId, partId, member, offset) VALUES (?, ?, ?, ?)",
+                                      [(msgId, partId or '', member, offset)
+                                       for msgId, partId, member, offset in members])
+
+    def members(self, msgId: str):
+        """
+        Returns where the attachments of an email written into archives are.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the email
+
+        Returns
+        -------
+        List of tuples of the partId, filename, archive path, member name and offset of each
+        archived attachment.
+        """
+
+        with self.__lock:
+            return self.__db.execute("""SELECT a.partId, a.filename, a.path, m.member, m.offset
+                FROM attachments a JOIN members m ON a.msgId = m.msgId AND a.partId = m.partId
+                WHERE a.msgId = ? ORDER BY a.partId""", (msgId,)).fetchall()
+
+    def addResults(self, records: list):
+        """
+        Records what post processing hooks returned for attachments, in a single transaction.
+
+        Parameters
+        ----------
+        records : list
+            Tuples of the msgId, partId, hook name, result as JSON and error of each hook run, the
+            result or the error being None.
+        """
+
+        now = time.time()
+        with self.__lock, self.__db:
+            self.__db.executemany("INSERT OR REPLACE INTO results (msgId, partId, hook, result, error, processedAt) VALUES (?, ?, ?, ?, ?, ?)",
+                                  [(msgId, partId or '', hook, result, error, now)
+                                   for msgId, partId, hook, result, error in records])
+
+    def results(self, msgId: str):
+        """
+        Returns what the post processing hooks returned for the attachments of an email.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the email
+
+        Returns
+        -------
+        List of tuples of the partId, hook name, result as JSON and error of each hook run.
+        """
+
+        with self.__lock:
+            return self.__db.execute("SELECT partId, hook, result, error FROM results WHERE msgId = ? ORDER BY partId, hook",
+                                     (msgId,)).fetchall()
+
+    def close(self):
+        """
+        Closes the database.
+        """
+
+        with self.__lock:
+            self.__db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
@@ -0,0 +1,251 @@
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("metrics")
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# Prefix of every metric name in the Prometheus export
+PREFIX = 'attachback_'
+
+
+class Metrics():
+    """
+    Metrics collects counters and latency histograms for a run, such as API calls per method, bytes
+    downloaded and written, attachments skipped by reason and time spent on the network, decoding
+    and disk. Each metric may be split by a single label, such as the API method. Metrics may be
+    updated from several threads.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = collections.defaultdict(float)
+        self.__histograms = {}
+        self.__started = time.monotonic()
+
+    def increment(self, name: str, label: str = None, amount: float = 1):
+        """
+        Adds to a counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter, such as api_calls_total.
+        label : str
+            Label value to split the counter by, such as the API method.
+        amount : float
+            Amount to add.
+        """
+
+        with self.__lock:
+            self.__counters[(name, label)] += amount
+
+    def observe(self, name: str, label: str, seconds: float):
+        """
+        Records a duration in a histogram.
+
+        Parameters
+        ----------
+        name : str
+            Name of the histogram, such as api_latency_seconds.
+        label : str
+            Label value to split the histogram by, such as the API method.
+        seconds : float
+            Duration to record.
+        """
+
+        with self.__lock:
+            histogram = self.__histograms.setdefault(
+                (name, label), {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0})
+            histogram['buckets'][bisect.bisect_left(
+                LATENCY_BUCKETS, seconds)] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, label: str = None):
+        """
+        Context manager that records how long its block took in a histogram.
+        """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, label, time.monotonic() - start)
+
+    @contextlib.contextmanager
+    def phase(self, phase: str):
+        """
+        Context manager that adds how long its block took to the time spent in a phase of the
+        run, such as network, decode or disk.
+        """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.increment('phase_seconds_total', phase,
+                           time.monotonic() - start)
+
+    def get(self, name: str, label: str = None):
+        """
+        Returns the value of a counter, 0 if it was never incremented.
+        """
+
+        with self.__lock:
+            return self.__counters.get((name, label), 0)
+
+    def merge(self, other: 'Metrics'):
+        """
+        Adds the counters and histograms of another run into this one, such as those of each
+        account of a multi-account run.
+        """
+
+        with other.__lock:
+            counters = dict(other.__counters)
+            histograms = {key: {'buckets': list(histogram['buckets']), 'sum': histogram['sum'],
+                                'count': histogram['count']}
+                          for key, histogram in other.__histograms.items()}
+        with self.__lock:
+            for key, value in counters.items():
+                self.__counters[key] += value
+            for key, histogram in histograms.items():
+                mine = self.__histograms.setdefault(
+                    key, {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0})
+                mine['buckets'] = [a + b for a, b in zip(mine['buckets'], histogram['buckets'])]
+                mine['sum'] += histogram['sum']
+                mine['count'] += histogram['count']
+
+    def toDict(self):
+        """
+        Returns every metric as a dictionary that can be written as JSON.
+        """
+
+        with self.__lock:
+            result = {'run_seconds': time.monotonic() - self.__started,
+                      'counters': {}, 'histograms': {}}
+            for (name, label), value in sorted(self.__counters.items(), key=_sortKey):
+                counter = result['counters'].setdefault(name, {})
+                counter[label or ''] = value
+            for (name, label), histogram in sorted(self.__histograms.items(), key=_sortKey):
+                histograms = result['histograms'].setdefault(name, {})
+                histograms[label or ''] = {'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                                               histogram['buckets'])),
+                                           'sum': histogram['sum'], 'count': histogram['count']}
+        return result
+
+    def toPrometheus(self):
+        """
+        Returns every metric in the Prometheus text exposition format, as read by the node exporter
+        text file collector.
+        """
+
+        data = self.toDict()
+        lines = ['# TYPE %srun_seconds gauge' % PREFIX,
+                 '%srun_seconds %f' % (PREFIX, data['run_seconds'])]
+        for name, values in data['counters'].items():
+            lines.append('# TYPE %s%s counter' % (PREFIX, name))
+            for label, value in values.items():
+                lines.append('%s%s%s %s' %
+                             (PREFIX, name, _labels(name, label), value))
+        for name, values in data['histograms'].items():
+            lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+            for label, histogram in values.items():
+                cumulative = 0
+                for bound, count in histogram['buckets'].items():
+                    cumulative += count
+                    lines.append('%s%s_bucket%s %d' % (PREFIX, name, _labels(
+                        name, label, {'le': bound}), cumulative))
+                lines.append('%s%s_sum%s %f' % (
+                    PREFIX, name, _labels(name, label), histogram['sum']))
+                lines.append('%s%s_count%s %d' % (
+                    PREFIX, name, _labels(name, label), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """
+        Writes every metric to a file, as JSON if the file name ends in .json and in the Prometheus
+        text format otherwise. The file is replaced in one step so readers never see it partly
+        written.
+
+        Parameters
+        ----------
+        path : str
+            Path and file name to write to.
+        """
+
+        tempFile = path + '.tmp'
+        with open(tempFile, 'w', encoding="utf-8") as f:
+            if path.endswith('.json'):
+                json.dump(self.toDict(), f, indent=2)
+            else:
+                f.write(self.toPrometheus())
+        os.replace(tempFile, path)
+        logger.info("Metrics written to %s", path)
+
+    def summary(self):
+        """
+        Returns a short human readable report of the run.
+        """
+
+        data = self.toDict()
+        counters = data['counters']
+        lines = ["Run took %.1fs" % data['run_seconds']]
+        for title, name in [("API calls", 'api_calls_total'), ("Retries", 'api_retries_total'),
+                            ("Skipped attachments", 'attachments_skipped_total'),
+                            ("Time by phase (s)", 'phase_seconds_total'),
+                            ("Startup (s)", 'startup_seconds_total'),
+                            ("Metadata cache", 'metadata_cache_total'),
+                            ("Hooks (s)", 'hook_seconds_total'), ("Hook errors", 'hook_errors_total')]:
+            if name in counters:
+                lines.append("%s: %s" % (title, ", ".join("%s=%g" % (label, value)
+                                                          for label, value in counters[name].items())))
+        for title, name in [("Emails", 'emails_total'), ("Attachments saved", 'attachments_saved_total'),
+                            ("Quota units", 'quota_units_total'), ("Bytes downloaded", 'bytes_downloaded_total'),
+                            ("Bytes written", 'bytes_written_total')]:
+            lines.append("%s: %d" % (title, counters.get(name, {}).get('', 0)))
+        for method, histogram in data['histograms'].get('api_latency_seconds', {}).items():
+            if histogram['count']:
+                lines.append("Latency of %s: mean %.3fs over %d calls" % (method, histogram['sum'] / histogram['count'],
+                                                                          histogram['count']))
+        return "\n".join(lines)
+
+
+# Name of the label that splits each metric
+LABEL_NAMES = {
+    'api_calls_total': 'method',
+    'api_retries_total': 'method',
+    'api_latency_seconds': 'method',
+    'attachments_skipped_total': 'reason',
+    'phase_seconds_total': 'phase',
+    'startup_seconds_total': 'phase',
+    'metadata_cache_total': 'result',
+    'list_windows_total': 'result',
+    'hook_seconds_total': 'hook',
+    'hook_errors_total': 'hook',
+}
+
+
+def _sortKey(item):
+    (name, label), _ = item
+    return name, label or ''
+
+
+def _labels(name: str, label: str, extra: dict = None):
+    labels = {}
+    if label:
+        labels[LABEL_NAMES.get(name, 'label')] = label
+    if extra:
+        labels.update(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels.items()) + '}'
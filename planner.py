@@ -0,0 +1,325 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import math
+import os
+import time
+
+from cache import MetadataCache
+from emailMsg import (CHECKPOINT_INTERVAL, MAX_BATCH_SIZE, AttachmentFilter, CheckpointFile, Email,
+                      EmailMsg, GoogleAuth, ShardedEmail, getHistoryId, retrieveBatched)
+from ledger import Ledger
+from startup import lazyImport
+
+logger = logging.getLogger("planner")
+
+# Only needed for errors, loaded on first use
+requests = lazyImport('requests')
+
+# Version of the plan format, plans of other versions are refused
+PLAN_VERSION = 1
+
+# Download rate assumed when estimating how long a plan takes, as planning downloads no attachment
+ESTIMATED_DOWNLOAD_RATE = 10 * 1024 * 1024
+
+# Gmail sends attachment data base64 encoded, a third larger than the attachment
+ENCODING_OVERHEAD = 4 / 3
+
+
+def _contentType(contentType: str):
+    # the Content-Type header may carry parameters such as the name of the attachment
+    return (contentType or '').split(';')[0].strip().lower() or 'unknown'
+
+
+def _emailsOf(auth: GoogleAuth, emails, workers: int, batchSize: int, cache: MetadataCache):
+    # retrieves the emails listed, by batch requests or concurrently, in the order listed
+    if batchSize or workers <= 1:
+        yield from emails
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plan") as executor:
+        pending = collections.deque()
+        for msgId in emails.messageIds():
+            pending.append(executor.submit(EmailMsg, auth, msgId, cache=cache))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def planBackup(auth: GoogleAuth, ledger: Ledger, query: str = '', attachmentFilter: AttachmentFilter = None,
+               workers: int = 1, batchSize: int = 0, pageSize: int = 500, listShards: int = 1,
+               cache: MetadataCache = None, downloadRate: float = ESTIMATED_DOWNLOAD_RATE):
+    """
+    Works out what a run would download without downloading anything. The emails of the query are
+    listed and retrieved, but only their headers and attachment metadata, and the attachments a run
+    would save are counted with their sizes as reported by the emails. The plan can be saved with
+    savePlan and executed later by a run given it, which then needs no listing.
+
+    The runtime is estimated as the slowest of three limits at the given concurrency: the quota,
+    the requests at the latency seen while planning, and the attachment data at downloadRate.
+    With a cache, the emails retrieved while planning are cached and the run is assumed to find
+    them there.
+
+    Parameters
+    ----------
+    auth : GoogleAuth
+        Authentication object into Google APIs
+    ledger : Ledger
+        Ledger of the attachments already downloaded, which the plan leaves out
+    query : str
+        gmail query string of the emails to plan for
+    attachmentFilter : AttachmentFilter
+        predicate applied to each attachment's metadata, None for every attachment
+    workers : int
+        number of threads retrieving emails, also assumed by the estimate
+    batchSize : int
+        number of emails retrieved per batch request, 0 to not use batch requests, also assumed by the estimate
+    pageSize : int
+        number of emails listed per request, up to 500
+    listShards : int
+        number of threads listing the emails at once, 1 to list them page by page
+    cache : MetadataCache
+        cache of the metadata of emails seen before, None to retrieve every email
+    downloadRate : float
+        bytes per second attachments are assumed to download at
+
+    Returns
+    -------
+    The plan, a dictionary that can be saved as JSON.
+    """
+
+    if not attachmentFilter:
+        attachmentFilter = AttachmentFilter()
+
+    started = time.time()
+    # taken before listing, like the sync state of a run, so the plan covers everything up to here
+    historyId = getHistoryId(auth)
+    if listShards > 1:
+        emails = ShardedEmail(auth, query=query, shards=listShards, batchSize=batchSize,
+                              pageSize=pageSize, cache=cache)
+    else:
+        emails = Email(auth, query=query, batchSize=batchSize, pageSize=pageSize, cache=cache)
+
+    planned = []
+    listed = 0
+    attachments = 0
+    inline = 0
+    inlineEmails = 0
+    totalBytes = 0
+    byType = collections.defaultdict(lambda: {'attachments': 0, 'bytes': 0})
+    try:
+        for email in _emailsOf(auth, emails, workers, batchSize, cache):
+            listed += 1
+            wanted = [attachment for attachment in email
+                      if not ledger.contains(email.msgId, attachment.partId, attachment.filename)
+                      and attachmentFilter(attachment)]
+            if not wanted:
+                continue
+            planned.append(email.msgId)
+            if any(attachment.isInline for attachment in wanted):
+                inlineEmails += 1
+            for attachment in wanted:
+                contentType = byType[_contentType(attachment.contentType)]
+                contentType['attachments'] += 1
+                contentType['bytes'] += attachment.size or 0
+                attachments += 1
+                totalBytes += attachment.size or 0
+                if attachment.isInline:
+                    inline += 1
+            if listed % 1000 == 0:
+                logger.info("Planned %d emails so far", listed)
+    finally:
+        emails.close()
+
+    # what the run costs: the emails, unless cached, the attachments not inline in them, and the
+    # emails again for those that are
+    byMethod = {'gmail.users.messages.get': (0 if cache else len(planned)) + inlineEmails,
+                'gmail.users.messages.attachments.get': attachments - inline}
+    units = {method: count * auth.limiter.cost(method) for method, count in byMethod.items()}
+    calls = sum(byMethod.values())
+    # the inline attachments of an email are read with a request of its own, outside any batch
+    roundTrips = math.ceil((calls - inlineEmails) / batchSize) + inlineEmails if batchSize else 0
+    latencies = auth.metrics.toDict()['histograms'].get('api_latency_seconds', {}).values()
+    observed = sum(histogram['count'] for histogram in latencies)
+    latency = sum(histogram['sum'] for histogram in latencies) / observed if observed else 0
+    estimate = {'quotaSeconds': sum(units.values()) / auth.limiter.unitsPerSecond,
+                'requestSeconds': roundTrips * latency if batchSize else calls * latency / max(workers, 1),
+                'downloadSeconds': totalBytes * ENCODING_OVERHEAD / downloadRate,
+                'workers': workers, 'batchSize': batchSize, 'latency': latency, 'downloadRate': downloadRate}
+    estimate['seconds'] = max(estimate['quotaSeconds'], estimate['requestSeconds'], estimate['downloadSeconds'])
+
+    return {'version': PLAN_VERSION, 'createdAt': started, 'historyId': historyId, 'query': query,
+            'filter': {'contentType': attachmentFilter.contentType, 'minSize': attachmentFilter.minSize,
+                       'maxSize': attachmentFilter.maxSize, 'filenamePattern': attachmentFilter.filenamePattern},
+            'totals': {'emailsListed': listed, 'emails': len(planned), 'attachments': attachments,
+                       'inlineAttachments': inline, 'bytes': totalBytes},
+            'byContentType': dict(sorted(byType.items())),
+            'quota': {'units': sum(units.values()), 'requests': byMethod},
+            'estimate': estimate,
+            'emails': planned}
+
+
+def planSummary(plan: dict):
+    """
+    Returns a short human readable report of a plan.
+    """
+
+    totals = plan['totals']
+    estimate = plan['estimate']
+    lines = ["%d of %d emails have %d attachments to download, %.1f MB" % (
+        totals['emails'], totals['emailsListed'], totals['attachments'], totals['bytes'] / 1024 / 1024)]
+    for contentType, counts in plan['byContentType'].items():
+        lines.append("  %s: %d attachments, %.1f MB" % (
+            contentType, counts['attachments'], counts['bytes'] / 1024 / 1024))
+    lines.append("Quota units: %d" % plan['quota']['units'])
+    lines.append("Estimated runtime: %.0fs at %d workers%s (quota %.0fs, requests %.0fs, download %.0fs)" % (
+        estimate['seconds'], estimate['workers'],
+        ", batches of %d" % estimate['batchSize'] if estimate['batchSize'] else '',
+        estimate['quotaSeconds'], estimate['requestSeconds'], estimate['downloadSeconds']))
+    return "\n".join(lines)
+
+
+def savePlan(path: str, plan: dict):
+    """
+    Writes a plan to a JSON file, replacing it in one step.
+    """
+
+    tempFile = path + '.tmp'
+    with open(tempFile, 'w', encoding="utf-8") as f:
+        json.dump(plan, f, indent=1)
+    os.replace(tempFile, path)
+    logger.info("Plan of %d emails written to %s", len(plan['emails']), path)
+
+
+def loadPlan(path: str):
+    """
+    Reads a plan written by savePlan.
+
+    Raises
+    ------
+    ValueError
+        If the file is not a plan of this version.
+    """
+
+    with open(path, 'r', encoding="utf-8") as f:
+        plan = json.load(f)
+    if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION or 'emails' not in plan:
+        raise ValueError("%s is not a plan of version %d." % (path, PLAN_VERSION))
+    return plan
+
+
+class PlannedEmail():
+    """
+    PlannedEmail represents the emails of a plan. The emails can be iterated like Email, but are
+    not listed again, and only those the plan found attachments to download in are retrieved.
+    With a batchSize, they are retrieved batchSize at a time with batch requests.
+
+    With a checkpointFile, the position of the last email reported processed through checkpoint() is
+    saved periodically, and a new PlannedEmail for the same plan continues from that position.
+    """
+
+    def __init__(self, auth: GoogleAuth, plan: dict, userId: str = 'me', checkpointFile: str = None,
+                 cache: MetadataCache = None, batchSize: int = 0):
+        self.logger = logging.getLogger(
+            "planner." + self.__class__.__name__)
+
+        if not auth:
+            raise ValueError("Valid GoogleAuth required for email.")
+        if batchSize < 0 or batchSize > MAX_BATCH_SIZE:
+            raise ValueError(
+                "batchSize must be between 0 and %d." % MAX_BATCH_SIZE)
+
+        self.__auth = auth
+        self.__userId = userId
+        self.__plan = plan['createdAt']
+        self.__msgIds = plan['emails']
+        self.__checkpointFile = CheckpointFile(checkpointFile) if checkpointFile else None
+        self.__cache = cache
+        self.__batchSize = batchSize
+        # emails taken from the plan with their batched responses, not yet handed out
+        self.__batch = collections.deque()
+        self.__position = self.__loadCheckpoint()
+        self.__sinceCheckpoint = 0
+        # position after each email, to checkpoint by ID
+        self.__positions = {msgId: index + 1 for index, msgId in enumerate(self.__msgIds)}
+
+    def __loadCheckpoint(self):
+        checkpoint = self.__checkpointFile.load() if self.__checkpointFile else None
+        if not checkpoint:
+            return 0
+        if checkpoint.get('plan') != self.__plan:
+            self.logger.info("Ignoring checkpoint of another listing or plan")
+            return 0
+        self.logger.info("Resuming from checkpoint at email %d of the plan", checkpoint['position'])
+        return checkpoint['position']
+
+    def __saveCheckpoint(self, position: int):
+        self.__checkpointFile.save({'plan': self.__plan, 'position': position})
+        self.__sinceCheckpoint = 0
+        self.logger.debug("Checkpoint saved at email %d of the plan", position)
+
+    def checkpoint(self, msgId: str):
+        """
+        Reports that the email, and every email handed out before it, has been processed. The
+        position after it is saved to the checkpoint file every CHECKPOINT_INTERVAL emails. Does
+        nothing without a checkpoint file.
+
+        Parameters
+        ----------
+        msgId : str
+            ID of the processed email.
+        """
+
+        if not self.__checkpointFile or msgId not in self.__positions:
+            return
+        self.__sinceCheckpoint += 1
+        if self.__sinceCheckpoint >= CHECKPOINT_INTERVAL:
+            self.__saveCheckpoint(self.__positions[msgId])
+
+    def clearCheckpoint(self):
+        """
+        Removes the checkpoint file, for once every email has been processed.
+        """
+
+        if self.__checkpointFile:
+            self.__checkpointFile.clear()
+
+    def close(self):
+        """
+        Does nothing, a plan is read in full when loaded.
+        """
+
+    def messageIds(self):
+        """
+        Generator of the IDs of the remaining emails, without retrieving the emails themselves.
+        Shares its position with iteration over the PlannedEmail object.
+
+        Yields
+        ------
+        str
+            ID of the next email.
+        """
+
+        while self.__position < len(self.__msgIds):
+            self.__position += 1
+            yield self.__msgIds[self.__position - 1]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.__batch:
+            msgIds = self.__msgIds[self.__position:self.__position + max(self.__batchSize, 1)]
+            if not msgIds:
+                raise StopIteration
+            responses = {}
+            if self.__batchSize:
+                responses = retrieveBatched(self.__auth, msgIds, self.__userId, self.__cache, self.__batchSize)
+            self.__batch = collections.deque((msgId, responses.get(msgId)) for msgId in msgIds)
+        msgId, response = self.__batch.popleft()
+        self.__position += 1
+        if isinstance(response, requests.HTTPError):
+            self.logger.error("Error getting email: %s %s", *response.args)
+            raise response
+        return EmailMsg(self.__auth, msgId, self.__userId, response, self.__cache)
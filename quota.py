@@ -0,0 +1,162 @@
+import json
+import logging
+import random
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+logger = logging.getLogger("quota")
+
+# Gmail quota units consumed by each API method, by discovery method ID
+METHOD_COSTS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+}
+
+# Cost assumed for methods missing from METHOD_COSTS
+DEFAULT_COST = 5
+
+# Gmail allows each user 250 quota units per second
+DEFAULT_UNITS_PER_SECOND = 250
+
+# Exponential backoff between retries starts at BASE_DELAY seconds and is capped at MAX_DELAY
+BASE_DELAY = 1.0
+MAX_DELAY = 64.0
+
+# Reasons given by Gmail with a 403 status when the request was rate limited rather than denied
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+
+
+class QuotaLimiter():
+    """
+    QuotaLimiter is a token bucket of Gmail quota units shared by every thread making requests for
+    the same user. Callers acquire the units a request costs before sending it, and wait if the
+    bucket has run dry, which keeps concurrent and batched requests just under the quota.
+
+    Attributes
+    ----------
+    unitsPerSecond : float
+        Rate the bucket refills at.
+    capacity : float
+        Most units the bucket holds, the largest burst allowed after being idle.
+    """
+
+    def __init__(self, unitsPerSecond: float = DEFAULT_UNITS_PER_SECOND, capacity: float = None):
+        if unitsPerSecond <= 0:
+            raise ValueError("unitsPerSecond must be positive.")
+
+        self.unitsPerSecond = unitsPerSecond
+        self.capacity = capacity if capacity else unitsPerSecond
+        self.__tokens = self.capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def cost(methodId: str):
+        """
+        Returns the quota units a request for the API method costs.
+
+        Parameters
+        ----------
+        methodId : str
+            Discovery ID of the method, such as gmail.users.messages.get. None for requests that
+            have no method of their own, such as batches, whose sub-requests are counted instead.
+        """
+
+        if not methodId:
+            return 0
+        return METHOD_COSTS.get(methodId, DEFAULT_COST)
+
+    def acquire(self, units: float):
+        """
+        Takes units from the bucket, first sleeping until enough have accumulated. Units are
+        reserved before sleeping, so waiting callers are served in turn.
+
+        Parameters
+        ----------
+        units : float
+            Number of quota units to take.
+        """
+
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens +
+                                (now - self.__updated) * self.unitsPerSecond)
+            self.__updated = now
+            self.__tokens -= units
+            wait = -self.__tokens / self.unitsPerSecond if self.__tokens < 0 else 0
+        if wait > 0:
+            logger.debug("Waiting %.3fs for %s quota units", wait, units)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Empties the bucket so that no request is sent for the given time, for when Gmail reports
+        that the quota was exceeded anyway.
+
+        Parameters
+        ----------
+        seconds : float
+            Time to hold back all requests for.
+        """
+
+        with self.__lock:
+            self.__tokens = min(self.__tokens, -seconds * self.unitsPerSecond)
+
+
+def _errorReason(e: HttpError):
+    try:
+        return json.loads(e.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def isRateLimited(e: Exception):
+    """
+    Returns True if the error is Gmail reporting that too many requests were made.
+    """
+
+    if not isinstance(e, HttpError):
+        return False
+    status = e.resp.status
+    return status == 429 or (status == 403 and _errorReason(e) in RATE_LIMIT_REASONS)
+
+
+def isRetryable(e: Exception):
+    """
+    Returns True if the request that raised the error may succeed if sent again: rate limiting,
+    server errors and network failures.
+    """
+
+    if isinstance(e, HttpError):
+        return isRateLimited(e) or e.resp.status >= 500
+    return isinstance(e, (OSError, httplib2.HttpLib2Error))
+
+
+def retryDelay(e: Exception, attempt: int):
+    """
+    Returns how long to wait before the given retry attempt, counting from 0. The delay is
+    exponential with full jitter, and at least as long as the Retry-After header asks for.
+
+    Parameters
+    ----------
+    e : Exception
+        Error the request failed with.
+    attempt : int
+        Number of retries already made.
+    """
+
+    delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+    retryAfter = e.resp.get('retry-after') if isinstance(e, HttpError) else None
+    if retryAfter:
+        try:
+            delay = max(delay, float(retryAfter))
+        except ValueError:
+            # an HTTP date rather than seconds, fall back on the backoff
+            pass
+    return delay
@@ -0,0 +1,52 @@
+import importlib
+import importlib.util
+import sys
+import time
+import types
+
+# When this module was first imported. attachBack imports it before anything else, so the time
+# from here to main is the cost of the application's imports.
+STARTED = time.perf_counter()
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Stands in for a module until one of its attributes is used, then imports it. The import goes
+    through importlib, which holds the module's import lock, so threads using it for the first
+    time at once wait for one import instead of racing as they would with a LazyLoader module.
+    """
+
+    def __getattr__(self, attribute: str):
+        return getattr(importlib.import_module(self.__name__), attribute)
+
+
+def lazyImport(name: str):
+    """
+    Returns a module that is only loaded when one of its attributes is first used, so that heavy
+    dependencies needed only on some paths, such as for errors, don't slow every start. It is
+    safe to first use from several threads.
+
+    Parameters
+    ----------
+    name : str
+        Name of the module, such as requests.
+
+    Raises
+    ------
+    ImportError
+        If there is no such module.
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError("No module named " + name, name=name)
+    return _LazyModule(name)
+
+
+def sinceStarted():
+    """
+    Returns the seconds since the application started importing its modules.
+    """
+
+    return time.perf_counter() - STARTED
@@ -0,0 +1,301 @@
+import email.utils
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger("storage")
+
+# Layouts of the download path: every attachment in it, or filed by the year and month of the
+# email, by the domain of its sender or by the first characters of the SHA-256 of its data
+LAYOUTS = ['flat', 'month', 'sender', 'hash']
+
+# Characters that are replaced in a sender domain before it names a directory
+_UNSAFE_DOMAIN = re.compile(r'[^a-z0-9.-]')
+
+
+def syncFile(path: str):
+    """
+    Flushes a file's data to disk.
+
+    Parameters
+    ----------
+    path : str
+        Path and file name of the file to flush.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncDirectory(path: str):
+    """
+    Flushes a directory's entries to disk, so files renamed into it survive a crash. Does nothing
+    where directories can't be opened, such as on Windows.
+
+    Parameters
+    ----------
+    path : str
+        Path of the directory to flush.
+    """
+
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def claimPath(directory: str, filename: str):
+    """
+    Reserves a free path for a file by creating it empty, which fails atomically if the name is
+    taken, even by another process. A taken name is prefixed with the time, and a counter if that
+    is taken too. The caller replaces the empty file with the real one.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to create the file in.
+    filename : str
+        Name wanted for the file.
+
+    Returns
+    -------
+    The path and file name reserved.
+    """
+
+    path = os.path.join(directory, filename)
+    attempt = 0
+    while True:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            return path
+        except FileExistsError:
+            attempt += 1
+            logger.info("Duplicate file %s found.", path)
+            prefix = str(time.time()) + ('-%d' % attempt if attempt > 1 else '')
+            path = os.path.join(directory, prefix + '-' + filename)
+
+
+def layoutDirectory(layout: str, date: str, sender: str, sha256: str):
+    """
+    Returns the directory an attachment is filed in, relative to the download path, so that no
+    directory grows too large to list or search quickly.
+
+    Parameters
+    ----------
+    layout : str
+        One of LAYOUTS
+    date : str
+        Date header of the email, emails without a valid one are filed under undated
+    sender : str
+        From header of the email, emails without a valid one are filed under unknown
+    sha256 : str
+        Hex SHA-256 digest of the attachment data
+
+    Returns
+    -------
+    The relative directory, empty for the flat layout.
+    """
+
+    if layout == 'month':
+        try:
+            received = email.utils.parsedate_to_datetime(date)
+        except (TypeError, ValueError):
+            return 'undated'
+        return os.path.join('%04d' % received.year, '%02d' % received.month)
+    if layout == 'sender':
+        _, at, domain = email.utils.parseaddr(sender or '')[1].rpartition('@')
+        domain = _UNSAFE_DOMAIN.sub('_', domain.lower())
+        return domain if at and domain.strip('.') else 'unknown'
+    if layout == 'hash':
+        return os.path.join(sha256[0:2], sha256[2:4])
+    return ''
+
+
+class NameIndex():
+    """
+    NameIndex hands out free file names from memory. The names in a directory are read with a single
+    scandir the first time it is used, after which taken names are found without a stat call, and
+    a name taken several times is numbered from where it was last left, as report-1.pdf,
+    report-2.pdf and so on. Each name is still created exclusively, so a name taken by another
+    process meanwhile, or differing only in case on a file system that ignores case, is skipped
+    rather than overwritten.
+
+    A NameIndex may be shared by several threads.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__names = {}
+        self.__counters = {}
+
+    def __namesIn(self, directory: str):
+        names = self.__names.get(directory)
+        if names is None:
+            os.makedirs(directory, exist_ok=True)
+            with os.scandir(directory) as entries:
+                names = {entry.name for entry in entries}
+            self.__names[directory] = names
+            logger.debug("Indexed %d names in %s", len(names), directory)
+        return names
+
+    def claim(self, directory: str, filename: str):
+        """
+        Reserves a free path for a file by creating it empty, like claimPath. The directory is
+        created if needed.
+
+        Parameters
+        ----------
+        directory : str
+            Directory to create the file in.
+        filename : str
+            Name wanted for the file.
+
+        Returns
+        -------
+        The path and file name reserved.
+        """
+
+        stem, extension = os.path.splitext(filename)
+        with self.__lock:
+            names = self.__namesIn(directory)
+            candidate = filename
+            counter = self.__counters.get((directory, filename), 0)
+            while True:
+                if candidate not in names:
+                    names.add(candidate)
+                    path = os.path.join(directory, candidate)
+                    try:
+                        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+                        self.__counters[(directory, filename)] = counter
+                        return path
+                    except FileExistsError:
+                        logger.info("File %s was created by someone else.", path)
+                counter += 1
+                candidate = '%s-%d%s' % (stem, counter, extension)
+
+
+def placeFile(tempPath: str, path: str):
+    """
+    Moves a completely written temporary file to its final path, flushing it to disk first so the
+    final path never refers to a partially written file after a crash.
+
+    Parameters
+    ----------
+    tempPath : str
+        Path and file name of the temporary file.
+    path : str
+        Path and file name to move it to, replaced if it exists.
+    """
+
+    syncFile(tempPath)
+    os.replace(tempPath, path)
+
+
+class ContentStore():
+    """
+    ContentStore keeps one copy of each distinct attachment, filed under the SHA-256 of its data in
+    a tree sharded on the first characters of the digest so no directory grows too large. Friendly
+    filenames are hard links to the stored copy, so attachments that arrive many times take the
+    space of one.
+
+    Attributes
+    ----------
+    root : str
+        Directory the store is kept in.
+    """
+
+    # Levels of sharding directories, each named by the next two characters of the digest
+    SHARD_LEVELS = 2
+
+    def __init__(self, root: str):
+        self.logger = logging.getLogger(
+            "storage." + self.__class__.__name__)
+
+        if not root:
+            raise ValueError("Valid root required for content store.")
+
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def pathFor(self, sha256: str):
+        """
+        Returns the path the data with the given SHA-256 is stored at.
+
+        Parameters
+        ----------
+        sha256 : str
+            Hex SHA-256 digest of the data.
+        """
+
+        shards = [sha256[level * 2:level * 2 + 2]
+                  for level in range(self.SHARD_LEVELS)]
+        return os.path.join(self.root, *shards, sha256)
+
+    def add(self, tempPath: str, sha256: str):
+        """
+        Moves a temporary file into the store, or removes it if the store already holds the same
+        data.
+
+        Parameters
+        ----------
+        tempPath : str
+            Path and file name of the temporary file with the data.
+        sha256 : str
+            Hex SHA-256 digest of the data.
+
+        Returns
+        -------
+        The path the data is stored at.
+        """
+
+        storePath = self.pathFor(sha256)
+        if os.path.exists(storePath):
+            self.logger.info("Duplicate of %s, not stored again", storePath)
+            os.remove(tempPath)
+            return storePath
+
+        os.makedirs(os.path.dirname(storePath), exist_ok=True)
+        placeFile(tempPath, storePath)
+        self.logger.debug("Stored %s", storePath)
+        return storePath
+
+    def link(self, tempPath: str, sha256: str, path: str):
+        """
+        Stores a temporary file and makes path a hard link to the stored copy, replacing any file
+        at path, such as one reserved by claimPath. If the file system does not support hard
+        links, path is removed.
+
+        Parameters
+        ----------
+        tempPath : str
+            Path and file name of the temporary file with the data.
+        sha256 : str
+            Hex SHA-256 digest of the data.
+        path : str
+            Path and file name of the friendly name for the data.
+
+        Returns
+        -------
+        The friendly path if it was linked, otherwise the path the data is stored at.
+        """
+
+        storePath = self.add(tempPath, sha256)
+        # the temporary name is free again, link there and rename over path as links can't replace
+        try:
+            os.link(storePath, tempPath)
+        except OSError as e:
+            self.logger.warning(
+                "Unable to link %s to %s, recording the stored copy instead: %s", path, storePath, e)
+            if os.path.exists(path):
+                os.remove(path)
+            return storePath
+        os.replace(tempPath, path)
+        return path
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from google.oauth2.credentials import Credentials
+
+import emailMsg
+from emailMsg import INITIAL_WINDOW, Email, GoogleAuth, ShardedEmail
+from fakeGmail import FakeGmailServer, Mailbox
+from metrics import Metrics
+from quota import QuotaLimiter
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+
+
+class ShardedEmailTest(unittest.TestCase):
+    """
+    Lists a fake mailbox of emails a day apart with ShardedEmail, the listing starting at the
+    second of one of the emails so the windows meet where an email was received.
+    """
+
+    MESSAGES = 300
+
+    def setUp(self):
+        self.mailbox = Mailbox(self.MESSAGES, attachments=0)
+        self.server = FakeGmailServer(self.mailbox)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        # the newest email is sent a little after the listing starts, the window boundaries
+        # INITIAL_WINDOW apart fall on emails
+        self.now = self.mailbox.messageTime(self.MESSAGES - 10)
+        self.expected = [Mailbox.messageId(index) for index in range(self.MESSAGES - 1, -1, -1)]
+
+    def auth(self):
+        return GoogleAuth(SCOPES, 'gmail', 'v1', {'installed': {}}, Credentials(token='fake'),
+                          limiter=QuotaLimiter(10**6), metrics=Metrics(), discoveryUrl=self.server.discoveryUrl)
+
+    def sharded(self, auth, **kwargs):
+        with mock.patch.object(emailMsg.time, 'time', return_value=self.now):
+            return ShardedEmail(auth, **kwargs)
+
+    def testListsLikeEmail(self):
+        auth = self.auth()
+        self.assertEqual(list(Email(auth).messageIds()), self.expected)
+        # one shard lists the windows from the newest back, so the emails come in Email's order
+        self.assertEqual(list(self.sharded(auth, shards=1).messageIds()), self.expected)
+
+    def testMergesWithoutDuplicates(self):
+        auth = self.auth()
+        msgIds = list(self.sharded(auth, shards=4).messageIds())
+        self.assertEqual(len(msgIds), len(set(msgIds)))
+        self.assertEqual(set(msgIds), set(self.expected))
+
+    def testSplitsFullWindows(self):
+        auth = self.auth()
+        # the initial window holds 30 emails, more than a page
+        pageSize = INITIAL_WINDOW // 86400 // 4
+        msgIds = list(self.sharded(auth, shards=4, pageSize=pageSize).messageIds())
+        self.assertEqual(len(msgIds), len(set(msgIds)))
+        self.assertEqual(set(msgIds), set(self.expected))
+        self.assertGreater(auth.metrics.get('list_windows_total', 'split'), 0)
+
+    def testResumes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        checkpointFile = os.path.join(directory.name, 'checkpoint.json')
+        syncState = {'historyId': '1', 'startTime': 1}
+
+        emails = self.sharded(self.auth(), shards=2, checkpointFile=checkpointFile, syncState=syncState)
+        processed = []
+        for msgId in emails.messageIds():
+            processed.append(msgId)
+            emails.checkpoint(msgId)
+            if len(processed) == self.MESSAGES // 2:
+                break
+        emails.close()
+        self.assertTrue(os.path.exists(checkpointFile))
+
+        auth = self.auth()
+        resumed = self.sharded(auth, shards=2, checkpointFile=checkpointFile,
+                               syncState={'historyId': '2', 'startTime': 2})
+        self.assertEqual(resumed.syncState, syncState)
+        remaining = list(resumed.messageIds())
+        self.assertEqual(set(processed) | set(remaining), set(self.expected))
+        # only the emails of windows not completed are listed again
+        self.assertLess(len(remaining), self.MESSAGES)
+
+        resumed.clearCheckpoint()
+        self.assertFalse(os.path.exists(checkpointFile))
+
+
+if __name__ == '__main__':
+    unittest.main()
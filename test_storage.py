@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+
+from storage import NameIndex, layoutDirectory
+
+
+class NameIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def testClaimsFreeName(self):
+        path = NameIndex().claim(self.directory, 'report.pdf')
+        self.assertEqual(path, os.path.join(self.directory, 'report.pdf'))
+        self.assertTrue(os.path.isfile(path))
+
+    def testCreatesDirectory(self):
+        directory = os.path.join(self.directory, '2022', '03')
+        path = NameIndex().claim(directory, 'report.pdf')
+        self.assertEqual(path, os.path.join(directory, 'report.pdf'))
+        self.assertTrue(os.path.isfile(path))
+
+    def testNumbersTakenNames(self):
+        names = NameIndex()
+        paths = [names.claim(self.directory, 'report.pdf') for _ in range(3)]
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ['report.pdf', 'report-1.pdf', 'report-2.pdf'])
+        self.assertEqual(os.path.basename(names.claim(self.directory, 'notes')), 'notes')
+        self.assertEqual(os.path.basename(names.claim(self.directory, 'notes')), 'notes-1')
+
+    def testSkipsExistingFiles(self):
+        for filename in ('report.pdf', 'report-1.pdf'):
+            open(os.path.join(self.directory, filename), 'w').close()
+        path = NameIndex().claim(self.directory, 'report.pdf')
+        self.assertEqual(os.path.basename(path), 'report-2.pdf')
+
+    def testSkipsFilesCreatedAfterIndexing(self):
+        names = NameIndex()
+        names.claim(self.directory, 'report.pdf')
+        # created by another process once the directory was read
+        open(os.path.join(self.directory, 'report-1.pdf'), 'w').close()
+        path = names.claim(self.directory, 'report.pdf')
+        self.assertEqual(os.path.basename(path), 'report-2.pdf')
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, 'report-1.pdf')), 0)
+
+    def testIndexesDirectoriesSeparately(self):
+        names = NameIndex()
+        other = os.path.join(self.directory, 'other')
+        names.claim(self.directory, 'report.pdf')
+        path = names.claim(other, 'report.pdf')
+        self.assertEqual(path, os.path.join(other, 'report.pdf'))
+
+    def testSharesIndexBetweenInstances(self):
+        NameIndex().claim(self.directory, 'report.pdf')
+        # a new index reads what an earlier one left in the directory
+        path = NameIndex().claim(self.directory, 'report.pdf')
+        self.assertEqual(os.path.basename(path), 'report-1.pdf')
+
+
+class LayoutDirectoryTest(unittest.TestCase):
+
+    SHA256 = 'abcdef' + '0' * 58
+
+    def testFlat(self):
+        self.assertEqual(layoutDirectory('flat', 'Tue, 15 Mar 2022 10:00:00 +0000', 'a@example.com',
+                                         self.SHA256), '')
+
+    def testMonth(self):
+        self.assertEqual(layoutDirectory('month', 'Tue, 15 Mar 2022 10:00:00 +0000', None, self.SHA256),
+                         os.path.join('2022', '03'))
+
+    def testMonthUndated(self):
+        for date in (None, '', 'not a date'):
+            self.assertEqual(layoutDirectory('month', date, None, self.SHA256), 'undated')
+
+    def testSender(self):
+        self.assertEqual(layoutDirectory('sender', None, 'Alice <alice@Mail.Example.COM>', self.SHA256),
+                         'mail.example.com')
+
+    def testSenderUnsafe(self):
+        self.assertEqual(layoutDirectory('sender', None, 'alice@exa$mple.com', self.SHA256), 'exa_mple.com')
+        self.assertEqual(layoutDirectory('sender', None, 'alice@..', self.SHA256), 'unknown')
+
+    def testSenderUnknown(self):
+        for sender in (None, '', 'Alice', 'alice@'):
+            self.assertEqual(layoutDirectory('sender', None, sender, self.SHA256), 'unknown')
+
+    def testHash(self):
+        self.assertEqual(layoutDirectory('hash', None, None, self.SHA256), os.path.join('ab', 'cd'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import collections
+import logging
+import os
+import queue
+import threading
+
+from archive import ArchiveWriter
+from hooks import PostProcessor
+from ledger import Ledger
+from metrics import Metrics
+from storage import LAYOUTS, ContentStore, NameIndex, layoutDirectory, syncDirectory, syncFile
+
+logger = logging.getLogger("writer")
+
+# Most attachments moved into place and recorded in the ledger with one flush
+WRITE_BATCH_SIZE = 64
+
+# Most emails waiting for the writer before the fetchers are held back
+WRITE_QUEUE_SIZE = 128
+
+# Marks the end of the queue
+_CLOSE = object()
+
+
+class AttachmentWriter():
+    """
+    AttachmentWriter is the stage that moves downloaded attachments into place and records them in
+    the ledger, on a thread of its own so that a slow disk or network share does not stall the API
+    requests. Emails are queued in the order they should be checkpointed, with the temporary files
+    of their attachments. The queue is bounded, so fetching waits when the disk falls behind.
+
+    Whatever is queued is written in batches: the files of a batch are flushed, given their names,
+    their directory is flushed once and they are recorded in one ledger transaction. A batch is
+    written as soon as the queue runs empty, so batches only grow while the disk is behind.
+
+    Each attachment is named by calling name with its email and itself, which returns the filename
+    to save it under or None to skip it. The layout files it in a directory of the download path,
+    see layoutDirectory. Taken names are made unique by a NameIndex, numbering the later ones,
+    which may be kept across writers of the same download path so directories are read once. With
+    an archive, attachments are appended to it instead, and the archive is flushed once per batch.
+    With a postProcessor, every attachment written is handed to its hooks once recorded.
+
+    Attributes
+    ----------
+    downloadPath : str
+        Path attachments are moved into.
+    layout : str
+        Layout of the directories attachments are filed in, one of LAYOUTS.
+    """
+
+    def __init__(self, downloadPath: str, ledger: Ledger, name, metrics: Metrics = None, store: ContentStore = None,
+                 archive: ArchiveWriter = None, batchSize: int = WRITE_BATCH_SIZE, queueSize: int = WRITE_QUEUE_SIZE,
+                 postProcessor: PostProcessor = None, layout: str = 'flat', names: NameIndex = None):
+        self.logger = logging.getLogger(
+            "writer." + self.__class__.__name__)
+
+        if not ledger:
+            raise ValueError("Valid ledger required for writer.")
+        if archive and postProcessor:
+            raise ValueError("Post processing can't be used with an archive.")
+        if layout not in LAYOUTS:
+            raise ValueError("Layout must be one of %s." % ", ".join(LAYOUTS))
+        if archive and layout != 'flat':
+            raise ValueError("Layouts can't be used with an archive.")
+
+        self.downloadPath = downloadPath
+        self.layout = layout
+        self.__names = names if names else NameIndex()
+        self.__ledger = ledger
+        self.__name = name
+        self.__metrics = metrics if metrics else Metrics()
+        self.__store = store
+        self.__archive = archive
+        self.__postProcessor = postProcessor
+        self.__batchSize = batchSize
+        self.__queue = queue.Queue(queueSize)
+        self.__written = collections.deque()
+        self.__error = None
+        self.__thread = threading.Thread(
+            target=self.__run, name="writer", daemon=True)
+        self.__thread.start()
+
+    def put(self, email, attachments: list):
+        """
+        Queues an email to be written, waiting while the queue is full.
+
+        Parameters
+        ----------
+        email : EmailMsg
+            Email the attachments belong to
+        attachments : list
+            List of (Attachment, SavedFile) tuples of its downloaded attachments, may be empty
+
+        Raises
+        ------
+        Exception
+            The error the writer failed with, if it did.
+        """
+
+        self.__put((email, attachments))
+
+    def __put(self, item):
+        with self.__metrics.phase('backpressure'):
+            while True:
+                self.__raiseError()
+                try:
+                    # wake up now and then in case the writer failed
+                    self.__queue.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+    def popWritten(self):
+        """
+        Returns the IDs of the emails whose attachments have all been written and recorded since
+        the last call, in the order they were queued.
+        """
+
+        written = []
+        while self.__written:
+            written.append(self.__written.popleft())
+        return written
+
+    def close(self):
+        """
+        Writes everything queued and stops the writer.
+
+        Raises
+        ------
+        Exception
+            The error the writer failed with, if it did.
+        """
+
+        if self.__thread.is_alive():
+            self.__put(_CLOSE)
+            self.__thread.join()
+        self.__raiseError()
+
+    def __raiseError(self):
+        if self.__error:
+            raise self.__error
+
+    def __run(self):
+        try:
+            closing = False
+            while not closing:
+                batch = []
+                count = 0
+                item = self.__queue.get()
+                while True:
+                    if item is _CLOSE:
+                        closing = True
+                        break
+                    batch.append(item)
+                    count += len(item[1])
+                    if count >= self.__batchSize:
+                        break
+                    try:
+                        item = self.__queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if batch:
+                    self.__write(batch)
+        except BaseException as e:
+            self.logger.error("Writer failed: %s", e)
+            self.__error = e
+
+    def __write(self, batch: list):
+        if self.__archive:
+            self.__writeArchive(batch)
+            return
+
+        metrics = self.__metrics
+        records = []
+        contentTypes = []
+        directories = set()
+        with metrics.phase('disk'):
+            # flush the data first, so no name ever refers to a partly written file after a crash
+            if not self.__store:
+                for _, attachments in batch:
+                    for _, saved in attachments:
+                        syncFile(saved.path)
+
+            for email, attachments in batch:
+                for attachment, saved in attachments:
+                    filename = self.__name(email, attachment)
+                    if not filename:
+                        os.remove(saved.path)
+                        metrics.increment('attachments_skipped_total', 'unnamed')
+                        continue
+                    directory = os.path.join(self.downloadPath, layoutDirectory(
+                        self.layout, email.date, email.sender, saved.sha256))
+                    path = self.__names.claim(directory, filename)
+                    directories.add(directory)
+                    self.logger.info("Writing: %s", path)
+                    if self.__store:
+                        path = self.__store.link(saved.path, saved.sha256, path)
+                    else:
+                        os.replace(saved.path, path)
+                    records.append((email.msgId, attachment.partId, attachment.filename, path,
+                                    saved.size, saved.sha256))
+                    contentTypes.append(attachment.contentType)
+
+            if records:
+                self.__syncDirectories(directories)
+                self.__ledger.addMany(records)
+        metrics.increment('attachments_saved_total', amount=len(records))
+        if self.__postProcessor:
+            for (msgId, partId, filename, path, size, sha256), contentType in zip(records, contentTypes):
+                self.__postProcessor.submit(path, {'msgId': msgId, 'partId': partId, 'filename': filename,
+                                                   'contentType': contentType, 'size': size, 'sha256': sha256})
+        self.logger.debug("Wrote %d attachments of %d emails",
+                          len(records), len(batch))
+        self.__written.extend(email.msgId for email, _ in batch)
+
+    def __syncDirectories(self, directories: set):
+        # the names written, and the directories made for them up to the download path
+        synced = set()
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory not in synced:
+                syncDirectory(directory)
+                synced.add(directory)
+                if os.path.normpath(directory) == os.path.normpath(self.downloadPath):
+                    break
+                directory = os.path.dirname(directory)
+
+    def __writeArchive(self, batch: list):
+        metrics = self.__metrics
+        records = []
+        members = []
+        with metrics.phase('disk'):
+            for email, attachments in batch:
+                for attachment, saved in attachments:
+                    filename = self.__name(email, attachment)
+                    if filename:
+                        path, member, offset = self.__archive.add(
+                            saved.path, email.msgId, attachment.partId, filename)
+                        self.logger.info("Archived: %s in %s", member, path)
+                        records.append((email.msgId, attachment.partId, attachment.filename, path,
+                                        saved.size, saved.sha256))
+                        members.append((email.msgId, attachment.partId, member, offset))
+                    else:
+                        metrics.increment('attachments_skipped_total', 'unnamed')
+                    os.remove(saved.path)
+
+            if records:
+                # the members must be on disk before the ledger says they are
+                self.__archive.flush()
+                self.__ledger.addMany(records, members)
+        metrics.increment('attachments_saved_total', amount=len(records))
+        self.__written.extend(email.msgId for email, _ in batch)